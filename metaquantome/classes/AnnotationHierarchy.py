@@ -1,29 +1,60 @@
+import numpy as np
 import pandas as pd
 
 import metaquantome.classes.AnnotationNode as anode
 from metaquantome.databases.GeneOntologyDb import GeneOntologyDb
 from metaquantome.databases.NCBITaxonomyDb import NCBITaxonomyDb
+from metaquantome.databases.ClosureCache import unwrap_db
+
+# number of buffered term observations that are added to the node arrays at once
+FLUSH_SIZE = 1000000
 
 
 class AnnotationHierarchy:
     """
     Annotation Hierarchy takes in a dataframe and builds a hierarchy for a specific sample.
     After hierarchy is built from the dataframe, the hierarchy can be written to dataframe.
+
+    Nodes are not stored as objects: each term has a position in a term index, which can be shared
+    by the hierarchies of all samples, and the intensity, number of peptides, and number of sample children
+    of the terms are held in parallel arrays at those positions. Observations are buffered and added to the
+    arrays in one step, in the order they were made. The children of a term within the sample are only
+    listed on request, with `get_sample_children()`.
     """
-    def __init__(self, db, sample_set, sample_name):
+    def __init__(self, db, sample_set, sample_name, term_index=None, term_list=None):
         """
         Create instance of Annotation hierarchy and set methods.
-        `nodes` and `informative_nodes` are filled later,
-        in `add_nodes_from_df()`.
+        The nodes are filled later, in `add_nodes_from_df()`.
 
-        :param db: The relevant database.
+        :param db: The relevant database. May be wrapped in a ClosureCache, which can be shared between samples.
         :param sample_set: Set of all direct annotations in specific sample.
         :param sample_name: Name of the sample to build hierarchy for
+        :param term_index: dictionary of the form {term: position}, shared by the hierarchies of several samples
+        so that each term is stored once. New terms are added to it. If None, the hierarchy has its own index
+        :param term_list: list of the terms in the order of their positions in term_index, shared with it.
+        Must be given together with term_index
         """
+        if (term_index is None) != (term_list is None):
+            raise ValueError('term_index and term_list must be given together')
         self.db = db
         self.sample_set = sample_set
-        self.nodes = dict()
         self.sample_name = sample_name
+        self.term_index = dict() if term_index is None else term_index
+        self.term_list = list() if term_list is None else term_list
+        # node arrays, indexed by term position. npeptide is 0 for terms that are not in this sample
+        self.intensity = np.zeros(0)
+        self.npeptide = np.zeros(0, dtype=np.int32)
+        self.n_sample_children = None
+        # observations not yet added to the arrays: term positions and intensities
+        self._pending_positions = list()
+        self._pending_intensities = list()
+        # check the type of the underlying database once, rather than for every term
+        ref_db = unwrap_db(db)
+        self.is_ncbi = isinstance(ref_db, NCBITaxonomyDb)
+        # if using GO and slimming down, only ancestors in the slim are added
+        self.slim_db = None
+        if isinstance(ref_db, GeneOntologyDb) and ref_db.slim_down:
+            self.slim_db = ref_db
 
     def add_nodes_from_df(self, df, annot_colname, int_colname):
         """
@@ -34,12 +65,10 @@ class AnnotationHierarchy:
         :param int_colname: Name of column with quantification for `self.sample_name`
         :return: None
         """
-        for index, row in df.iterrows():
-            term = row[annot_colname]
+        for term, intensity in zip(df[annot_colname].values, df[int_colname].values):
             # ensure each taxID is an integer (gets converted to float a lot by pandas)
-            if isinstance(self.db, NCBITaxonomyDb):
+            if self.is_ncbi:
                 term = int(term)
-            intensity = row[int_colname]
             self._add_node_with_ancestors(term, intensity)
 
         # add sample children here
@@ -47,7 +76,7 @@ class AnnotationHierarchy:
 
     def _add_node_with_ancestors(self, term, intensity):
         """
-        create AnnotationNode objects for term and all of
+        add a node for term and all of
         terms ancestors
 
         :param term: observed term
@@ -58,48 +87,145 @@ class AnnotationHierarchy:
         self._add_node(term, intensity)
 
         # add node for ancestors
-        ancestors = self.db.get_ancestors(term)
-        for anc in ancestors:
+        if self.slim_db is not None:
             # if using GO and slimming down, only add ancestors in slim
-            if isinstance(self.db, GeneOntologyDb):
-                if self.db.slim_down and anc not in self.db.slim_members:
-                    continue
-            # self.expanded_sample_set.update({anc})
+            ancestors = self.slim_db.get_slim_ancestors(term)
+        else:
+            ancestors = self.db.get_ancestors(term)
+        for anc in ancestors:
             self._add_node(anc, intensity)
 
     def _add_node(self, term, intensity):
         """
-        create AnnotationNode for a given term observation
-        or add intensity to an existing Annotation Node
+        add a node for a given term observation
+        or add intensity to an existing node.
+        The first observation of a term counts as a peptide, later
+        observations only if their intensity is positive (see AnnotationNode.add_peptide())
 
         :param term: observed term
         :param intensity: intensity (numeric)
         :return: None
         """
-        if term not in self.nodes.keys():
-            # create new node
-            self.nodes[term] = anode.AnnotationNode(term, intensity)
-        else:
-            # update existing node
-            self.nodes[term].add_peptide(intensity)
+        position = self.term_index.get(term)
+        if position is None:
+            position = len(self.term_list)
+            self.term_index[term] = position
+            self.term_list.append(term)
+        self._pending_positions.append(position)
+        self._pending_intensities.append(intensity)
+        if len(self._pending_positions) >= FLUSH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        """
+        add the buffered observations to the node arrays
+
+        :return: None
+        """
+        nterms = len(self.term_index)
+        if len(self.intensity) < nterms:
+            # the term index grows as terms are added, by this or other hierarchies
+            self.intensity = np.concatenate([self.intensity, np.zeros(nterms - len(self.intensity),
+                                                                      dtype=self.intensity.dtype)])
+            self.npeptide = np.concatenate([self.npeptide, np.zeros(nterms - len(self.npeptide),
+                                                                    dtype=self.npeptide.dtype)])
+        if not self._pending_positions:
+            return
+        positions = np.array(self._pending_positions, dtype=np.int64)
+        intensities = np.array(self._pending_intensities)
+        if self.intensity.dtype != intensities.dtype:
+            if not self.npeptide.any():
+                # the node arrays take the type of the first intensities
+                self.intensity = self.intensity.astype(intensities.dtype)
+            else:
+                self.intensity = self.intensity.astype(np.result_type(self.intensity, intensities))
+        # added one at a time, in order, so sums are the same as adding up each observation
+        np.add.at(self.intensity, positions, intensities)
+        # observations with positive intensity are peptides, and so is
+        # the first observation of a term that is new to the sample, whatever its intensity
+        is_peptide = intensities > 0
+        _, first_occurrence = np.unique(positions, return_index=True)
+        first_occurrence = first_occurrence[self.npeptide[positions[first_occurrence]] == 0]
+        is_peptide[first_occurrence] = True
+        np.add.at(self.npeptide, positions, is_peptide.astype(self.npeptide.dtype))
+        self._pending_positions = list()
+        self._pending_intensities = list()
+
+    def terms(self):
+        """
+        :return: list of the terms in this sample, in the order of the term index
+        """
+        self._flush()
+        return [self.term_list[i] for i in np.flatnonzero(self.npeptide)]
 
     def _define_sample_children(self):
         """
         After all Node creation has happened, this
-        defines the "sample children", or the children
+        counts the "sample children", or the children
         that each node has within the sample associated with
-        the AnnotationHierarchy
+        the AnnotationHierarchy. The children themselves are not kept;
+        see `get_sample_children()`.
 
         :return: None
         """
+        self._flush()
         # expanded sample set is all nodes
-        expanded_sample_set = self.nodes.keys()
+        expanded_sample_set = set(self.terms())
+        self.n_sample_children = np.zeros(len(self.npeptide), dtype=np.int32)
+        if self.is_ncbi:
+            # the NCBI tree is too large to list the children of each node,
+            # so the children are found from the lineages of the sample nodes
+            all_sample_children = unwrap_db(self.db).get_sample_children(expanded_sample_set)
+            for term, children in all_sample_children.items():
+                self.n_sample_children[self.term_index[term]] = len(children)
+        else:
+            for term in expanded_sample_set:
+                ref_children = self.db.get_children(term)
+                self.n_sample_children[self.term_index[term]] = len(ref_children.intersection(expanded_sample_set))
+
+    def get_sample_children(self, term):
+        """
+        list the children of a term within the sample
 
-        for term in self.nodes.keys():
-            node = self.nodes[term]
-            ref_children = self.db.get_children(term)
-            node.sample_children = ref_children.intersection(expanded_sample_set)
-            node.n_sample_children = len(node.sample_children)
+        :param term: a term in the sample
+        :return: set of children of term that are also in the sample
+        """
+        expanded_sample_set = set(self.terms())
+        if self.is_ncbi:
+            return unwrap_db(self.db).get_sample_children(expanded_sample_set)[term]
+        return set(self.db.get_children(term)).intersection(expanded_sample_set)
+
+    @property
+    def nodes(self):
+        """
+        the nodes of the sample, for inspection. The AnnotationNode objects are copies
+        of the node arrays at the time of the call
+
+        :return: dictionary of the form {term: AnnotationNode, ...}
+        """
+        self._flush()
+        nodes = dict()
+        for term in self.terms():
+            position = self.term_index[term]
+            node = anode.AnnotationNode(term, self.intensity[position])
+            node.npeptide = int(self.npeptide[position])
+            if self.n_sample_children is not None and position < len(self.n_sample_children):
+                node.n_sample_children = int(self.n_sample_children[position])
+            nodes[term] = node
+        return nodes
+
+    def to_columns(self):
+        """
+        Run after add_nodes_from_df. Collects the aggregated intensity, number of sample children,
+        and number of peptides of all terms into arrays, in the same order as the terms.
+
+        :return: tuple of (list of terms, intensity array, n_sample_children array, npeptide array)
+        """
+        self._flush()
+        positions = np.flatnonzero(self.npeptide)
+        terms = self.terms()
+        n_sample_children = self.n_sample_children[positions].astype(np.int64)
+        return terms, self.intensity[positions], n_sample_children, self.npeptide[positions].astype(np.int64)
 
     def to_dataframe(self):
         """
@@ -109,15 +235,8 @@ class AnnotationHierarchy:
 
         :return: pandas data.frame with a row for each term
         """
-        nodes = self.nodes
-        node_rows = [0]*len(nodes)
-        index = 0
-        for term, node in nodes.items():
-            samp_children_name = self.sample_name + '_n_samp_children'
-            n_peptide_name = self.sample_name + '_n_peptide'
-            node_rows[index] = pd.DataFrame({self.sample_name: node.intensity,
-                                             samp_children_name: node.n_sample_children,
-                                             n_peptide_name: node.npeptide}, index=[term])
-            index += 1
-        df = pd.concat(node_rows)
+        terms, intensity, n_sample_children, npeptide = self.to_columns()
+        colnames = [self.sample_name, self.sample_name + '_n_samp_children', self.sample_name + '_n_peptide']
+        df = pd.DataFrame(dict(zip(colnames, [intensity, n_sample_children, npeptide])), index=pd.Index(terms),
+                          columns=colnames)
         return df
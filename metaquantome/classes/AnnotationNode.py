@@ -1,8 +1,12 @@
 class AnnotationNode:
     """
     A single taxon or functional term and its associated intensity.
-    Also provides members for npeptide and n_sample_children
+    Also provides members for npeptide and n_sample_children.
+    AnnotationHierarchy keeps its nodes in arrays, and returns AnnotationNode objects as copies of them;
+    the children of a node within the sample are available from AnnotationHierarchy.get_sample_children()
     """
+    __slots__ = ('id', 'intensity', 'npeptide', 'n_sample_children')
+
     def __init__(self, id, intensity):
         """
         create AnnotationNode object
@@ -14,8 +18,7 @@ class AnnotationNode:
         self.intensity = intensity
         self.npeptide = 1
 
-        # the next two attributes are updated later in AnnotationHierarchy
-        self.sample_children = None
+        # updated later in AnnotationHierarchy
         self.n_sample_children = None
 
     def add_peptide(self, intensity):
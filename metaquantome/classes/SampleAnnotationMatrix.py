@@ -0,0 +1,262 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from metaquantome.databases.GeneOntologyDb import GeneOntologyDb
+from metaquantome.databases.NCBITaxonomyDb import NCBITaxonomyDb
+from metaquantome.databases.ClosureCache import ClosureCache, DEFAULT_CACHE_SIZE
+from metaquantome.util.utils import PEPTIDE_ROW_COLNAME
+from metaquantome.util import profiling
+
+
+class SampleAnnotationMatrix:
+    """
+    Alternative to `SampleAnnotations` that expands all samples at once.
+    A sparse term -> ancestor incidence matrix is built once for the distinct
+    terms in the data, and the aggregated intensities, number of peptides, and
+    number of sample children are computed for all samples with sparse
+    matrix products over the peptide x sample intensity matrix.
+    The results are identical to those of `SampleAnnotations`.
+
+    Peptides can also be added in chunks with `add_chunk()`, followed by `finalize()`.
+    Only the per-term sums are kept between chunks, so memory use depends
+    on the number of distinct terms rather than the number of peptides.
+    """
+    def __init__(self, db, cache_size=DEFAULT_CACHE_SIZE):
+        """
+        Initialize SampleAnnotationMatrix object
+
+        :param db: reference database - will be taxonomy, GO terms, etc.
+        :param cache_size: maximum number of terms in the ancestor and children caches,
+        which are shared by all chunks
+        """
+        self.db = db
+        self.closure_cache = ClosureCache(db, maxsize=cache_size)
+        # these are filled by add_chunk
+        self.terms = list()
+        self.term_index = dict()
+        self.sample_names = list()
+        self.intensity_sum = None
+        self.npeptide_sum = None
+        # these are filled by finalize
+        self.intensity = None
+        self.npeptide = None
+        self.n_sample_children = None
+
+    @profiling.timed('hierarchy')
+    def add_samples_from_df(self, df, annot_colname, samp_grps):
+        """
+        Expands all samples in the dataframe at once
+
+        :param df: Full dataframe, with one term per row. Missing values should be 0.
+        :param annot_colname: Annotation column name
+        :param samp_grps: SampleGroups object
+        :return: Nothing
+        """
+        self.add_chunk(df, annot_colname, samp_grps)
+        self.finalize()
+
+    @profiling.timed('hierarchy')
+    def add_chunk(self, df, annot_colname, samp_grps):
+        """
+        Expand a chunk of peptides and add the intensity and number of peptides
+        of each term (and its ancestors) to the running sums
+
+        :param df: dataframe with some of the peptides, with one term per row. Missing values should be 0.
+        :param annot_colname: Annotation column name
+        :param samp_grps: SampleGroups object
+        :return: Nothing
+        """
+        self._add_terms(df, np.arange(df.shape[0]), df[annot_colname].tolist(), samp_grps)
+
+    @profiling.timed('hierarchy')
+    def add_term_mapping(self, peptide_df, term_df, annot_colname, samp_grps):
+        """
+        Like add_chunk(), but with peptides that may have several terms. Rather than repeating the
+        intensities of each peptide for every term (as in utils.tidy_split()), each term refers to
+        the row position of its peptide (see utils.split_terms()).
+
+        :param peptide_df: dataframe with some of the peptides, with one peptide per row. Missing values should be 0.
+        :param term_df: dataframe with one term per row, and the row position of the term's peptide
+        within peptide_df in the utils.PEPTIDE_ROW_COLNAME column
+        :param annot_colname: Annotation column name in term_df
+        :param samp_grps: SampleGroups object
+        :return: Nothing
+        """
+        self._add_terms(peptide_df, term_df[PEPTIDE_ROW_COLNAME].values, term_df[annot_colname].tolist(),
+                        samp_grps)
+
+    def _add_terms(self, peptide_df, positions, row_terms, samp_grps):
+        """
+        Expand terms and add the intensity and number of peptides of each term (and its ancestors) to the running sums
+
+        :param peptide_df: dataframe with the intensities of the peptides
+        :param positions: row position within peptide_df of the peptide of each term
+        :param row_terms: list of terms
+        :param samp_grps: SampleGroups object
+        :return: Nothing
+        """
+        self.sample_names = samp_grps.all_intcols
+        if self.intensity_sum is None:
+            self.intensity_sum = np.zeros((0, len(self.sample_names)))
+            self.npeptide_sum = np.zeros((0, len(self.sample_names)))
+        if len(row_terms) == 0:
+            return
+        # ensure each taxID is an integer (gets converted to float a lot by pandas)
+        if isinstance(self.db, NCBITaxonomyDb):
+            row_terms = [int(term) for term in row_terms]
+        codes, distinct_terms = pd.factorize(np.array(row_terms, dtype=object))
+        distinct_terms = distinct_terms.tolist()
+
+        # peptide x distinct term and distinct term x expanded term incidence matrices.
+        # a peptide counts once for each of its terms
+        n_pep = peptide_df.shape[0]
+        pep_to_term = sparse.csr_matrix((np.ones(len(codes)), (positions, codes)),
+                                        shape=(n_pep, len(distinct_terms)))
+        term_to_anc, chunk_terms = self._build_ancestor_matrix(distinct_terms)
+
+        # expanded term x peptide. sorted indices keep the peptides in the original row order,
+        # so intensities are summed in the same order as in AnnotationHierarchy
+        anc_by_pep = (pep_to_term @ term_to_anc).T.tocsr()
+        anc_by_pep.sort_indices()
+
+        values = np.asarray(peptide_df[self.sample_names].values, dtype=np.float64)
+        intensity = anc_by_pep @ values
+        npeptide = anc_by_pep @ (values != 0).astype(np.float64)
+
+        # give terms seen for the first time a row, then add the chunk to the running sums
+        new_terms = [term for term in chunk_terms if term not in self.term_index]
+        if len(new_terms) > 0:
+            for term in new_terms:
+                self.term_index[term] = len(self.terms)
+                self.terms.append(term)
+            new_rows = np.zeros((len(new_terms), len(self.sample_names)))
+            self.intensity_sum = np.vstack([self.intensity_sum, new_rows])
+            self.npeptide_sum = np.vstack([self.npeptide_sum, new_rows])
+        rows = np.array([self.term_index[term] for term in chunk_terms], dtype=np.int64)
+        self.intensity_sum[rows] += intensity
+        self.npeptide_sum[rows] += npeptide
+
+    @profiling.timed('finalize')
+    def finalize(self):
+        """
+        Once all peptides have been added, count the sample children of each term
+        and set terms that are not observed in a sample to NaN
+
+        :return: Nothing
+        """
+        if self.intensity_sum is None:
+            self.intensity_sum = np.zeros((0, len(self.sample_names)))
+            self.npeptide_sum = np.zeros((0, len(self.sample_names)))
+        terms = self.terms
+        is_present = self.npeptide_sum > 0
+
+        # number of children of each term that are also present in the sample
+        children = self._build_children_matrix(terms)
+        n_sample_children = children @ is_present.astype(np.float64)
+
+        # only keep terms observed in at least one sample
+        keep = is_present.any(axis=1)
+        self.terms = [terms[i] for i in np.flatnonzero(keep)]
+        self.term_index = {term: i for i, term in enumerate(self.terms)}
+        is_present = is_present[keep]
+        self.intensity = np.where(is_present, self.intensity_sum[keep], np.nan)
+        self.npeptide = np.where(is_present, self.npeptide_sum[keep], np.nan)
+        self.n_sample_children = np.where(is_present, n_sample_children[keep], np.nan)
+        self.intensity_sum = self.intensity_sum[keep]
+        self.npeptide_sum = self.npeptide_sum[keep]
+
+    def _build_ancestor_matrix(self, distinct_terms):
+        """
+        Build a sparse incidence matrix from each distinct term to itself and
+        all of its ancestors.
+
+        :param distinct_terms: list of distinct observed terms
+        :return: tuple of the (distinct terms x expanded terms) matrix and the list of expanded terms
+        """
+        # expanded terms, in order of their columns, and the column of each
+        terms = list()
+        term_index = dict()
+        rows = list()
+        cols = list()
+        for i, term in enumerate(distinct_terms):
+            closure = [term] + list(self._get_ancestors(term))
+            for anc in closure:
+                if anc not in term_index:
+                    term_index[anc] = len(terms)
+                    terms.append(anc)
+                rows.append(i)
+                cols.append(term_index[anc])
+        matrix = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                   shape=(len(distinct_terms), len(terms)))
+        return matrix, terms
+
+    def _get_ancestors(self, term):
+        """
+        get the ancestors of a term that are added to the hierarchy.
+        If using GO and slimming down, only ancestors in the slim are kept
+
+        :param term: observed term
+        :return: set of ancestors
+        """
+        if isinstance(self.db, GeneOntologyDb) and self.db.slim_down:
+            return self.db.get_slim_ancestors(term)
+        return self.closure_cache.get_ancestors(term)
+
+    def _build_children_matrix(self, terms):
+        """
+        Build a sparse (term x term) matrix, where entry (i, j) is 1 if
+        term j is a child of term i in the reference database. Only
+        children within `terms` are included.
+
+        :param terms: list of expanded terms
+        :return: sparse matrix
+        """
+        term_index = {term: i for i, term in enumerate(terms)}
+        if isinstance(self.db, NCBITaxonomyDb):
+            # children within terms, from the lineages of terms (see NCBITaxonomyDb.get_sample_children)
+            children = self.db.get_sample_children(terms)
+        else:
+            children = {term: self.closure_cache.get_children(term) for term in terms}
+        rows = list()
+        cols = list()
+        for i, term in enumerate(terms):
+            for child in children[term]:
+                j = term_index.get(child)
+                if j is not None:
+                    rows.append(i)
+                    cols.append(j)
+        return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                 shape=(len(terms), len(terms)))
+
+    @profiling.timed('to_dataframe')
+    def to_dataframe(self):
+        """
+        Create a dataframe with the aggregated intensity, number of sample children,
+        and the number of peptides for each term and sample.
+        Terms not observed in a sample are NaN, as in `SampleAnnotations.to_dataframe()`
+
+        :return: dataframe with a row for each term
+        """
+        columns = dict()
+        colnames = list()
+        for i, samp in enumerate(self.sample_names):
+            columns[samp] = self.intensity[:, i]
+            columns[samp + '_n_samp_children'] = self._as_counts(self.n_sample_children[:, i])
+            columns[samp + '_n_peptide'] = self._as_counts(self.npeptide[:, i])
+            colnames.extend([samp, samp + '_n_samp_children', samp + '_n_peptide'])
+        full_df = pd.DataFrame(columns, index=pd.Index(self.terms), columns=colnames)
+        return full_df.sort_index()
+
+    @staticmethod
+    def _as_counts(values):
+        """
+        counts are integers, unless there are missing values (as in `SampleAnnotations.to_dataframe()`)
+
+        :param values: numpy array of counts
+        :return: integer array if there are no missing values, otherwise the original array
+        """
+        if np.isnan(values).any():
+            return values
+        else:
+            return values.astype(np.int64)
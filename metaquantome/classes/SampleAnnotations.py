@@ -1,6 +1,16 @@
+import logging
+import multiprocessing
+import numpy as np
 import pandas as pd
 
 from metaquantome.classes.AnnotationHierarchy import AnnotationHierarchy
+from metaquantome.databases.ClosureCache import ClosureCache, DEFAULT_CACHE_SIZE, unwrap_db
+from metaquantome.databases.NCBITaxonomyDb import NCBITaxonomyDb
+from metaquantome.util import profiling
+
+# database and dataframe used by the worker processes. set before the pool is forked,
+# so they are shared with the workers rather than pickled
+_pool_state = None
 
 
 class SampleAnnotations:
@@ -8,16 +18,30 @@ class SampleAnnotations:
     Builds annotation hierarchy for each sample by
     calling `AnnotationHierarchy`
     """
-    def __init__(self, db):
+    def __init__(self, db, cache_size=DEFAULT_CACHE_SIZE, workers=1):
         """
         Initialize SampleAnnotations object
 
         :param db: reference database - will be taxonomy, GO terms, etc.
+        :param cache_size: maximum number of terms in the ancestor and children caches,
+        which are shared by the hierarchies of all samples
+        :param workers: number of processes used to build the sample hierarchies. If greater than 1,
+        the hierarchies are built in a pool of forked processes, which share the loaded database.
         """
         self.db = db
-        # this is filled later in add_samples_from_df
+        self.closure_cache = ClosureCache(db, maxsize=cache_size)
+        self.workers = workers
+        # these are filled later in add_samples_from_df
         self.hierarchies = set()
+        self.sample_names = list()
+        # columns of each sample (see AnnotationHierarchy.to_columns()), if built by worker processes
+        self.sample_columns = None
+        # term index shared by the sample hierarchies, so that the nodes of a term in each sample
+        # are stored at the same array position, and the terms in the order of their positions
+        self.term_index = dict()
+        self.term_list = list()
 
+    @profiling.timed('hierarchy')
     def add_samples_from_df(self, df, annot_colname, samp_grps):
         """
         Adds a sample for each intensity row in the dataframe
@@ -28,17 +52,52 @@ class SampleAnnotations:
         :return: Nothing
         """
         all_intcols = samp_grps.all_intcols
+        self.sample_names = list(all_intcols)
+        if self.workers > 1 and len(all_intcols) > 1:
+            self.sample_columns = self._expand_in_pool(df, annot_colname, all_intcols)
+            if self.sample_columns is not None:
+                return
         hierarchies = set()
         for samp in all_intcols:
             filt = self.filter_to_samp_observed(df, samp)
             sample_set = self.create_sample_set(filt, annot_colname)
             # create hierarchy for this sample
-            hier = AnnotationHierarchy(self.db, sample_set, samp)
+            hier = AnnotationHierarchy(self.closure_cache, sample_set, samp, term_index=self.term_index,
+                                       term_list=self.term_list)
             # add node for each row in df
             hier.add_nodes_from_df(filt, annot_colname, samp)
             # add to set
             hierarchies.update({hier})
         self.hierarchies = hierarchies
+        for lookup, info in self.closure_cache.cache_info().items():
+            logging.info('Closure cache (' + lookup + '): ' + str(info['hits']) + ' hits, ' +
+                         str(info['misses']) + ' misses')
+
+    def _expand_in_pool(self, df, annot_colname, all_intcols):
+        """
+        Build the hierarchy of each sample in a pool of worker processes.
+        The workers are forked, so the database and dataframe are shared rather than copied,
+        and the columns of each sample are returned in the order of all_intcols.
+
+        :param df: Full dataframe
+        :param annot_colname: Annotation column name
+        :param all_intcols: list of sample names
+        :return: list of sample columns (see AnnotationHierarchy.to_columns()), or None if
+        processes cannot be forked on this platform
+        """
+        global _pool_state
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            logging.info('Worker processes require fork, which is not available. Expanding samples serially.')
+            return None
+        processes = min(self.workers, len(all_intcols))
+        logging.info('Expanding ' + str(len(all_intcols)) + ' samples with ' + str(processes) + ' processes')
+        _pool_state = (self.closure_cache, df, annot_colname, self.term_index, self.term_list)
+        try:
+            with multiprocessing.get_context('fork').Pool(processes=processes, initializer=_init_worker) as pool:
+                sample_columns = pool.map(_expand_sample, all_intcols)
+        finally:
+            _pool_state = None
+        return sample_columns
 
     @staticmethod
     def create_sample_set(df_filt, annot_colname):
@@ -66,20 +125,78 @@ class SampleAnnotations:
         filt = df.loc[df[samp] != 0]
         return filt
 
+    @profiling.timed('to_dataframe')
     def to_dataframe(self):
         """
-        convert each hierarchy to dataframe and concatenate.
-        fills NAs with 0s, for adding up
-        :return: concatenated dataframe, missing values are 0
+        collect the columns of each hierarchy into a single dataframe, in the order of the samples.
+        The rows are the sorted union of the terms of all samples, and each sample's arrays
+        are placed at the positions of its terms in that shared index.
+        Terms not observed in a sample are NaN (and the sample's count columns are then floats).
+
+        :return: dataframe with a row for each term
         """
-        n_hier = len(self.hierarchies)
-        loc_hier = self.hierarchies.copy()
-        hierarchy_dfs = list()
-        for i in range(n_hier):
-            h = loc_hier.pop()
-            dh = h.to_dataframe()
-            hierarchy_dfs.append(dh)
-        full_df = pd.concat(hierarchy_dfs, axis=1, sort=True)
-        # stats expects 0's, not NaNs
-        full_df.fillna(0)
+        if self.sample_columns is not None:
+            sample_names = self.sample_names
+            sample_columns = self.sample_columns
+        else:
+            sample_order = {samp: i for i, samp in enumerate(self.sample_names)}
+            hierarchies = sorted(self.hierarchies, key=lambda h: sample_order.get(h.sample_name, len(sample_order)))
+            sample_names = [h.sample_name for h in hierarchies]
+            sample_columns = [h.to_columns() for h in hierarchies]
+        all_terms = pd.Index(sorted(set().union(*[terms for terms, *values in sample_columns])))
+        columns = dict()
+        colnames = list()
+        for samp, (terms, intensity, n_sample_children, npeptide) in zip(sample_names, sample_columns):
+            positions = all_terms.get_indexer(terms)
+            columns[samp] = self._align(intensity, positions, len(all_terms))
+            columns[samp + '_n_samp_children'] = self._align(n_sample_children, positions, len(all_terms))
+            columns[samp + '_n_peptide'] = self._align(npeptide, positions, len(all_terms))
+            colnames.extend([samp, samp + '_n_samp_children', samp + '_n_peptide'])
+        full_df = pd.DataFrame(columns, index=all_terms, columns=colnames)
         return full_df
+
+    @staticmethod
+    def _align(values, positions, nterms):
+        """
+        place the values of a sample at their positions in the shared term index
+
+        :param values: numpy array with a value for each term of the sample
+        :param positions: positions of the sample's terms in the shared index
+        :param nterms: length of the shared index
+        :return: numpy array of length nterms. Keeps the dtype of values if every term is present,
+        otherwise is a float array with NaN for the missing terms
+        """
+        if len(values) == nterms:
+            aligned = np.empty(nterms, dtype=values.dtype)
+        else:
+            aligned = np.full(nterms, np.nan)
+        aligned[positions] = values
+        return aligned
+
+
+def _init_worker():
+    """
+    Runs once in each worker process. The sqlite connection of the NCBI database
+    is not safe to use after a fork, so a new one is opened.
+
+    :return: None
+    """
+    closure_cache = _pool_state[0]
+    ref_db = unwrap_db(closure_cache)
+    if isinstance(ref_db, NCBITaxonomyDb):
+        ref_db.reconnect()
+
+
+def _expand_sample(samp):
+    """
+    Build the hierarchy of a single sample in a worker process
+
+    :param samp: sample name
+    :return: columns of the sample hierarchy (see AnnotationHierarchy.to_columns())
+    """
+    closure_cache, df, annot_colname, term_index, term_list = _pool_state
+    filt = SampleAnnotations.filter_to_samp_observed(df, samp)
+    sample_set = SampleAnnotations.create_sample_set(filt, annot_colname)
+    hier = AnnotationHierarchy(closure_cache, sample_set, samp, term_index=term_index, term_list=term_list)
+    hier.add_nodes_from_df(filt, annot_colname, samp)
+    return hier.to_columns()
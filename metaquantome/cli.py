@@ -7,11 +7,11 @@ import pkg_resources
 # add metaquantome parent directory to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from metaquantome.modules.expand import expand
-from metaquantome.modules.filter import run_filter
-from metaquantome.modules.stat import stat
+from metaquantome.modules.jobs import SOCKET_ENV, load_job
+from metaquantome.databases.ReferenceDatabases import PRELOAD_NAMES
 from metaquantome.modules.run_viz import run_viz
 from metaquantome.modules.db_download_handler import db_download_handler
+from metaquantome.util import profiling
 
 
 def cli():
@@ -23,22 +23,39 @@ def cli():
     # initialize logger
     logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
     args = parse_args_cli()
+    # profiling options of the expand, filter, stat, and run commands
+    profile_args = dict(profile=getattr(args, 'profile', False), profile_json=getattr(args, 'profile_json', None),
+                        profile_stats=getattr(args, 'profile_stats', None))
     if args.command == "db":
-        db_download_handler(args.dbs, args.dir, args.update)
+        db_download_handler(args.dbs, args.dir, args.update, args.closure_index, args.ncbi_snapshot)
     elif args.command == "expand":
-        expand(mode=args.mode, sinfo=args.samps, int_file=args.int_file, pep_colname_int=args.pep_colname_int,
-               pep_colname_func=args.pep_colname_func, pep_colname_tax=args.pep_colname_tax, data_dir=args.data_dir,
-               outfile=args.outfile, func_file=args.func_file, func_colname=args.func_colname, ontology=args.ontology,
-               slim_down=args.slim_down, tax_file=args.tax_file, tax_colname=args.tax_colname, nopep=args.nopep,
-               nopep_file=args.nopep_file, ft_tar_rank=args.ft_tar_rank)
+        # a single rank gives a single table
+        ft_tar_rank = args.ft_tar_rank[0] if len(args.ft_tar_rank) == 1 else args.ft_tar_rank
+        run_job('expand', mode=args.mode, sinfo=args.samps, int_file=args.int_file,
+                pep_colname_int=args.pep_colname_int, pep_colname_func=args.pep_colname_func,
+                pep_colname_tax=args.pep_colname_tax, data_dir=args.data_dir, outfile=args.outfile,
+                func_file=args.func_file, func_colname=args.func_colname, ontology=args.ontology,
+                slim_down=args.slim_down, tax_file=args.tax_file, tax_colname=args.tax_colname, nopep=args.nopep,
+                nopep_file=args.nopep_file, ft_tar_rank=ft_tar_rank, engine=args.engine,
+                chunksize=args.chunksize, workers=args.workers, **profile_args)
     elif args.command == "filter":
-        run_filter(expanded_file=args.expand_file, sinfo=args.samps, ontology=args.ontology, mode=args.mode,
-                   qthreshold=args.qthreshold, min_child_non_leaf=args.min_children_non_leaf,
-                   min_child_nsamp=args.min_child_nsamp, min_peptides=args.min_peptides,
-                   min_pep_nsamp=args.min_pep_nsamp, outfile=args.outfile)
+        if args.sweep:
+            run_job('filter_sweep', expanded_file=args.expand_file, sinfo=args.samps, ontology=args.ontology,
+                    mode=args.mode, settings=args.sweep, outfile=args.outfile, **profile_args)
+        else:
+            run_job('filter', expanded_file=args.expand_file, sinfo=args.samps, ontology=args.ontology,
+                    mode=args.mode, qthreshold=args.qthreshold, min_child_non_leaf=args.min_children_non_leaf,
+                    min_child_nsamp=args.min_child_nsamp, min_peptides=args.min_peptides,
+                    min_pep_nsamp=args.min_pep_nsamp, outfile=args.outfile, **profile_args)
     elif args.command == "stat":
-        stat(infile=args.file, sinfo=args.samps, paired=args.paired, parametric=args.parametric, ontology=args.ontology,
-             mode=args.mode, outfile=args.outfile, control_group=args.control_group)
+        run_job('stat', infile=args.file, sinfo=args.samps, paired=args.paired, parametric=args.parametric,
+                ontology=args.ontology, mode=args.mode, outfile=args.outfile, control_group=args.control_group,
+                workers=args.workers, **profile_args)
+    elif args.command == "run":
+        run_job('run', config=args.config, **profile_args)
+    elif args.command == "serve":
+        from metaquantome.modules.server import serve
+        serve(args.socket, data_dir=args.data_dir, preload=args.preload)
     elif args.command == "viz":
         run_viz(plottype=args.plottype,
                 img=args.img,
@@ -68,10 +85,37 @@ def cli():
                 feature_cluster_size=args.feature_cluster_size,
                 sample_cluster_size=args.sample_cluster_size)
     else:
-        ValueError('incorrect mode. please provide one of "db", "expand", "filter", "stat", or "viz".')
+        ValueError('incorrect mode. please provide one of "db", "expand", "filter", "stat", "run", "serve", or "viz".')
     sys.exit(0)
 
 
+def run_job(command, profile=False, profile_json=None, profile_stats=None, **kwargs):
+    """
+    Run an expand, filter, stat, or run job. If the METAQUANTOME_SOCKET environment variable is set,
+    the job is sent to the server listening on that socket (see `metaquantome serve`), which has the
+    reference databases already loaded. Otherwise, the job is run in this process.
+
+    :param command: name of the job, see metaquantome.modules.jobs.JOBS
+    :param profile: whether to log the wall time and peak memory of each stage of the job,
+    and counters of database lookups and cache hits. Only for jobs run in this process
+    :param profile_json: path to write the profile as JSON. Implies profile
+    :param profile_stats: path to write cProfile statistics. Implies profile
+    :param kwargs: keyword arguments of the job
+    :return: None
+    """
+    enabled = profile or bool(profile_json) or bool(profile_stats)
+    socket_path = os.environ.get(SOCKET_ENV)
+    if socket_path:
+        if enabled:
+            logging.warning('Profiling is not available for jobs run by the metaquantome server; ignoring.')
+        from metaquantome.modules.server import submit
+        submit(socket_path, command, kwargs)
+    else:
+        func = load_job(command)[0]
+        with profiling.profile_run(enabled=enabled, json_file=profile_json, stats_file=profile_stats):
+            func(**kwargs)
+
+
 def check_col_range(arg):
     try:
         value = int(arg)
@@ -95,7 +139,7 @@ def parse_args_cli():
             "For more background information, please read the associated manuscript: https://doi.org/10.1074/mcp.ra118.001240. "
             "For a more hands-on tutorial, please visit the following page: https://galaxyproteomics.github.io/metaquantome_mcp_analysis/cli_tutorial/cli_tutorial.html.\n\n"
             "The metaQuantome workflow is as follows: db → expand → filter → stat → viz.\n\n" 
-            "Run `metaquantome {db,expand,filter,stat,viz} -h` for more information on the individual modules. "
+            "Run `metaquantome {db,expand,filter,stat,run,serve,viz} -h` for more information on the individual modules. "
             "Any issues can be brought to attention here: https://github.com/galaxyproteomics/metaquantome/issues."
     )
     parser.add_argument('-v', '--version', action='version',
@@ -107,8 +151,8 @@ def parse_args_cli():
         formatter_class=argparse.RawTextHelpFormatter,
         description="metaQuantome uses freely available bioinformatic databases to expand your set of direct annotations. For most cases, all 3 databases can be downloaded (the default).\n"
                     "The databases are:\n"
-                    "1. NCBI taxonomy database. This contains a list of all currently identified taxa and the relationships between them.\n"
-                    "2. Gene Ontology (GO) term database. metaQuantome uses the OBO format of the database. Specifically, two files are used: the go-basic.obo file, which is a simplified version of the GO database that is guaranteed to be acyclic, and the metagenomics slim GO, which is a subset of the full GO that is useful for microbiome research. More details are available at http://geneontology.org/docs/download-ontology/\n"
+                    "1. NCBI taxonomy database. This contains a list of all currently identified taxa and the relationships between them. With --ncbi_snapshot, the database is also compiled to a binary snapshot in the data directory, which is loaded in milliseconds and answers lookups without querying the sqlite database.\n"
+                    "2. Gene Ontology (GO) term database. metaQuantome uses the OBO format of the database. Specifically, two files are used: the go-basic.obo file, which is a simplified version of the GO database that is guaranteed to be acyclic, and the metagenomics slim GO, which is a subset of the full GO that is useful for microbiome research. More details are available at http://geneontology.org/docs/download-ontology/. Both files are also compiled to a binary snapshot in the data directory, which is much faster to load than the OBO files. The map from full GO terms to the slim is written to the data directory the first time --slim_down is used.\n"
                     "3. ENZYME database with Enzyme Classification (EC) numbers. This database classifies enzymes and organizes the relationships between them.\n"
                     "This module downloads the most recent releases of the specified databases and stores them in a single file, which can then be accessed by the rest of the metaQuantome modules. For reference, the taxonomy database is the largest (~500 Mb), while the GO and EC databases are smaller: ~34 Mb and ~10Mb, respectively."
                     )
@@ -146,6 +190,22 @@ def parse_args_cli():
         description="The stat module is the third step in the metaQuantome analysis workflow."
                     " The purpose of the stat module is to perform differential expression analysis between 2 experimental conditions."
                     " metaQuantome offers paired and unpaired tests, as well as parametric and non-parametric options.")
+    parser_run = subparsers.add_parser('run',
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="The run module runs expand, and optionally filter and stat, in a single process."
+                    " The results of each step are passed directly to the next step instead of through files,"
+                    " so the reference databases are loaded and the expanded table is parsed only once."
+                    " Only the outputs of the steps with an outfile are written."
+                    " The wall time and peak memory of each step are always reported, as with --profile.")
+    parser_serve = subparsers.add_parser('serve',
+        formatter_class=argparse.RawTextHelpFormatter,
+        description="The serve module starts a long-running server that keeps the reference databases loaded,"
+                    " and runs expand, filter, stat, and run jobs sent to a Unix socket."
+                    " Each job runs in its own process, forked from the server, so jobs run concurrently"
+                    " and do not load the databases again.\n"
+                    "To send jobs to the server, set the environment variable " + SOCKET_ENV +
+                    " to the socket path. The metaquantome expand, filter, stat, and run commands are then"
+                    " run by the server, with the same arguments and outputs.")
     parser_viz = subparsers.add_parser('viz', 
         formatter_class=argparse.RawTextHelpFormatter, 
         description="The viz module is the final step in the metaQuantome analysis workflow."
@@ -161,6 +221,14 @@ def parse_args_cli():
                            help='data directory for files.')
     parser_db.add_argument('--update', '-u', action="store_true",
                            help='overwrite existing databases if present.')
+    parser_db.add_argument('--closure_index', action="store_true",
+                           help='also precompute the ancestors of every GO term and taxon and store them in an ' +
+                           'index within the data directory. When present and up to date, the index is memory mapped ' +
+                           'by the expand module, which makes ancestor lookups much faster.')
+    parser_db.add_argument('--ncbi_snapshot', action="store_true",
+                           help='also compile the NCBI database to a memory mapped snapshot within the data ' +
+                           'directory. When present and up to date, the snapshot is used in place of the ' +
+                           'sqlite database.')
 
     # samps file is required in all four non-db parsers
     for par in (parser_expand, parser_filter, parser_stat, parser_viz):
@@ -180,6 +248,19 @@ def parse_args_cli():
         common_tmp.add_argument('--data_dir',
                                 help="Path to data directory. The default is <metaquantome_pkg_dir>/data")
 
+    # profiling, for the modules that can be slow
+    for par in (parser_expand, parser_filter, parser_stat, parser_run):
+        prof_tmp = par.add_argument_group('Profiling')
+        prof_tmp.add_argument('--profile', action='store_true',
+                              help='Log the wall time and peak memory of each stage (reading, database loading, ' +
+                                   'hierarchy building, summarizing, writing, ...), and counters of database ' +
+                                   'lookups and cache hits. Not available for jobs run by metaquantome serve.')
+        prof_tmp.add_argument('--profile_json',
+                              help='Also write the profile to this file, as JSON. Implies --profile.')
+        prof_tmp.add_argument('--profile_stats',
+                              help='Also run the Python profiler and write its statistics to this file, ' +
+                                   'which can be read with the pstats module or snakeviz. Implies --profile.')
+
     # ---- METAQUANTOME EXPAND ---- #
     common = parser_expand.add_argument_group('Arguments for all 3 modes')
     common.add_argument('--nopep', action="store_true",
@@ -200,7 +281,22 @@ def parse_args_cli():
                         help='The column name within the taxonomy file that corresponds ' +
                              'to the peptide sequences. ')
     common.add_argument('--outfile', required=True,
-                        help='Output file')
+                        help='Output file. The output is tab-separated, unless the file name ends in ' +
+                             '.parquet, .feather, or .arrow, in which case it is written in that columnar format ' +
+                             '(requires pyarrow).')
+    common.add_argument('--engine', choices=['hierarchy', 'matrix'], default='hierarchy',
+                        help="Expansion engine for f and t modes. 'hierarchy' (the default) builds the hierarchy " +
+                             "sample by sample, while 'matrix' expands all samples at once using sparse matrix " +
+                             "products, which is much faster for large datasets. Both give the same results.")
+    common.add_argument('--chunksize', type=int, default=None,
+                        help="Read the intensity file (or nopep file) this many rows at a time, and add the " +
+                             "intensities of each chunk to running per-term sums, so that the whole table is " +
+                             "never held in memory. Use for intensity tables that are larger than memory. " +
+                             "Chunks are always expanded with the 'matrix' engine.")
+    common.add_argument('--workers', type=int, default=1,
+                        help="Number of processes used to build the sample hierarchies with the 'hierarchy' " +
+                             "engine. Each process builds the hierarchies of some of the samples, using the " +
+                             "database loaded by the main process. Default is 1 (no extra processes).")
 
     # function-specific
     func = parser_expand.add_argument_group('Function')
@@ -229,8 +325,11 @@ def parse_args_cli():
 
     # function-taxonomy
     ft = parser_expand.add_argument_group('Function-Taxonomy')
-    ft.add_argument('--ft_tar_rank', default='genus',
-                    help="Desired rank for taxonomy. The default is 'genus'.")
+    ft.add_argument('--ft_tar_rank', nargs='+', default=['genus'],
+                    help="Desired rank for taxonomy. The default is 'genus'. If several ranks are given, " +
+                         "the peptides are read, cleaned, and mapped to all of them in one pass, and a table is " +
+                         "written for each rank, with the rank added to the name of the outfile " +
+                         "(e.g., out_genus.tab and out_phylum.tab for --outfile out.tab).")
 
     # ---- METAQUANTOME FILTER ---- #
     parser_filter.add_argument('--expand_file',
@@ -258,14 +357,52 @@ def parse_args_cli():
                                     'will be filtered out. The default is 3, because this is the minimum ' +
                                     'number for t-tests.')
     parser_filter.add_argument('--outfile', required=True,
-                               help="Output file")
+                               help='Output file. The output is tab-separated, unless the file name ends in ' +
+                                    '.parquet, .feather, or .arrow, in which case it is written in that columnar format ' +
+                                    '(requires pyarrow).')
+    parser_filter.add_argument('--sweep',
+                               help="Evaluate several filtering configurations on the same expanded file. " +
+                                    "Either a JSON-formatted string or a path to a JSON file, with a list of " +
+                                    "configurations like " +
+                                    "'[{\"qthreshold\": 3, \"min_child_non_leaf\": 0, \"min_child_nsamp\": \"all\", " +
+                                    "\"min_peptides\": 0, \"min_pep_nsamp\": \"all\"}, ...]'. " +
+                                    "The other filtering arguments are ignored, and the result of the i-th " +
+                                    "configuration is written to the outfile name with '_i' added before the extension.")
+
+    # ---- METAQUANTOME RUN ---- #
+    parser_run.add_argument('--config', required=True,
+                            help='Pipeline configuration. Either a JSON-formatted string or a path to a JSON file. ' +
+                                 'The keys "samps", "mode", "ontology", and "data_dir" are shared by all steps, ' +
+                                 'and the arguments of each step are given under "expand" (required), "filter", ' +
+                                 'and "stat", using the names of the command line options without the dashes ' +
+                                 '(except min_child_non_leaf, which is --min_children_non_leaf for filter). ' +
+                                 'Example: {"samps": {"A": ["A1", "A2"], "B": ["B1", "B2"]}, "mode": "t", ' +
+                                 '"expand": {"int_file": "int.tab", "pep_colname_int": "peptide", ' +
+                                 '"pep_colname_func": "peptide", "pep_colname_tax": "peptide", ' +
+                                 '"tax_file": "tax.tab", "tax_colname": "lca"}, ' +
+                                 '"filter": {"qthreshold": 2, "min_child_non_leaf": 0, "min_child_nsamp": 0, ' +
+                                 '"min_peptides": 0, "min_pep_nsamp": 0}, ' +
+                                 '"stat": {"control_group": "B", "paired": false, "parametric": true, ' +
+                                 '"outfile": "stat.tab"}}')
+
+    # ---- METAQUANTOME SERVE ---- #
+    parser_serve.add_argument('--socket', required=True,
+                              help='Path of the Unix socket to listen on.')
+    parser_serve.add_argument('--data_dir',
+                              help="Path to data directory of the preloaded databases. " +
+                                   "The default is <metaquantome_pkg_dir>/data")
+    parser_serve.add_argument('--preload', nargs='*', choices=PRELOAD_NAMES, default=PRELOAD_NAMES,
+                              help='Databases to load when the server starts. goslim is GO with the ' +
+                                   'metagenomics slim (for --slim_down). The default is all of them.')
 
     # ---- METAQUANTOME STAT ---- #
     # statistics
     parser_stat.add_argument('--file', '-f', required=True,
                              help='Output file from metaquantome expand.')
     parser_stat.add_argument('--outfile', required=True,
-                             help='Output file')
+                             help='Output file. The output is tab-separated, unless the file name ends in ' +
+                                  '.parquet, .feather, or .arrow, in which case it is written in that columnar format ' +
+                                  '(requires pyarrow).')
     parser_stat.add_argument('--parametric', type=bool, default=False,
                              help='Choose the type of test. If --parametric True is provided,' +
                                   'then a standard t-test is performed. ' +
@@ -275,6 +412,9 @@ def parse_args_cli():
                              help='Perform paired tests.')
     parser_stat.add_argument('--control_group', required=True,
                              help='Sample group name of control samples (will be used as denominator for fold change).')
+    parser_stat.add_argument('--workers', type=int, default=1,
+                             help='Number of threads used to test the case groups against the control group ' +
+                                  'in parallel. Default is 1.')
     
     # ---- METAQUANTOME VIZ ---- #
     parser_viz.add_argument('--plottype', '-p', required=True, choices=['bar', 'volcano', 'heatmap', 'pca', 'ft_dist', 'stacked_bar'],
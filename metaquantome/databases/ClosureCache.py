@@ -0,0 +1,121 @@
+from collections import OrderedDict
+
+from metaquantome.util import profiling
+
+# default maximum number of terms held for each type of lookup
+DEFAULT_CACHE_SIZE = 100000
+
+
+class ClosureCache:
+    """
+    A bounded least-recently-used cache around one of the reference databases
+    (GeneOntologyDb, EnzymeDb, or NCBITaxonomyDb). The results of `get_ancestors()`
+    and `get_children()` are memoized, so that each closure is computed once
+    and then shared between all samples.
+    All other attributes and methods are passed through to the wrapped database.
+    """
+    # the database lookups that are cached
+    LOOKUPS = ['ancestors', 'children']
+
+    def __init__(self, db, maxsize=DEFAULT_CACHE_SIZE):
+        """
+        Create ClosureCache object
+
+        :param db: reference database to wrap
+        :param maxsize: maximum number of terms cached for each lookup. If None, the cache is unbounded.
+        """
+        self.db = db
+        self.maxsize = maxsize
+        self.caches = {lookup: OrderedDict() for lookup in self.LOOKUPS}
+        self.hits = {lookup: 0 for lookup in self.LOOKUPS}
+        self.misses = {lookup: 0 for lookup in self.LOOKUPS}
+
+    def __getattr__(self, name):
+        """
+        pass any other attribute lookups (is_in_db, slim_down, gofull, etc.)
+        through to the wrapped database
+
+        :param name: attribute name
+        :return: attribute of the wrapped database
+        """
+        # avoid infinite recursion if db has not been set yet (e.g., while unpickling)
+        if name == 'db':
+            raise AttributeError(name)
+        return getattr(self.db, name)
+
+    def get_ancestors(self, term):
+        """
+        Get all ancestors of a term, using the cached closure if available
+
+        :param term: query term
+        :return: frozenset of ancestors
+        """
+        return self._lookup('ancestors', self.db.get_ancestors, term)
+
+    def get_children(self, term):
+        """
+        Get the immediate children of a term, using the cached closure if available
+
+        :param term: query term
+        :return: frozenset of children
+        """
+        return self._lookup('children', self.db.get_children, term)
+
+    def _lookup(self, lookup, func, term):
+        """
+        Return the cached result for term, or compute and cache it.
+        The least recently used term is dropped once the cache is full.
+        Results are stored as frozensets so that callers cannot modify the cached copy.
+
+        :param lookup: name of the lookup, one of LOOKUPS
+        :param func: database method to call on a cache miss
+        :param term: query term
+        :return: frozenset with the result of func(term)
+        """
+        cache = self.caches[lookup]
+        if term in cache:
+            self.hits[lookup] += 1
+            profiling.count(lookup + ' cache hits')
+            cache.move_to_end(term)
+            return cache[term]
+        self.misses[lookup] += 1
+        profiling.count(lookup + ' cache misses')
+        result = frozenset(func(term))
+        cache[term] = result
+        if self.maxsize is not None and len(cache) > self.maxsize:
+            cache.popitem(last=False)
+        return result
+
+    def cache_info(self):
+        """
+        Summarize how much work the cache has saved
+
+        :return: dictionary of the form {lookup: {'hits': int, 'misses': int, 'size': int}, ...}
+        """
+        return {lookup: {'hits': self.hits[lookup],
+                         'misses': self.misses[lookup],
+                         'size': len(self.caches[lookup])}
+                for lookup in self.LOOKUPS}
+
+    def clear(self):
+        """
+        Empty the cache and reset the counters
+
+        :return: None
+        """
+        for lookup in self.LOOKUPS:
+            self.caches[lookup].clear()
+            self.hits[lookup] = 0
+            self.misses[lookup] = 0
+
+
+def unwrap_db(db):
+    """
+    Get the underlying reference database, whether or not it is wrapped in a ClosureCache
+
+    :param db: reference database or ClosureCache
+    :return: reference database
+    """
+    if isinstance(db, ClosureCache):
+        return db.db
+    return db
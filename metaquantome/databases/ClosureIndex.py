@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import shutil
+import numpy as np
+
+# bump this if the layout of the index files changes
+INDEX_VERSION = 1
+
+
+def stamp_files(source_paths):
+    """
+    size and modification time of each source file, used to detect a stale index or snapshot
+
+    :param source_paths: list of paths to the raw database files
+    :return: list of [basename, size, mtime] lists
+    """
+    stamps = list()
+    for path in source_paths:
+        stat = os.stat(path)
+        stamps.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+    return stamps
+
+
+class ClosureIndex:
+    """
+    A precomputed, on-disk index of the ancestors of every term in a reference database.
+    The index lives in a directory within data_dir, <data_dir>/<name>_closure, and consists of:
+
+    - terms.npy: sorted array of all term ids
+    - offsets.npy: CSR offsets, so that the ancestors of terms[i] are ancestors[offsets[i]:offsets[i+1]]
+    - ancestors.npy: integer-encoded ancestors (positions within terms.npy)
+    - meta.npy: integer code of the per-term metadata (e.g., NCBI rank or GO namespace)
+    - index.json: metadata categories, and the size and modification time of the source database files
+
+    The arrays are memory mapped when loaded, so opening the index is nearly free
+    and looking up ancestors is a binary search followed by an array slice.
+    """
+    def __init__(self, index_dir):
+        """
+        Load (memory map) a previously built closure index
+
+        :param index_dir: directory containing the index files
+        """
+        with open(os.path.join(index_dir, 'index.json'), 'r') as f:
+            info = json.load(f)
+        self.categories = info['categories']
+        self.terms = np.load(os.path.join(index_dir, 'terms.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(index_dir, 'offsets.npy'), mmap_mode='r')
+        self.ancestors = np.load(os.path.join(index_dir, 'ancestors.npy'), mmap_mode='r')
+        self.meta = np.load(os.path.join(index_dir, 'meta.npy'), mmap_mode='r')
+
+    @staticmethod
+    def define_index_dir(data_dir, name):
+        """
+        define the directory that holds the closure index for a database
+
+        :param data_dir: data directory
+        :param name: short name of the database ('go', 'ec', or 'ncbi')
+        :return: path to index directory
+        """
+        return os.path.join(data_dir, name + '_closure')
+
+    @staticmethod
+    def write(data_dir, name, closures, metadata, source_paths):
+        """
+        Write a closure index to <data_dir>/<name>_closure
+
+        :param data_dir: data directory
+        :param name: short name of the database ('go', 'ec', or 'ncbi')
+        :param closures: dictionary of the form {term: set of ancestors, ...}.
+        Every ancestor must also be a key.
+        :param metadata: dictionary of the form {term: string, ...}, such as the rank or namespace of each term
+        :param source_paths: list of paths to the raw database files that the index was built from
+        :return: None
+        """
+        index_dir = ClosureIndex.define_index_dir(data_dir, name)
+        tmp_dir = index_dir + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        # terms are sorted so they can be found with a binary search
+        terms = np.array(sorted(closures.keys()))
+        position = {term: i for i, term in enumerate(terms.tolist())}
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        ancestors = list()
+        for i, term in enumerate(terms.tolist()):
+            anc_pos = sorted(position[anc] for anc in closures[term])
+            ancestors.extend(anc_pos)
+            offsets[i + 1] = len(ancestors)
+        categories = sorted(set(metadata.values()))
+        cat_codes = {cat: i for i, cat in enumerate(categories)}
+        meta = np.array([cat_codes[metadata[term]] for term in terms.tolist()], dtype=np.int16)
+
+        np.save(os.path.join(tmp_dir, 'terms.npy'), terms)
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+        np.save(os.path.join(tmp_dir, 'ancestors.npy'), np.array(ancestors, dtype=np.int32))
+        np.save(os.path.join(tmp_dir, 'meta.npy'), meta)
+        with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+            json.dump({'version': INDEX_VERSION,
+                       'categories': categories,
+                       'sources': stamp_files(source_paths)}, f)
+
+        # swap in the finished index, so a partially written index is never loaded
+        if os.path.exists(index_dir):
+            shutil.rmtree(index_dir)
+        os.rename(tmp_dir, index_dir)
+        logging.info('Wrote closure index for ' + str(len(terms)) + ' terms to ' + index_dir)
+
+    @staticmethod
+    def load(data_dir, name, source_paths):
+        """
+        Load the closure index for a database, if it exists and is up to date
+        with the source database files.
+
+        :param data_dir: data directory
+        :param name: short name of the database ('go', 'ec', or 'ncbi')
+        :param source_paths: list of paths to the raw database files
+        :return: ClosureIndex object, or None if there is no usable index
+        """
+        index_dir = ClosureIndex.define_index_dir(data_dir, name)
+        info_path = os.path.join(index_dir, 'index.json')
+        if not os.path.exists(info_path):
+            return None
+        with open(info_path, 'r') as f:
+            info = json.load(f)
+        if not all(os.path.exists(path) for path in source_paths):
+            return None
+        if info.get('version') != INDEX_VERSION or info.get('sources') != stamp_files(source_paths):
+            logging.info('Closure index in ' + index_dir + ' is out of date and will not be used. ' +
+                         'Rebuild it with >metaquantome db ... --closure_index')
+            return None
+        return ClosureIndex(index_dir)
+
+    def _position(self, term):
+        """
+        find the position of a term within the index
+
+        :param term: query term
+        :return: integer position, or None if the term is not in the index
+        """
+        try:
+            i = int(np.searchsorted(self.terms, term))
+        except TypeError:
+            # term of a different type than the index (e.g., a string in an integer index)
+            return None
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+        return None
+
+    def __contains__(self, term):
+        return self._position(term) is not None
+
+    def get_ancestors(self, term):
+        """
+        Get all ancestors of a term
+
+        :param term: query term
+        :return: set of ancestors, or None if the term is not in the index
+        """
+        i = self._position(term)
+        if i is None:
+            return None
+        anc_pos = self.ancestors[self.offsets[i]:self.offsets[i + 1]]
+        return set(self.terms[anc_pos].tolist())
+
+    def get_metadata(self, term):
+        """
+        Get the metadata (e.g., rank or namespace) of a term
+
+        :param term: query term
+        :return: metadata string, or None if the term is not in the index
+        """
+        i = self._position(term)
+        if i is None:
+            return None
+        return self.categories[self.meta[i]]
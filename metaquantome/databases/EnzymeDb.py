@@ -23,6 +23,9 @@ class EnzymeDb:
         :param data_dir: directory in which the ENZYME files will go
         """
         self.ecdb = self.load_enzyme_db(data_dir)
+        # adjacency, ancestor, and prefix maps, so that lookups do not scan the whole database.
+        # the database is small, so these are built on every load rather than stored in a closure index
+        self.parent_map, self.child_map, self.ancestor_map, self.prefix_map = self._index_enzyme_db(self.ecdb)
 
     @staticmethod
     def _define_ec_paths(data_dir):
@@ -103,6 +106,44 @@ class EnzymeDb:
             annotated_db[k] = newv
         return annotated_db
 
+    @staticmethod
+    def _index_enzyme_db(annotated_db):
+        """
+        Build the maps used to answer parent, child, ancestor, and descendant queries.
+        The maps follow the same rules as scanning the database (see get_parents() and get_descendants()),
+        including for '-' placeholders and terms whose intermediate levels are not in the database.
+
+        :param annotated_db: annotated enzyme database, from _annotate_enzyme_db()
+        :return: tuple of dictionaries (parent_map, child_map, ancestor_map, prefix_map).
+        The first three have the form {ecid: set of ecids, ...}.
+        prefix_map has the form {(n, tuple of the first n levels): set of ecids, ...},
+        for n from 0 to 4
+        """
+        # terms grouped by depth and annotation up to (and including) that depth
+        groups = dict()
+        prefix_map = dict()
+        for ecid, annot in annotated_db.items():
+            key = (annot['depth'], tuple(annot['levels'][0:(annot['depth'] + 1)]))
+            groups.setdefault(key, set()).add(ecid)
+            for n in range(len(EnzymeDb.ALL_UNKNOWN) + 1):
+                prefix_map.setdefault((n, tuple(annot['levels'][0:n])), set()).add(ecid)
+
+        parent_map = dict()
+        child_map = {ecid: set() for ecid in annotated_db.keys()}
+        ancestor_map = dict()
+        # parents always have a smaller depth, so go from the most general to the most specific
+        for ecid, annot in sorted(annotated_db.items(), key=lambda item: item[1]['depth']):
+            child_depth = annot['depth']
+            # parents have the same annotation to child_depth - 1, and depth one less than the child
+            parents = groups.get((child_depth - 1, tuple(annot['levels'][0:child_depth])), set()) - {ecid}
+            parent_map[ecid] = parents
+            ancestors = set(parents)
+            for parent in parents:
+                child_map[parent].add(ecid)
+                ancestors.update(ancestor_map[parent])
+            ancestor_map[ecid] = ancestors
+        return parent_map, child_map, ancestor_map, prefix_map
+
     @staticmethod
     def _create_ec_num_enzyme_name_association_file(enzdat_file, ec_id_file):
         """
@@ -170,21 +211,12 @@ class EnzymeDb:
         :param ecid: ecid as string
         :return: set of children. If no children, returns empty set.
         """
-        parent = self.ecdb[ecid]
-        parent_levels = parent['levels']
-        parent_depth = parent['depth']
-
-        # get annotation at levels up to depth
-        annot_to_depth = parent_levels[0:(parent_depth+1)]
-
         # children are all terms that:
         #   - have same annotation at level 0 to parent_depth
         #   - are not the parent
         #   - have a depth that is one greater than the parent (i.e., immediate descendants)
-        children = {ec for ec, annot in self.ecdb.items() if
-                    annot['levels'][0:(parent_depth+1)] == annot_to_depth and
-                    annot['depth'] == parent_depth + 1 and
-                    ec != parent['id']}
+        # which are precomputed in _index_enzyme_db()
+        children = set(self.child_map[ecid])
         return children
 
     def get_descendants(self, ecid):
@@ -204,9 +236,7 @@ class EnzymeDb:
         # descendants are all terms that:
         #   - have same annotation from level 0 to level parent_depth
         #   - are not the parent
-        desc = {ec for ec, annot in self.ecdb.items() if
-                annot['levels'][0:(parent_depth+1)] == annot_to_depth and
-                ec != parent['id']}
+        desc = self.prefix_map[(parent_depth + 1, tuple(annot_to_depth))] - {ecid}
         return desc
 
     def get_parents(self, ecid):
@@ -216,19 +246,12 @@ class EnzymeDb:
         :param ecid: String of ecid in form 'w.x.y.z'
         :return: A set of all parents of the ecid. If no parents, returns empty set.
         """
-        child = self.ecdb[ecid]
-        child_levels = child['levels']
-        child_depth = child['depth']
-        # get annotation at levels up to depth - 1
-        annot_to_prev_depth = child_levels[0:child_depth]
         # parents are all terms that:
         #   - have same annotation at level 0 to child_depth minus 1
         #   - have depth (child_depth - 1)
         #   - are not the child
-        parents = {ec for ec, annot in self.ecdb.items() if
-                   annot['levels'][0:child_depth] == annot_to_prev_depth and
-                   annot['depth'] == child_depth - 1 and
-                   ec != child['id']}
+        # which are precomputed in _index_enzyme_db()
+        parents = set(self.parent_map[ecid])
         return parents
 
     def get_ancestors(self, ecid):
@@ -238,18 +261,8 @@ class EnzymeDb:
         :param ecid: String of ecid in form 'w.x.y.z'
         :return: A set of all ancestors of the ecid. If no ancestors, returns empty set.
         """
-        # ancestors are all terms that:
-        #   - have same annotation at child_depth
-        #   - have depth less than child_depth
-        #   - are not the child
-        # run get_parents for each parent and each grandparent, etc.
-        parents = self.get_parents(ecid)
-        ancestors = parents.copy()
-        while len(parents) > 0:
-            this_id = parents.pop()
-            this_parents = self.get_parents(this_id)
-            ancestors.update(this_parents)
-            parents.update(this_parents)
+        # ancestors are the parents, the parents of each parent, etc.
+        ancestors = set(self.ancestor_map[ecid])
         return ancestors
 
     def _assign_depth(self, ecid):
@@ -1,12 +1,19 @@
 from goatools import obo_parser
+from collections import deque
+import json
 import os
 import logging
 
-from metaquantome.util.utils import safe_cast_to_list, stream_to_file_from_url
+from metaquantome.util.utils import stream_to_file_from_url
+from metaquantome.databases.ClosureIndex import ClosureIndex, stamp_files
+from metaquantome.databases.GoSnapshot import GoSnapshot
 
 FULL_OBO_URL = 'http://purl.obolibrary.org/obo/go/go-basic.obo'
 SLIM_OBO_URL = 'http://current.geneontology.org/ontology/subsets/goslim_metagenomics.obo'
 
+# bump this if the layout of the slim map file changes
+SLIM_MAP_VERSION = 1
+
 
 class GeneOntologyDb:
     # the three "namespaces", or "ontologies"
@@ -31,10 +38,18 @@ class GeneOntologyDb:
         self.gofull = gofull
         self.goslim = goslim
         self.slim_down = slim_down
+        # precomputed ancestors, if built with >metaquantome db go --closure_index
+        obo_path, slim_path = self._define_data_paths(data_dir)
+        self.closure_index = ClosureIndex.load(data_dir, 'go', [obo_path])
         # slim_members is a set of all terms in the GO slim
         self.slim_members = None
+        # slim_map maps every full GO term to its closest term in the slim,
+        # and slim_ancestors maps every slim term to its ancestors within the slim
+        self.slim_map = None
+        self.slim_ancestors = None
         if slim_down:
             self.slim_members = set(goslim.keys())
+            self.slim_map, self.slim_ancestors = self._load_slim_map(data_dir)
 
     @staticmethod
     def _define_data_paths(data_dir):
@@ -68,11 +83,43 @@ class GeneOntologyDb:
             logging.info('Downloading generic slim GO obo file from ' + SLIM_OBO_URL + ' to ' + slim_path)
             stream_to_file_from_url(SLIM_OBO_URL, slim_path)
 
+    @staticmethod
+    def write_snapshots(data_dir):
+        """
+        Parse the full and slim OBO files and write compiled snapshots (see GoSnapshot) to data_dir,
+        unless up-to-date snapshots already exist.
+
+        :param data_dir: Data directory
+        :return: None
+        """
+        obo_path, slim_path = GeneOntologyDb._define_data_paths(data_dir)
+        for name, path in [('go', obo_path), ('goslim', slim_path)]:
+            if GoSnapshot.is_current(data_dir, name, path):
+                logging.info('GO snapshot of ' + path + ' is up to date.')
+            else:
+                GoSnapshot.write(data_dir, name, obo_parser.GODag(path), path)
+
+    @staticmethod
+    def _load_obo(data_dir, name, path):
+        """
+        Load a single GO database, from the compiled snapshot if it is present
+        and up to date, and otherwise by parsing the OBO file with goatools.oboparser.
+
+        :param data_dir: Data directory
+        :param name: name of the snapshot ('go' or 'goslim')
+        :param path: path to the OBO file
+        :return: GoSnapshot or GODag object
+        """
+        snapshot = GoSnapshot.load(data_dir, name, path)
+        if snapshot is not None:
+            return snapshot
+        return obo_parser.GODag(path)
+
     @staticmethod
     def _load_go_db(data_dir, slim_down):
         """
-        Load GO databases using goatools.oboparser. Always
-        loads the full GO, and loads the metagenomics slim GO if slim_down = True
+        Load GO databases using goatools.oboparser, or the compiled snapshots written by
+        >metaquantome db go. Always loads the full GO, and loads the metagenomics slim GO if slim_down = True
 
         :param data_dir: Data directory
         :param slim_down: Whether slim database is going to be used or not
@@ -83,9 +130,9 @@ class GeneOntologyDb:
             logging.error('GO files not found in specified directory.\n' +
                           'Please use the command >metaquantome db ...  to download the files.')
         # read gos
-        go_dag = obo_parser.GODag(obo_path)
+        go_dag = GeneOntologyDb._load_obo(data_dir, 'go', obo_path)
         if slim_down:
-            go_dag_slim = obo_parser.GODag(slim_path)
+            go_dag_slim = GeneOntologyDb._load_obo(data_dir, 'goslim', slim_path)
         else:
             go_dag_slim = None
         return go_dag, go_dag_slim
@@ -120,43 +167,115 @@ class GeneOntologyDb:
         If goid is in GO slim, it is returned. If it is not even in the full GO, the string "unknown" is returned.
         Otherwise, the most recent ancestor in the GO slim is returned.
         If multiple ancestors tie, the one that is first alphabetically is chosen.
+        The mapping is looked up in the precomputed slim map (see build_slim_map()).
 
         :param goid: GO term ID
         :return: closest term in slim (which is the term itself if it is in the slim GO)
         """
-        # first, check that term is in full GO. if not, return "unknown"
-        if not self._safe_query_go(goid):
-            return "unknown"
-        # first, see if term is in slim
-        slim_ids = self.goslim.keys()
-        if goid in slim_ids:
-            return goid
-        # if not in slim, get closest ancestor that is in slim. if there is a tie,
-        # select term that is first alphabetically (todo: could change this)
-        # this should always finish because each of BP, CC, and MF are in slim
-        closest_in_slim = None
-        ancestor_set = self.get_parents(goid)
-        while not closest_in_slim:
-            potential_closest = set()
-            # get term parents
-            ancestors = list(ancestor_set)
-            for full_id in ancestors:
-                if full_id in slim_ids:
-                    potential_closest.update(safe_cast_to_list(full_id))
-            # no potential closest
-            if len(potential_closest) == 0:
-                # new ancestors are the parents of the old ancestors
-                parents_of_new_ancestors = set()
-                for term in ancestors:
-                    parents_of_new_ancestors.update(self.get_parents(term))
-                ancestor_set = parents_of_new_ancestors
-                continue
-            # one or more potential closest
+        return self.slim_map.get(goid, 'unknown')
+
+    def get_slim_ancestors(self, goid):
+        """
+        Get the ancestors of a GO term that are in the GO slim
+
+        :param goid: query GO id
+        :return: set of ancestors in the slim. For terms in the slim, the precomputed set is returned
+        """
+        slim_ancestors = self.slim_ancestors.get(goid)
+        if slim_ancestors is not None:
+            return slim_ancestors
+        return {anc for anc in self.get_ancestors(goid) if anc in self.slim_members}
+
+    def build_slim_map(self):
+        """
+        Map every term in the full GO to its closest term in the slim, in a single sweep over the GO DAG.
+        The closest slim term is the slim ancestor with the fewest is_a edges to the term, with
+        ties broken alphabetically. Terms that are in the slim are mapped to themselves, and terms
+        with no ancestor in the slim are mapped to "unknown".
+
+        The terms are visited in topological order (parents before children), so that the closest
+        slim term of each term follows from those of its parents: if p is a parent of a term,
+        and the closest slim term to p (counting p itself) is s at distance d, then
+        s is at distance d + 1 from the term.
+
+        :return: tuple of a dictionary with the closest slim term of every GO id (including alternate ids),
+        and a dictionary with the ancestors within the slim of every slim term
+        """
+        terms = {term.id: term for term in self.gofull.values()}
+        # number of parents not yet visited
+        n_unvisited = {goid: len(term.parents) for goid, term in terms.items()}
+        to_visit = deque(goid for goid, n in n_unvisited.items() if n == 0)
+        # closest[goid] is the (distance, slim id) of the closest slim ancestor, not counting the term itself.
+        # closest_or_self counts the term itself, at distance 0
+        closest = dict()
+        closest_or_self = dict()
+        while len(to_visit) > 0:
+            goid = to_visit.popleft()
+            term = terms[goid]
+            candidates = [closest_or_self[parent.id] for parent in term.parents
+                          if closest_or_self[parent.id] is not None]
+            if len(candidates) > 0:
+                distance, slim_id = min(candidates)
+                closest[goid] = (distance + 1, slim_id)
+            else:
+                closest[goid] = None
+            closest_or_self[goid] = (0, goid) if goid in self.slim_members else closest[goid]
+            for child in term.children:
+                n_unvisited[child.id] -= 1
+                if n_unvisited[child.id] == 0:
+                    to_visit.append(child.id)
+
+        slim_map = dict()
+        for goid, term in self.gofull.items():
+            if goid in self.slim_members:
+                slim_map[goid] = goid
+            elif closest[term.id] is not None:
+                slim_map[goid] = closest[term.id][1]
             else:
-                potential_ancestors_list = list(potential_closest)
-                first_alpha = sorted(potential_ancestors_list)[0]
-                closest_in_slim = first_alpha
-        return closest_in_slim
+                slim_map[goid] = 'unknown'
+        slim_ancestors = {goid: frozenset(anc for anc in self.get_ancestors(goid) if anc in self.slim_members)
+                          for goid in self.slim_members if goid in self.gofull}
+        return slim_map, slim_ancestors
+
+    @staticmethod
+    def define_slim_map_path(data_dir):
+        """
+        define the path of the slim map file within data dir
+
+        :param data_dir: Data directory
+        :return: path to the slim map
+        """
+        return os.path.join(data_dir, 'goslim_map.json')
+
+    def _load_slim_map(self, data_dir):
+        """
+        Load the slim map from data_dir, if it is up to date with both OBO files.
+        Otherwise, build the slim map and write it to data_dir for later loads.
+
+        :param data_dir: Data directory
+        :return: tuple of slim map and slim ancestors, as returned by build_slim_map()
+        """
+        map_path = self.define_slim_map_path(data_dir)
+        stamps = stamp_files(self._define_data_paths(data_dir))
+        if os.path.exists(map_path):
+            with open(map_path, 'r') as f:
+                info = json.load(f)
+            if info.get('version') == SLIM_MAP_VERSION and info.get('sources') == stamps:
+                slim_ancestors = {goid: frozenset(ancestors) for goid, ancestors in info['slim_ancestors'].items()}
+                return info['slim_map'], slim_ancestors
+        slim_map, slim_ancestors = self.build_slim_map()
+        info = {'version': SLIM_MAP_VERSION,
+                'sources': stamps,
+                'slim_map': slim_map,
+                'slim_ancestors': {goid: sorted(ancestors) for goid, ancestors in slim_ancestors.items()}}
+        try:
+            with open(map_path + '.tmp', 'w') as f:
+                json.dump(info, f)
+            os.replace(map_path + '.tmp', map_path)
+            logging.info('Wrote map from ' + str(len(slim_map)) + ' GO terms to the slim to ' + map_path)
+        except OSError:
+            logging.info('Could not write the GO slim map to ' + map_path + '. It will be built again on the next load.')
+        return slim_map, slim_ancestors
 
     def _safe_query_go(self, goid):
         """
@@ -229,6 +348,10 @@ class GeneOntologyDb:
         :param goid: query GO id
         :return: set of ancestors or empty set, if term doesn't exist in db or has no ancestors
         """
+        if self.closure_index is not None:
+            ancestors = self.closure_index.get_ancestors(goid)
+            if ancestors is not None:
+                return ancestors
         term = self._safe_query_go(goid)
         if term:
             parents = set(term.parents)
@@ -242,3 +365,19 @@ class GeneOntologyDb:
             return anc_ids
         else:
             return set()
+
+    def write_closure_index(self, data_dir):
+        """
+        Precompute the ancestors of every GO term (including alternate ids)
+        and write them to the closure index in data_dir, to be memory mapped on later loads.
+
+        :param data_dir: data directory
+        :return: None
+        """
+        closures = dict()
+        metadata = dict()
+        for goid, term in self.gofull.items():
+            closures[goid] = term.get_all_parents()
+            metadata[goid] = term.namespace
+        obo_path, slim_path = self._define_data_paths(data_dir)
+        ClosureIndex.write(data_dir, 'go', closures, metadata, [obo_path])
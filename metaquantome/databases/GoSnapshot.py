@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+import shutil
+from collections.abc import Mapping
+import numpy as np
+
+from metaquantome.databases.ClosureIndex import stamp_files
+
+# bump this if the layout of the snapshot files changes
+SNAPSHOT_VERSION = 1
+
+
+class GoSnapshot(Mapping):
+    """
+    A compiled, read-only copy of a parsed GO DAG (goatools.obo_parser.GODag), stored in
+    <data_dir>/<name>_snapshot and memory mapped when loaded, so that the OBO file does not have to be parsed.
+
+    Terms are numbered by their position in the sorted list of primary GO ids. The snapshot consists of:
+
+    - goids.npy and goid_term.npy: all GO ids (including alternate ids), sorted, and the term number of each
+    - term_ids.npy: primary GO id of each term
+    - name_bytes.npy and name_offsets.npy: UTF-8 encoded names, so that the name of term i is
+      name_bytes[name_offsets[i]:name_offsets[i+1]]
+    - namespace.npy: integer code of the namespace of each term
+    - parent_offsets.npy, parents.npy, child_offsets.npy, children.npy: CSR arrays of parent and child term numbers
+    - snapshot.json: namespace table and the size and modification time of the OBO file
+
+    Like a GODag, a GoSnapshot maps GO ids to term objects (GoSnapshotTerm)
+    with id, name, namespace, parents, and children attributes.
+    """
+    def __init__(self, snapshot_dir):
+        """
+        Load (memory map) a previously written snapshot
+
+        :param snapshot_dir: directory containing the snapshot files
+        """
+        with open(os.path.join(snapshot_dir, 'snapshot.json'), 'r') as f:
+            info = json.load(f)
+        self.namespaces = info['namespaces']
+        for array in ['goids', 'goid_term', 'term_ids', 'name_bytes', 'name_offsets', 'namespace',
+                      'parent_offsets', 'parents', 'child_offsets', 'children']:
+            setattr(self, array, np.load(os.path.join(snapshot_dir, array + '.npy'), mmap_mode='r'))
+
+    @staticmethod
+    def define_snapshot_dir(data_dir, name):
+        """
+        define the directory that holds a snapshot
+
+        :param data_dir: data directory
+        :param name: name of the snapshot ('go' or 'goslim')
+        :return: path to snapshot directory
+        """
+        return os.path.join(data_dir, name + '_snapshot')
+
+    @staticmethod
+    def write(data_dir, name, godag, source_path):
+        """
+        Compile a parsed GO DAG and write it to <data_dir>/<name>_snapshot
+
+        :param data_dir: data directory
+        :param name: name of the snapshot ('go' or 'goslim')
+        :param godag: goatools GODag, or any mapping from GO id to GO term
+        :param source_path: path to the OBO file that godag was parsed from
+        :return: None
+        """
+        snapshot_dir = GoSnapshot.define_snapshot_dir(data_dir, name)
+        tmp_dir = snapshot_dir + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        # primary terms, numbered in sorted order of their ids
+        terms = {term.id: term for term in godag.values()}
+        term_ids = sorted(terms.keys())
+        term_number = {goid: i for i, goid in enumerate(term_ids)}
+        goids = sorted(godag.keys())
+        namespaces = sorted({term.namespace for term in terms.values()})
+        namespace_code = {namespace: i for i, namespace in enumerate(namespaces)}
+
+        names = [terms[goid].name.encode('utf-8') for goid in term_ids]
+        name_offsets = np.zeros(len(term_ids) + 1, dtype=np.int64)
+        name_offsets[1:] = np.cumsum([len(n) for n in names])
+        arrays = {'goids': np.array(goids),
+                  'goid_term': np.array([term_number[godag[goid].id] for goid in goids], dtype=np.int32),
+                  'term_ids': np.array(term_ids),
+                  'name_bytes': np.frombuffer(b''.join(names), dtype=np.uint8),
+                  'name_offsets': name_offsets,
+                  'namespace': np.array([namespace_code[terms[goid].namespace] for goid in term_ids], dtype=np.int8)}
+        for relation, attribute in [('parent', 'parents'), ('child', 'children')]:
+            offsets = np.zeros(len(term_ids) + 1, dtype=np.int64)
+            related = list()
+            for i, goid in enumerate(term_ids):
+                related.extend(sorted(term_number[rel.id] for rel in getattr(terms[goid], attribute)))
+                offsets[i + 1] = len(related)
+            arrays[relation + '_offsets'] = offsets
+            arrays[attribute] = np.array(related, dtype=np.int32)
+
+        for array_name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, array_name + '.npy'), array)
+        with open(os.path.join(tmp_dir, 'snapshot.json'), 'w') as f:
+            json.dump({'version': SNAPSHOT_VERSION,
+                       'namespaces': namespaces,
+                       'sources': stamp_files([source_path])}, f)
+
+        # swap in the finished snapshot, so a partially written snapshot is never loaded
+        if os.path.exists(snapshot_dir):
+            shutil.rmtree(snapshot_dir)
+        os.rename(tmp_dir, snapshot_dir)
+        logging.info('Wrote snapshot of ' + str(len(term_ids)) + ' GO terms to ' + snapshot_dir)
+
+    @staticmethod
+    def is_current(data_dir, name, source_path):
+        """
+        check whether a snapshot exists and was compiled from the current version of the OBO file
+
+        :param data_dir: data directory
+        :param name: name of the snapshot ('go' or 'goslim')
+        :param source_path: path to the OBO file
+        :return: True if the snapshot can be used
+        """
+        info_path = os.path.join(GoSnapshot.define_snapshot_dir(data_dir, name), 'snapshot.json')
+        if not (os.path.exists(info_path) and os.path.exists(source_path)):
+            return False
+        with open(info_path, 'r') as f:
+            info = json.load(f)
+        return info.get('version') == SNAPSHOT_VERSION and info.get('sources') == stamp_files([source_path])
+
+    @staticmethod
+    def load(data_dir, name, source_path):
+        """
+        Load a snapshot, if it exists and is up to date with the OBO file
+
+        :param data_dir: data directory
+        :param name: name of the snapshot ('go' or 'goslim')
+        :param source_path: path to the OBO file
+        :return: GoSnapshot object, or None if there is no usable snapshot
+        """
+        snapshot_dir = GoSnapshot.define_snapshot_dir(data_dir, name)
+        if not GoSnapshot.is_current(data_dir, name, source_path):
+            if os.path.exists(snapshot_dir):
+                logging.info('GO snapshot in ' + snapshot_dir + ' is out of date, so the OBO file will be parsed. ' +
+                             'Rebuild it with >metaquantome db go')
+            return None
+        return GoSnapshot(snapshot_dir)
+
+    def _position(self, goid):
+        """
+        find the position of a GO id within the sorted GO ids
+
+        :param goid: query GO id
+        :return: integer position, or None if the id is not in the snapshot
+        """
+        try:
+            i = int(np.searchsorted(self.goids, goid))
+        except TypeError:
+            return None
+        if i < len(self.goids) and self.goids[i] == goid:
+            return i
+        return None
+
+    def __getitem__(self, goid):
+        i = self._position(goid)
+        if i is None:
+            raise KeyError(goid)
+        return GoSnapshotTerm(self, int(self.goid_term[i]))
+
+    def __contains__(self, goid):
+        return self._position(goid) is not None
+
+    def __iter__(self):
+        return iter(self.goids.tolist())
+
+    def __len__(self):
+        return len(self.goids)
+
+    def _related(self, number, relation):
+        """
+        term numbers of the parents or children of a term
+
+        :param number: term number
+        :param relation: 'parent' or 'child'
+        :return: numpy array of term numbers
+        """
+        offsets = getattr(self, relation + '_offsets')
+        related = self.parents if relation == 'parent' else self.children
+        return related[offsets[number]:offsets[number + 1]]
+
+
+class GoSnapshotTerm:
+    """
+    A single GO term within a GoSnapshot. Provides the attributes of goatools GOTerm
+    that are used by metaQuantome: id, name, namespace, parents, and children.
+    """
+    __slots__ = ['snapshot', 'number']
+
+    def __init__(self, snapshot, number):
+        """
+        :param snapshot: GoSnapshot object
+        :param number: term number within the snapshot
+        """
+        self.snapshot = snapshot
+        self.number = number
+
+    def __eq__(self, other):
+        return isinstance(other, GoSnapshotTerm) and self.snapshot is other.snapshot and self.number == other.number
+
+    def __hash__(self):
+        return hash(self.number)
+
+    def __repr__(self):
+        return 'GoSnapshotTerm(' + self.id + ')'
+
+    @property
+    def id(self):
+        return str(self.snapshot.term_ids[self.number])
+
+    @property
+    def name(self):
+        offsets = self.snapshot.name_offsets
+        return self.snapshot.name_bytes[offsets[self.number]:offsets[self.number + 1]].tobytes().decode('utf-8')
+
+    @property
+    def namespace(self):
+        return self.snapshot.namespaces[self.snapshot.namespace[self.number]]
+
+    @property
+    def parents(self):
+        return {GoSnapshotTerm(self.snapshot, int(i)) for i in self.snapshot._related(self.number, 'parent')}
+
+    @property
+    def children(self):
+        return {GoSnapshotTerm(self.snapshot, int(i)) for i in self.snapshot._related(self.number, 'child')}
+
+    def get_all_parents(self):
+        """
+        Get the ids of all ancestors of the term, as in goatools GOTerm.get_all_parents()
+
+        :return: set of GO ids
+        """
+        ancestors = set()
+        to_visit = list(self.snapshot._related(self.number, 'parent'))
+        while len(to_visit) > 0:
+            number = int(to_visit.pop())
+            if number not in ancestors:
+                ancestors.add(number)
+                to_visit.extend(self.snapshot._related(number, 'parent'))
+        return set(self.snapshot.term_ids[sorted(ancestors)].tolist())
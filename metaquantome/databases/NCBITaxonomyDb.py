@@ -1,9 +1,13 @@
 from ete3 import NCBITaxa
 import os
+import numbers
 import numpy as np
 import logging
 import warnings
 
+from metaquantome.databases.ClosureIndex import ClosureIndex
+from metaquantome.databases.NCBITaxonomySnapshot import NCBITaxonomySnapshot
+from metaquantome.util import profiling
 
 # taxonomy tree with only the ranks that are used in metaQuantome
 BASIC_TAXONOMY_TREE = ["phylum",
@@ -40,15 +44,41 @@ UNKNOWN_RANK = 'unknown'
 # NCBI taxID to represent unknown taxon
 UNIDENTIFIED = 32644
 
+# maximum number of taxids in a single SQL query of the bulk methods
+SQL_CHUNK_SIZE = 10000
+
+# ways to load the NCBI database: the snapshot if it is present and up to date, otherwise the sqlite
+# database ('auto'), only the sqlite database with ete3 ('sqlite'), or only the snapshot ('snapshot')
+NCBI_BACKENDS = ['auto', 'sqlite', 'snapshot']
+
 
 class NCBITaxonomyDb:
-    def __init__(self, data_dir):
+    def __init__(self, data_dir, backend='auto'):
         """
         load NCBI database stored in data_dirs
 
         :param data_dir: Data directory
+        :param backend: one of NCBI_BACKENDS. By default, the snapshot written by
+        >metaquantome db ncbi --ncbi_snapshot is used if it is present and up to date
+        """
+        # ete3 NCBITaxa, or the memory mapped snapshot written by >metaquantome db ncbi --ncbi_snapshot
+        self.ncbi = self._load_ncbi_db(data_dir, backend)
+        # ranks and ancestors loaded in bulk with prefetch()
+        self.rank_map = dict()
+        self.ancestor_map = dict()
+        # precomputed ancestors and ranks, if built with >metaquantome db ncbi --closure_index
+        self.closure_index = ClosureIndex.load(data_dir, 'ncbi', [self._define_tax_paths(data_dir)])
+
+    def reconnect(self):
+        """
+        Open a new connection to the sqlite database. A connection should not be shared
+        between processes, so this is called in each worker process after a fork.
+        Nothing needs to be done if the database was loaded from the snapshot.
+
+        :return: None
         """
-        self.ncbi = self._load_ncbi_db(data_dir)
+        if not isinstance(self.ncbi, NCBITaxonomySnapshot):
+            self.ncbi._connect()
 
     @staticmethod
     def _define_tax_paths(data_dir):
@@ -84,19 +114,45 @@ class NCBITaxonomyDb:
                     os.remove(taxdump)
 
     @staticmethod
-    def _load_ncbi_db(data_dir):
+    def write_snapshot(data_dir):
+        """
+        Compile the NCBI database and write a snapshot (see NCBITaxonomySnapshot) to data_dir,
+        unless an up-to-date snapshot already exists.
+
+        :param data_dir: Data directory
+        :return: None
+        """
+        tax_path = NCBITaxonomyDb._define_tax_paths(data_dir)
+        if NCBITaxonomySnapshot.is_current(data_dir, tax_path):
+            logging.info('NCBI snapshot of ' + tax_path + ' is up to date.')
+        else:
+            NCBITaxonomySnapshot.write(data_dir, tax_path)
+
+    @staticmethod
+    def _load_ncbi_db(data_dir, backend='auto'):
         """
-        Load a pre-existing NCBI database (within data_dir) using NCBITaxa from the ete3 package.
+        Load a pre-existing NCBI database (within data_dir), from the compiled snapshot written by
+        >metaquantome db ncbi --ncbi_snapshot, or using NCBITaxa from the ete3 package.
         Throws an error if the file does not exist (should be <data_dir>/taxa.sqlite>
 
         :param data_dir: directory that contains NCBI database files
-        :return: an NCBITaxa() object
+        :param backend: one of NCBI_BACKENDS
+        :return: an NCBITaxonomySnapshot or NCBITaxa() object
         """
+        if backend not in NCBI_BACKENDS:
+            raise ValueError('Unknown NCBI backend ' + str(backend) + '. Expected one of ' + ', '.join(NCBI_BACKENDS))
         with warnings.catch_warnings():  # turning off ResourceWarnings (unclosed file) from ete3
             warnings.simplefilter('ignore')
             tax_path = NCBITaxonomyDb._define_tax_paths(data_dir)
             if not os.path.exists(tax_path):
                 logging.error('NCBI files not found in specified directory. Use metaquantome db to download files')
+            if backend != 'sqlite':
+                snapshot = NCBITaxonomySnapshot.load(data_dir, tax_path)
+                if snapshot is not None:
+                    return snapshot
+                if backend == 'snapshot':
+                    raise ValueError('No up-to-date NCBI snapshot in ' + data_dir + '. ' +
+                                     'Use metaquantome db ncbi --ncbi_snapshot to compile it')
             return NCBITaxa(tax_path)
 
     def is_in_db(self, taxid):
@@ -107,6 +163,7 @@ class NCBITaxonomyDb:
         :return: True if present, False if not
         :rtype: boolean
         """
+        profiling.count('ncbi lookups')
         rank_dict = self.ncbi.get_rank([taxid])
         if taxid in rank_dict.keys():
             return True
@@ -126,6 +183,7 @@ class NCBITaxonomyDb:
         """
         rank_of_query = self.get_rank(taxid)
         num_rank_of_query = NUMERIC_RANK[rank_of_query]
+        profiling.count('ncbi lookups')
         lineage = self.ncbi.get_lineage(taxid)
         ranks = self.ncbi.get_rank(lineage)
         # flip the dict so we have rank: id, rather than id: rank
@@ -182,6 +240,13 @@ class NCBITaxonomyDb:
         :return: rank
         :rtype: string
         """
+        if taxid in self.rank_map:
+            return self.rank_map[taxid]
+        if self.closure_index is not None:
+            query_rank = self.closure_index.get_metadata(taxid)
+            if query_rank is not None:
+                return query_rank
+        profiling.count('ncbi lookups')
         query_rank = self.ncbi.get_rank([taxid])[taxid]
         return query_rank
 
@@ -194,14 +259,12 @@ class NCBITaxonomyDb:
         """
         # get the rank of the query
         query_rank = self.get_rank(taxid)
-        # get number of query rank
-        num_query_rank = NUMERIC_RANK[query_rank]
         # which major rank is the first with lower rank?
-        try:
-            child_rank_char = BASIC_TAXONOMY_TREE[[v > num_query_rank for v in BASIC_NUMERIC_RANK].index(True)]
-        except ValueError:  # if rank is species (none lower in BASIC_NUMERIC_RANK)
+        child_rank_char = self._child_rank(query_rank)
+        if child_rank_char is None:  # if rank is species (none lower in BASIC_NUMERIC_RANK)
             return set()
         # get all descendants of query
+        profiling.count('ncbi lookups')
         desc = self.ncbi.get_descendant_taxa(taxid, intermediate_nodes=True)
         # get ranks of all descendants
         desc_ranks = self.ncbi.get_rank(desc)
@@ -209,6 +272,44 @@ class NCBITaxonomyDb:
         immed_children = {k for k, v in desc_ranks.items() if v == child_rank_char}
         return immed_children
 
+    @staticmethod
+    def _child_rank(rank):
+        """
+        get the rank of the immediate children of a taxon,
+        which is the first rank in BASIC_TAXONOMY_TREE that is lower than the taxon's rank
+
+        :param rank: rank of the taxon
+        :return: rank of the children, or None if the taxon is a species or lower
+        """
+        num_query_rank = NUMERIC_RANK[rank]
+        try:
+            return BASIC_TAXONOMY_TREE[[v > num_query_rank for v in BASIC_NUMERIC_RANK].index(True)]
+        except ValueError:
+            return None
+
+    def get_sample_children(self, sample_set):
+        """
+        get the children of each taxid within a set of taxids (such as all the nodes in a sample).
+        The result is the same as {taxid: get_children(taxid) & sample_set, ...}, but rather than
+        listing every descendant of every taxid in the NCBI database, the lineages of the taxids in the set
+        are inverted: the children of X within the set are the members of the set that have X in their lineage
+        and have the rank of X's immediate children.
+
+        :param sample_set: set of taxids
+        :return: dictionary of the form {taxid: set of children within sample_set, ...}
+        """
+        sample_set = set(sample_set)
+        lineages, ranks = self._get_lineages_and_ranks(list(sample_set))
+        # rank of the immediate children of each taxid (raises a KeyError for unknown taxids or ranks,
+        # like get_children())
+        child_ranks = {taxid: self._child_rank(ranks[taxid]) for taxid in sample_set}
+        sample_children = {taxid: set() for taxid in sample_set}
+        for taxid in sample_set:
+            for anc in lineages[taxid]:
+                if anc != taxid and anc in sample_set and child_ranks[anc] == ranks[taxid]:
+                    sample_children[anc].add(taxid)
+        return sample_children
+
     def get_descendants(self, taxid):
         """
         get descendants of query taxid
@@ -253,6 +354,12 @@ class NCBITaxonomyDb:
         :param taxid: query taxid
         :return: set of all ancestors of query taxid
         """
+        if taxid in self.ancestor_map:
+            return set(self.ancestor_map[taxid])
+        if self.closure_index is not None:
+            # only taxa with ranks in NUMERIC_RANK have precomputed ancestors
+            if self.closure_index.get_metadata(taxid) in NUMERIC_RANK.keys():
+                return self.closure_index.get_ancestors(taxid)
         rank_of_query = self.get_rank(taxid)
         num_query_rank = NUMERIC_RANK[rank_of_query]
         # which ranks are more general?
@@ -262,11 +369,202 @@ class NCBITaxonomyDb:
         except ValueError:  # if rank is phylum (none higher in BASIC_NUMERIC_RANK)
             return set()
         # get full lineage of query
+        profiling.count('ncbi lookups')
         lineage = self.ncbi.get_lineage(taxid)
         # get only ancestors
         ancestors = self.filter_to_desired_ranks(lineage, ancestor_rank_char)
         return ancestors
 
+    def write_closure_index(self, data_dir):
+        """
+        Precompute the ancestors (at the ranks in BASIC_TAXONOMY_TREE) and the rank of every taxon
+        and write them to the closure index in data_dir, to be memory mapped on later loads.
+        The lineages are read directly from the ete3 sqlite database, or from the snapshot.
+
+        :param data_dir: data directory
+        :return: None
+        """
+        if isinstance(self.ncbi, NCBITaxonomySnapshot):
+            all_taxids = self.get_all_taxids()
+            ranks = self.ncbi.get_rank(all_taxids)
+            lineages = self.ncbi.get_lineage_translator(all_taxids)
+        else:
+            ranks = dict()
+            lineages = dict()
+            for taxid, rank, track in self.ncbi.db.execute('SELECT taxid, rank, track FROM species'):
+                ranks[taxid] = rank
+                lineages[taxid] = [int(tid) for tid in track.split(',')]
+        closures = dict()
+        for taxid, rank in ranks.items():
+            if rank not in NUMERIC_RANK.keys():
+                # get_ancestors() is not defined for these, so they are only used for get_rank()
+                closures[taxid] = set()
+                continue
+            num_query_rank = NUMERIC_RANK[rank]
+            ancestor_rank_char = [BASIC_TAXONOMY_TREE[i] for
+                                  i, v in enumerate(BASIC_NUMERIC_RANK) if v < num_query_rank]
+            closures[taxid] = {tid for tid in lineages[taxid] if ranks.get(tid) in ancestor_rank_char}
+        ClosureIndex.write(data_dir, 'ncbi', closures, ranks, [self._define_tax_paths(data_dir)])
+
+    @staticmethod
+    def _clean_taxids(taxids):
+        """
+        get the distinct integer taxids from a list, array, or Series, skipping
+        missing values and anything that is not a number (which is never in the database)
+
+        :param taxids: iterable of taxids
+        :return: list of distinct integer taxids
+        """
+        clean = {int(tid) for tid in taxids
+                 if isinstance(tid, numbers.Number) and np.isfinite(tid) and int(tid) == tid}
+        return list(clean)
+
+    def _query_species(self, columns, taxids):
+        """
+        query the ete3 species table for many taxids at once
+
+        :param columns: comma-separated columns to select, besides taxid
+        :param taxids: list of integer taxids
+        :return: list of rows, each a tuple of (taxid, <columns>)
+        """
+        rows = list()
+        for start in range(0, len(taxids), SQL_CHUNK_SIZE):
+            chunk = ','.join(str(tid) for tid in taxids[start:(start + SQL_CHUNK_SIZE)])
+            query = 'SELECT taxid, ' + columns + ' FROM species WHERE taxid IN (' + chunk + ');'
+            rows.extend(self.ncbi.db.execute(query).fetchall())
+            profiling.count('ncbi sql queries')
+        return rows
+
+    def get_all_taxids(self):
+        """
+        get every taxid in the NCBI database
+
+        :return: list of taxids
+        """
+        if isinstance(self.ncbi, NCBITaxonomySnapshot):
+            return self.ncbi.taxids.tolist()
+        return [row[0] for row in self.ncbi.db.execute('SELECT taxid FROM species;')]
+
+    def get_ranks(self, taxids):
+        """
+        get the ranks of many taxids at once. Bulk version of get_rank()
+
+        :param taxids: list, array, or Series of taxids
+        :return: dictionary of the form {taxid: rank, ...}. Taxids not in the database are left out.
+        """
+        if isinstance(self.ncbi, NCBITaxonomySnapshot):
+            return self.ncbi.get_rank(self._clean_taxids(taxids))
+        return {tid: rank for tid, rank in self._query_species('rank', self._clean_taxids(taxids))}
+
+    def are_in_db(self, taxids):
+        """
+        determine whether each of many taxids is present in the NCBI database. Bulk version of is_in_db()
+
+        :param taxids: list, array, or Series of taxids
+        :return: boolean numpy array, in the same order as taxids
+        """
+        present = set(self.get_ranks(taxids).keys())
+        return np.array([isinstance(tid, numbers.Number) and np.isfinite(tid) and tid in present
+                         for tid in taxids], dtype=bool)
+
+    def get_lineages(self, taxids):
+        """
+        get the full lineages of many taxids at once
+
+        :param taxids: list, array, or Series of taxids
+        :return: dictionary of the form {taxid: [root, ..., taxid], ...}, with lineages in the
+        same order as ncbi.get_lineage(). Taxids not in the database are left out.
+        """
+        if isinstance(self.ncbi, NCBITaxonomySnapshot):
+            return self.ncbi.get_lineage_translator(self._clean_taxids(taxids))
+        lineages = dict()
+        for tid, track in self._query_species('track', self._clean_taxids(taxids)):
+            lineages[tid] = [int(x) for x in track.split(',')][::-1]
+        return lineages
+
+    def _get_lineages_and_ranks(self, taxids):
+        """
+        get the lineages of taxids, and the ranks of every member of those lineages,
+        in two queries
+
+        :param taxids: list, array, or Series of taxids
+        :return: tuple of dictionaries ({taxid: lineage, ...}, {taxid: rank, ...})
+        """
+        lineages = self.get_lineages(taxids)
+        members = set()
+        for lineage in lineages.values():
+            members.update(lineage)
+        return lineages, self.get_ranks(list(members))
+
+    @staticmethod
+    def _basic_lineages(lineages, ranks):
+        """
+        select the ancestors at ranks in BASIC_TAXONOMY_TREE from each lineage, as in get_ancestors().
+        Taxids with a rank that is not in FULL_TAXONOMY_TREE are left out.
+
+        :param lineages: dictionary of the form {taxid: full lineage, ...}
+        :param ranks: dictionary of the form {taxid: rank, ...} for all members of the lineages
+        :return: dictionary of the form {taxid: set of ancestors, ...}
+        """
+        basic_lineages = dict()
+        for tid, lineage in lineages.items():
+            if ranks[tid] not in NUMERIC_RANK.keys():
+                continue
+            num_query_rank = NUMERIC_RANK[ranks[tid]]
+            ancestor_rank_char = [BASIC_TAXONOMY_TREE[i] for
+                                  i, v in enumerate(BASIC_NUMERIC_RANK) if v < num_query_rank]
+            basic_lineages[tid] = {anc for anc in lineage if ranks.get(anc) in ancestor_rank_char}
+        return basic_lineages
+
+    def get_basic_lineages(self, taxids):
+        """
+        get the ancestors (at the ranks in BASIC_TAXONOMY_TREE) of many taxids at once.
+        Bulk version of get_ancestors()
+
+        :param taxids: list, array, or Series of taxids
+        :return: dictionary of the form {taxid: set of ancestors, ...}. Taxids not in the database,
+        or with a rank that is not in FULL_TAXONOMY_TREE, are left out.
+        """
+        lineages, ranks = self._get_lineages_and_ranks(taxids)
+        return self._basic_lineages(lineages, ranks)
+
+    def map_ids_to_desired_ranks(self, ranks2get, taxids):
+        """
+        map many taxids to a desired rank or ranks at once. Bulk version of map_id_to_desired_ranks()
+
+        :param ranks2get: list of desired ranks
+        :param taxids: list, array, or Series of taxids
+        :return: dictionary of the form {taxid: {rank: taxID, ...}, ...}. Taxids not in the database,
+        or with a rank that is not in FULL_TAXONOMY_TREE, are left out.
+        """
+        lineages, ranks = self._get_lineages_and_ranks(taxids)
+        mapped = dict()
+        for tid, lineage in lineages.items():
+            if ranks[tid] not in NUMERIC_RANK.keys():
+                continue
+            num_rank_of_query = NUMERIC_RANK[ranks[tid]]
+            invert_dict = {ranks[anc]: anc for anc in lineage if anc in ranks}
+            rt_dict = dict()
+            for rank in ranks2get:
+                # must be above taxid in hierarchy
+                if NUMERIC_RANK[rank] <= num_rank_of_query:
+                    rt_dict[rank] = invert_dict.get(rank, UNIDENTIFIED)
+            mapped[tid] = rt_dict
+        return mapped
+
+    def prefetch(self, taxids):
+        """
+        Load the ranks and ancestors of many taxids (and the ranks of their ancestors) in bulk,
+        so that later calls to get_rank() and get_ancestors() for these taxids do not query the database.
+
+        :param taxids: list, array, or Series of taxids
+        :return: None
+        """
+        lineages, ranks = self._get_lineages_and_ranks(taxids)
+        self.rank_map.update(ranks)
+        # get_ancestors() raises an error for ranks outside FULL_TAXONOMY_TREE, so those are left to it
+        self.ancestor_map.update(self._basic_lineages(lineages, ranks))
+
     def convert_taxid_to_name(self, taxids):
         """
         convert a numeric NCBI taxid to the taxon's name
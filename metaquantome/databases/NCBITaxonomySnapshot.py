@@ -0,0 +1,401 @@
+import bisect
+import json
+import logging
+import numbers
+import os
+import shutil
+import sqlite3
+import warnings
+import numpy as np
+
+from metaquantome.databases.ClosureIndex import stamp_files
+
+# bump this if the layout of the snapshot files changes
+SNAPSHOT_VERSION = 1
+
+# sqlite's NOCASE collation, which ete3 uses to match names, only folds ASCII letters
+_ASCII_LOWER = {i: i + 32 for i in range(ord('A'), ord('Z') + 1)}
+
+
+class NCBITaxonomySnapshot:
+    """
+    A compiled, read-only copy of the ete3 NCBI taxonomy database (taxa.sqlite), stored in
+    <data_dir>/ncbi_snapshot and memory mapped when loaded, so that no sqlite queries are needed at query time.
+    Since the arrays are memory mapped and no database connection is held, a snapshot
+    can be shared by forked processes.
+
+    Taxa are numbered by their position in the sorted array of taxids. The snapshot consists of:
+
+    - taxids.npy: all taxids, sorted
+    - parents.npy: position of the parent of each taxon (-1 for the root)
+    - rank.npy: integer code of the rank of each taxon
+    - name_bytes.npy and name_offsets.npy: UTF-8 encoded scientific names, so that the name of taxon i is
+      name_bytes[name_offsets[i]:name_offsets[i+1]]
+    - preorder.npy and subtree_end.npy: positions of all taxa in preorder, and, for each taxon, the end of
+      its subtree within preorder, so that its descendants are preorder[preorder_index[i] + 1:subtree_end[i]]
+    - preorder_index.npy: index of each taxon within preorder
+    - key_bytes.npy and key_offsets.npy: case-folded scientific names and synonyms, sorted,
+      with the taxid of each (key_taxids.npy) and whether it is a synonym (key_synonym.npy)
+    - merged_old.npy and merged_new.npy: taxids that were merged into other taxids, sorted by the old taxid
+    - snapshot.json: rank table and the size and modification time of taxa.sqlite
+
+    A snapshot provides the methods of ete3.NCBITaxa that are used by metaQuantome
+    (get_rank, get_lineage, get_lineage_translator, get_descendant_taxa, get_taxid_translator,
+    and get_name_translator), with the same results.
+    """
+    def __init__(self, snapshot_dir):
+        """
+        Load (memory map) a previously written snapshot
+
+        :param snapshot_dir: directory containing the snapshot files
+        """
+        with open(os.path.join(snapshot_dir, 'snapshot.json'), 'r') as f:
+            info = json.load(f)
+        self.ranks = info['ranks']
+        for array in ['taxids', 'parents', 'rank', 'name_bytes', 'name_offsets', 'preorder', 'preorder_index',
+                      'subtree_end', 'key_bytes', 'key_offsets', 'key_taxids', 'key_synonym',
+                      'merged_old', 'merged_new']:
+            setattr(self, array, np.load(os.path.join(snapshot_dir, array + '.npy'), mmap_mode='r'))
+
+    @staticmethod
+    def define_snapshot_dir(data_dir):
+        """
+        define the directory that holds the snapshot
+
+        :param data_dir: data directory
+        :return: path to snapshot directory
+        """
+        return os.path.join(data_dir, 'ncbi_snapshot')
+
+    @staticmethod
+    def write(data_dir, tax_path):
+        """
+        Compile the ete3 NCBI taxonomy database and write it to <data_dir>/ncbi_snapshot
+
+        :param data_dir: data directory
+        :param tax_path: path to the ete3 sqlite database (taxa.sqlite)
+        :return: None
+        """
+        snapshot_dir = NCBITaxonomySnapshot.define_snapshot_dir(data_dir)
+        tmp_dir = snapshot_dir + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        db = sqlite3.connect(tax_path)
+        try:
+            species = db.execute('SELECT taxid, parent, rank, spname FROM species ORDER BY taxid').fetchall()
+            synonyms = db.execute('SELECT taxid, spname FROM synonym').fetchall()
+            merged = db.execute('SELECT taxid_old, taxid_new FROM merged ORDER BY taxid_old').fetchall()
+        finally:
+            db.close()
+
+        taxids = np.array([row[0] for row in species], dtype=np.int64)
+        position = {taxid: i for i, taxid in enumerate(taxids.tolist())}
+        # the root is its own parent in some versions of the database, and has no parent in others
+        parents = np.array([position.get(row[1], -1) if row[1] != row[0] else -1 for row in species],
+                           dtype=np.int32)
+        ranks = sorted({row[2] for row in species})
+        rank_code = {rank: i for i, rank in enumerate(ranks)}
+
+        names = [row[3].encode('utf-8') for row in species]
+        name_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        name_offsets[1:] = np.cumsum([len(n) for n in names])
+
+        # children of each taxon, in order of their taxids, to list the taxa in preorder
+        child_order = np.argsort(parents, kind='stable')
+        child_counts = np.bincount(parents[parents >= 0], minlength=len(taxids))
+        child_offsets = np.zeros(len(taxids) + 1, dtype=np.int64)
+        child_offsets[1:] = np.cumsum(child_counts)
+        children = child_order[np.sum(parents < 0):]
+        preorder = list()
+        to_visit = np.flatnonzero(parents < 0)[::-1].tolist()
+        while len(to_visit) > 0:
+            i = to_visit.pop()
+            preorder.append(i)
+            to_visit.extend(children[child_offsets[i]:child_offsets[i + 1]][::-1].tolist())
+        preorder = np.array(preorder, dtype=np.int32)
+        preorder_index = np.zeros(len(taxids), dtype=np.int32)
+        preorder_index[preorder] = np.arange(len(preorder), dtype=np.int32)
+        # subtree sizes, added up from the leaves
+        subtree_size = np.ones(len(taxids), dtype=np.int64)
+        for i in preorder[::-1].tolist():
+            if parents[i] >= 0:
+                subtree_size[parents[i]] += subtree_size[i]
+
+        # scientific names come before synonyms, and ties are in order of taxid, as returned by sqlite
+        keys = sorted([(NCBITaxonomySnapshot._fold_name(row[3]), False, row[0]) for row in species] +
+                      [(NCBITaxonomySnapshot._fold_name(name), True, taxid) for taxid, name in synonyms])
+        key_bytes = [key[0].encode('utf-8') for key in keys]
+        key_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        key_offsets[1:] = np.cumsum([len(k) for k in key_bytes])
+
+        arrays = {'taxids': taxids,
+                  'parents': parents,
+                  'rank': np.array([rank_code[row[2]] for row in species], dtype=np.int16),
+                  'name_bytes': np.frombuffer(b''.join(names), dtype=np.uint8),
+                  'name_offsets': name_offsets,
+                  'preorder': preorder,
+                  'preorder_index': preorder_index,
+                  'subtree_end': preorder_index + subtree_size,
+                  'key_bytes': np.frombuffer(b''.join(key_bytes), dtype=np.uint8),
+                  'key_offsets': key_offsets,
+                  'key_taxids': np.array([key[2] for key in keys], dtype=np.int64),
+                  'key_synonym': np.array([key[1] for key in keys], dtype=bool),
+                  'merged_old': np.array([row[0] for row in merged], dtype=np.int64),
+                  'merged_new': np.array([row[1] for row in merged], dtype=np.int64)}
+        for array_name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, array_name + '.npy'), array)
+        with open(os.path.join(tmp_dir, 'snapshot.json'), 'w') as f:
+            json.dump({'version': SNAPSHOT_VERSION,
+                       'ranks': ranks,
+                       'sources': stamp_files([tax_path])}, f)
+
+        # swap in the finished snapshot, so a partially written snapshot is never loaded
+        if os.path.exists(snapshot_dir):
+            shutil.rmtree(snapshot_dir)
+        os.rename(tmp_dir, snapshot_dir)
+        logging.info('Wrote snapshot of ' + str(len(taxids)) + ' taxa to ' + snapshot_dir)
+
+    @staticmethod
+    def is_current(data_dir, tax_path):
+        """
+        check whether a snapshot exists and was compiled from the current version of taxa.sqlite
+
+        :param data_dir: data directory
+        :param tax_path: path to the ete3 sqlite database
+        :return: True if the snapshot can be used
+        """
+        info_path = os.path.join(NCBITaxonomySnapshot.define_snapshot_dir(data_dir), 'snapshot.json')
+        if not (os.path.exists(info_path) and os.path.exists(tax_path)):
+            return False
+        with open(info_path, 'r') as f:
+            info = json.load(f)
+        return info.get('version') == SNAPSHOT_VERSION and info.get('sources') == stamp_files([tax_path])
+
+    @staticmethod
+    def load(data_dir, tax_path):
+        """
+        Load the snapshot, if it exists and is up to date with taxa.sqlite
+
+        :param data_dir: data directory
+        :param tax_path: path to the ete3 sqlite database
+        :return: NCBITaxonomySnapshot object, or None if there is no usable snapshot
+        """
+        snapshot_dir = NCBITaxonomySnapshot.define_snapshot_dir(data_dir)
+        if not NCBITaxonomySnapshot.is_current(data_dir, tax_path):
+            if os.path.exists(snapshot_dir):
+                logging.info('NCBI snapshot in ' + snapshot_dir + ' is out of date, so the sqlite database ' +
+                             'will be used. Rebuild it with >metaquantome db ncbi')
+            return None
+        return NCBITaxonomySnapshot(snapshot_dir)
+
+    @staticmethod
+    def _fold_name(name):
+        """
+        case-fold a name as it is compared by ete3.NCBITaxa.get_name_translator()
+
+        :param name: taxon name
+        :return: folded name
+        """
+        return name.translate(_ASCII_LOWER)
+
+    @staticmethod
+    def _to_int(taxid):
+        """
+        convert a taxid to an integer, as sqlite does when comparing it to the integer taxid column
+
+        :param taxid: query taxid
+        :return: integer taxid, or None if taxid is not an integral number
+        """
+        if isinstance(taxid, str):
+            try:
+                taxid = float(taxid)
+            except ValueError:
+                return None
+        if isinstance(taxid, numbers.Number) and np.isfinite(taxid) and int(taxid) == taxid:
+            return int(taxid)
+        return None
+
+    def _position(self, taxid):
+        """
+        find the position of a taxid within the sorted taxids
+
+        :param taxid: query taxid
+        :return: integer position, or None if the taxid is not in the snapshot
+        """
+        taxid = self._to_int(taxid)
+        if taxid is None:
+            return None
+        i = int(np.searchsorted(self.taxids, taxid))
+        if i < len(self.taxids) and self.taxids[i] == taxid:
+            return i
+        return None
+
+    def _translate_merged(self, taxid):
+        """
+        :param taxid: integer taxid
+        :return: the taxid that taxid was merged into, or None if it was not merged
+        """
+        i = int(np.searchsorted(self.merged_old, taxid))
+        if i < len(self.merged_old) and self.merged_old[i] == taxid:
+            return int(self.merged_new[i])
+        return None
+
+    def _name(self, i):
+        """
+        :param i: position of a taxon
+        :return: scientific name of the taxon
+        """
+        return self.name_bytes[self.name_offsets[i]:self.name_offsets[i + 1]].tobytes().decode('utf-8')
+
+    def _lineage(self, i):
+        """
+        :param i: position of a taxon
+        :return: list of taxids from the root to the taxon, by following the parent positions
+        """
+        positions = list()
+        while i >= 0:
+            positions.append(i)
+            i = int(self.parents[i])
+        return self.taxids[positions[::-1]].tolist()
+
+    def get_rank(self, taxids):
+        """
+        get the ranks of taxids, as ete3.NCBITaxa.get_rank()
+
+        :param taxids: list of taxids
+        :return: dictionary of the form {taxid: rank, ...}. Taxids not in the database are left out.
+        """
+        id2rank = dict()
+        for taxid in taxids:
+            i = self._position(taxid)
+            if i is not None:
+                id2rank[int(self.taxids[i])] = self.ranks[self.rank[i]]
+        return id2rank
+
+    def get_lineage(self, taxid):
+        """
+        get the lineage of a taxid, as ete3.NCBITaxa.get_lineage()
+
+        :param taxid: query taxid
+        :return: list of taxids, from the root to the query taxid. Raises a ValueError if the taxid
+        is not in the database
+        """
+        if not taxid:
+            return None
+        i = self._position(taxid)
+        if i is None:
+            # perhaps an obsolete taxid
+            new_taxid = self._translate_merged(int(taxid))
+            i = self._position(new_taxid) if new_taxid is not None else None
+            if i is None:
+                raise ValueError(str(taxid) + ' taxid not found')
+            warnings.warn('taxid ' + str(taxid) + ' was translated into ' + str(new_taxid))
+        return self._lineage(i)
+
+    def get_lineage_translator(self, taxids):
+        """
+        get the lineages of many taxids, as ete3.NCBITaxa.get_lineage_translator()
+
+        :param taxids: list of taxids
+        :return: dictionary of the form {taxid: [root, ..., taxid], ...}. Taxids not in the database are left out.
+        """
+        id2lineage = dict()
+        for taxid in taxids:
+            i = self._position(taxid)
+            if i is not None:
+                id2lineage[int(self.taxids[i])] = self._lineage(i)
+        return id2lineage
+
+    def get_descendant_taxa(self, parent, intermediate_nodes=False):
+        """
+        get the descendants of a taxon, as ete3.NCBITaxa.get_descendant_taxa()
+
+        :param parent: taxid or scientific name of the query taxon
+        :param intermediate_nodes: if True, all descendants are returned, otherwise only the leaves
+        :return: list of taxids, in preorder. If the taxon has no descendants, the list
+        contains only the taxon itself. Raises a ValueError if the taxon is not in the database
+        """
+        try:
+            taxid = int(parent)
+        except ValueError:
+            try:
+                taxid = self.get_name_translator([parent])[parent][0]
+            except KeyError:
+                raise ValueError(str(parent) + ' not found!')
+        new_taxid = self._translate_merged(taxid)
+        if new_taxid is not None:
+            taxid = new_taxid
+        i = self._position(taxid)
+        if i is None:
+            raise ValueError('taxid not found:' + str(taxid))
+        descendants = self.preorder[(self.preorder_index[i] + 1):self.subtree_end[i]]
+        if len(descendants) == 0:
+            return [taxid]
+        if not intermediate_nodes:
+            # leaves have a subtree of only themselves
+            descendants = descendants[self.subtree_end[descendants] == self.preorder_index[descendants] + 1]
+        return self.taxids[descendants].tolist()
+
+    def get_taxid_translator(self, taxids):
+        """
+        get the scientific names of taxids, as ete3.NCBITaxa.get_taxid_translator().
+        Obsolete taxids are translated with the names of the taxa that they were merged into.
+
+        :param taxids: list of taxids
+        :return: dictionary of the form {taxid: name, ...}. Taxids not in the database are left out.
+        """
+        id2name = dict()
+        for taxid in set(map(int, taxids)):
+            i = self._position(taxid)
+            if i is None:
+                new_taxid = self._translate_merged(taxid)
+                i = self._position(new_taxid) if new_taxid is not None else None
+            if i is not None:
+                id2name[taxid] = self._name(i)
+        return id2name
+
+    def get_name_translator(self, names):
+        """
+        get the taxids of names, as ete3.NCBITaxa.get_name_translator(). Names are matched
+        regardless of (ASCII) case, and synonyms are only used for names that are not scientific names.
+
+        :param names: list of names
+        :return: dictionary of the form {name: [taxid, ...], ...}. Names not in the database are left out.
+        """
+        keys = _SortedKeys(self)
+        # like ete3, only the last of several names that differ only in case is translated
+        name2origname = {name.lower(): name for name in names}
+        name2id = dict()
+        for lower_name, name in name2origname.items():
+            key = self._fold_name(lower_name).encode('utf-8')
+            start = bisect.bisect_left(keys, key)
+            end = bisect.bisect_right(keys, key, lo=start)
+            if start == end:
+                continue
+            synonym = self.key_synonym[start:end]
+            # scientific names are sorted before synonyms
+            use = ~synonym if not synonym[0] else synonym
+            name2id[name] = self.key_taxids[start:end][use].tolist()
+        return name2id
+
+
+class _SortedKeys:
+    """
+    The sorted, case-folded names of a NCBITaxonomySnapshot, as a sequence of bytes that can be searched with bisect
+    """
+    __slots__ = ['snapshot']
+
+    def __init__(self, snapshot):
+        """
+        :param snapshot: NCBITaxonomySnapshot object
+        """
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return len(self.snapshot.key_taxids)
+
+    def __getitem__(self, i):
+        offsets = self.snapshot.key_offsets
+        return self.snapshot.key_bytes[offsets[i]:offsets[i + 1]].tobytes()
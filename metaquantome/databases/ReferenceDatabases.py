@@ -0,0 +1,96 @@
+import logging
+import os
+
+from metaquantome.databases.EnzymeDb import EnzymeDb
+from metaquantome.databases.GeneOntologyDb import GeneOntologyDb
+from metaquantome.databases.NCBITaxonomyDb import NCBITaxonomyDb
+from metaquantome.util.utils import DATA_DIR
+
+# databases that can be loaded ahead of time, see ReferenceDatabases.preload()
+PRELOAD_NAMES = ['go', 'goslim', 'ec', 'ncbi']
+
+
+class ReferenceDatabases:
+    """
+    Loaded reference databases, kept so that several jobs (see metaquantome.modules.server)
+    can use them without parsing the GO OBO files or opening the NCBI database again.
+    Each database is loaded the first time it is requested for a data directory, and the same
+    object is returned afterwards.
+    """
+    def __init__(self):
+        """
+        Create an empty ReferenceDatabases object
+        """
+        # keys are (name, absolute path of data_dir), see PRELOAD_NAMES
+        self.dbs = dict()
+
+    def function_db(self, data_dir, ontology, slim_down):
+        """
+        Get the database for a functional ontology, loading it if needed
+
+        :param data_dir: directory that contains the database files. If None, the default data directory is used
+        :param ontology: 'go', 'ec', or 'cog'
+        :param slim_down: for GO, whether the metagenomics slim is used
+        :return: GeneOntologyDb or EnzymeDb object, or None for COG
+        """
+        if ontology == 'go':
+            return self._get('goslim' if slim_down else 'go', data_dir)
+        elif ontology == 'ec':
+            return self._get('ec', data_dir)
+        return None
+
+    def taxonomy_db(self, data_dir):
+        """
+        Get the NCBI taxonomy database, loading it if needed
+
+        :param data_dir: directory that contains the database files. If None, the default data directory is used
+        :return: NCBITaxonomyDb object
+        """
+        return self._get('ncbi', data_dir)
+
+    def preload(self, data_dir, names=PRELOAD_NAMES):
+        """
+        Load databases ahead of the first job
+
+        :param data_dir: directory that contains the database files. If None, the default data directory is used
+        :param names: databases to load, from PRELOAD_NAMES
+        :return: None
+        """
+        for name in names:
+            if name not in PRELOAD_NAMES:
+                raise ValueError('Unknown database ' + name + '. Expected one of ' + ', '.join(PRELOAD_NAMES))
+            self._get(name, data_dir)
+
+    def reconnect(self):
+        """
+        Open new connections to the sqlite databases, which should not be shared between
+        processes. Called in each job process after a fork.
+
+        :return: None
+        """
+        for (name, data_dir), db in self.dbs.items():
+            if name == 'ncbi':
+                db.reconnect()
+
+    def _get(self, name, data_dir):
+        """
+        :param name: one of PRELOAD_NAMES
+        :param data_dir: data directory
+        :return: the loaded database
+        """
+        if not data_dir:
+            data_dir = DATA_DIR
+        # relative to the current working directory, which is the client's for each job
+        data_dir = os.path.abspath(data_dir)
+        key = (name, data_dir)
+        if key not in self.dbs:
+            logging.info('Loading ' + name + ' database from ' + data_dir)
+            if name == 'go':
+                self.dbs[key] = GeneOntologyDb(data_dir, slim_down=False)
+            elif name == 'goslim':
+                self.dbs[key] = GeneOntologyDb(data_dir, slim_down=True)
+            elif name == 'ec':
+                self.dbs[key] = EnzymeDb(data_dir)
+            else:
+                self.dbs[key] = NCBITaxonomyDb(data_dir)
+        return self.dbs[key]
@@ -3,18 +3,28 @@ from metaquantome.databases.EnzymeDb import EnzymeDb
 from metaquantome.databases.NCBITaxonomyDb import NCBITaxonomyDb
 
 
-def db_download_handler(dbs, data_dir, overwrite):
+def db_download_handler(dbs, data_dir, overwrite, closure_index=False, ncbi_snapshot=False):
     """
     called by CLI to download databases
 
     :param dbs: list of databases ("go", "ec", and/or "ncbi")
     :param data_dir: data directory
     :param overwrite: whether to overwrite existing files or not
+    :param closure_index: whether to also build the precomputed ancestor index for the GO and NCBI databases.
+    The ancestors of EC numbers are computed when the database is loaded, so the ENZYME database has no index
+    :param ncbi_snapshot: whether to also compile the NCBI database to a snapshot (see NCBITaxonomySnapshot)
     :return: None
     """
     if "go" in dbs:
         GeneOntologyDb.download_go(data_dir, overwrite)
+        GeneOntologyDb.write_snapshots(data_dir)
+        if closure_index:
+            GeneOntologyDb(data_dir).write_closure_index(data_dir)
     if "ec" in dbs:
         EnzymeDb.download_enzyme_db(data_dir, overwrite)
     if "ncbi" in dbs:
         NCBITaxonomyDb.download_ncbi(data_dir)
+        if ncbi_snapshot:
+            NCBITaxonomyDb.write_snapshot(data_dir)
+        if closure_index:
+            NCBITaxonomyDb(data_dir).write_closure_index(data_dir)
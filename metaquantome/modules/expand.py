@@ -1,16 +1,25 @@
+from collections import OrderedDict
 import numpy as np
+import pandas as pd
 
 import metaquantome.util.expand_io as expand_io
 from metaquantome.classes.SampleAnnotations import SampleAnnotations
+from metaquantome.classes.SampleAnnotationMatrix import SampleAnnotationMatrix
+from metaquantome.modules import functional_analysis as fa
+from metaquantome.modules import taxonomy_analysis as ta
+from metaquantome.modules import function_taxonomy_interaction as fti
 from metaquantome.modules.functional_analysis import functional_analysis
 from metaquantome.modules.taxonomy_analysis import taxonomy_analysis
 from metaquantome.modules.function_taxonomy_interaction import function_taxonomy_analysis
 from metaquantome.classes.SampleGroups import SampleGroups
+from metaquantome.util import profiling
 
 
+@profiling.timed('expand')
 def expand(mode, sinfo, int_file, pep_colname_int, pep_colname_func, pep_colname_tax, data_dir=None, outfile=None,
            func_file=None, func_colname=None, ontology='go', slim_down=False, tax_file=None, tax_colname=None,
-           nopep=False, nopep_file=None, ft_tar_rank='genus'):
+           nopep=False, nopep_file=None, ft_tar_rank='genus', engine='hierarchy', chunksize=None, workers=1,
+           databases=None):
     """
     Expand the directly annotated hierarchy to one with all ancestors.
 
@@ -30,13 +39,70 @@ def expand(mode, sinfo, int_file, pep_colname_int, pep_colname_func, pep_colname
     :param nopep: if True, do nopep modules
     :param nopep_file: path to file without peptides
     :param data_dir: path to parent directory of database files
-    :param ft_tar_rank: in ft mode, all taxonomy are mapped to this rank if possible.
+    :param ft_tar_rank: in ft mode, all taxonomy are mapped to this rank if possible. May also be a list of ranks,
+    in which case the peptides are read, cleaned, and mapped to all ranks in one pass, and a table is made for each
+    rank; each table is written to outfile with the rank added to the name (see expand_io.define_ft_rank_outfile())
+    :param engine: expansion engine for 'f' and 't' modes. Either 'hierarchy' (one AnnotationHierarchy per sample)
+    or 'matrix' (all samples at once, with sparse matrix products). Both give the same results.
+    :param chunksize: if given, the intensity file (or nopep file) is read and expanded this many rows at a time,
+    so that only the per-term sums are held in memory. See stream_expand()
+    :param workers: number of processes used to expand the samples with the 'hierarchy' engine.
+    :param databases: ReferenceDatabases object with loaded reference databases to reuse (see
+    metaquantome.modules.server). If None, the databases are loaded from data_dir.
     :return: returns a dataframe of functional or taxonomic terms with associated intensities.
-    Missing values are represented as 0.
+    Missing values are represented as 0. In ft mode with a list of ranks, a dictionary of the form
+    {rank: dataframe, ...}
     """
     # define the sample groups object
     samp_grps = SampleGroups(sinfo)
 
+    if chunksize is not None:
+        # read and join files lazily, one chunk at a time - depending on pep/nopep
+        if nopep:
+            chunks = expand_io.read_nopep_table_chunks(file=nopep_file, samp_grps=samp_grps, mode=mode,
+                                                       chunksize=chunksize, func_colname=func_colname,
+                                                       tax_colname=tax_colname)
+        else:
+            chunks = expand_io.read_and_join_files_chunks(mode, pep_colname_int=pep_colname_int,
+                                                          pep_colname_func=pep_colname_func,
+                                                          pep_colname_tax=pep_colname_tax, samp_grps=samp_grps,
+                                                          int_file=int_file, chunksize=chunksize, tax_file=tax_file,
+                                                          func_file=func_file, func_colname=func_colname,
+                                                          tax_colname=tax_colname)
+        results = stream_expand(mode, chunks, samp_grps, data_dir=data_dir, func_colname=func_colname,
+                                ontology=ontology, slim_down=slim_down, tax_colname=tax_colname,
+                                ft_tar_rank=ft_tar_rank, databases=databases)
+    else:
+        results = expand_in_memory(mode, samp_grps, int_file, pep_colname_int, pep_colname_func, pep_colname_tax,
+                                   data_dir=data_dir, func_file=func_file, func_colname=func_colname,
+                                   ontology=ontology, slim_down=slim_down, tax_file=tax_file,
+                                   tax_colname=tax_colname, nopep=nopep, nopep_file=nopep_file,
+                                   ft_tar_rank=ft_tar_rank, engine=engine, workers=workers,
+                                   databases=databases)
+
+    # set up written output
+    if outfile:
+        cols = expand_io.define_outfile_cols_expand(samp_grps, ontology, mode)
+        if isinstance(results, dict):
+            # one table for each target rank in ft mode
+            for rank, rank_results in results.items():
+                expand_io.write_out_general(rank_results, outfile=expand_io.define_ft_rank_outfile(outfile, rank),
+                                            cols=cols)
+        else:
+            expand_io.write_out_general(results, outfile=outfile, cols=cols)
+    # whether writing out or not, return result data frame (mostly for testing)
+    return results
+
+
+def expand_in_memory(mode, samp_grps, int_file, pep_colname_int, pep_colname_func, pep_colname_tax, data_dir=None,
+                     func_file=None, func_colname=None, ontology='go', slim_down=False, tax_file=None,
+                     tax_colname=None, nopep=False, nopep_file=None, ft_tar_rank='genus', engine='hierarchy',
+                     workers=1, databases=None):
+    """
+    Read the full input tables and expand. See expand() for the parameters.
+
+    :return: dataframe of functional or taxonomic terms with associated intensities.
+    """
     # read and join files - depending on pep/nopep
     if nopep:
         df = expand_io.read_nopep_table(file=nopep_file, samp_grps=samp_grps,
@@ -50,25 +116,105 @@ def expand(mode, sinfo, int_file, pep_colname_int, pep_colname_func, pep_colname
     # run modules based on modes
     if mode == 'f':
         results = functional_analysis(df=df, func_colname=func_colname, samp_grps=samp_grps, ontology=ontology,
-                                      slim_down=slim_down, data_dir=data_dir)
+                                      slim_down=slim_down, data_dir=data_dir, engine=engine, workers=workers,
+                                      databases=databases)
     elif mode == 't':
-        results = taxonomy_analysis(df=df, samp_grps=samp_grps, data_dir=data_dir, tax_colname=tax_colname)
+        results = taxonomy_analysis(df=df, samp_grps=samp_grps, data_dir=data_dir, tax_colname=tax_colname,
+                                    engine=engine, workers=workers, databases=databases)
     elif mode == 'ft':
         results = function_taxonomy_analysis(df=df, func_colname=func_colname, pep_colname=pep_colname_int,
                                              ontology=ontology, slim_down=slim_down, tax_colname=tax_colname,
-                                             samp_grps=samp_grps, ft_tar_rank=ft_tar_rank, data_dir=data_dir)
+                                             samp_grps=samp_grps, ft_tar_rank=ft_tar_rank, data_dir=data_dir,
+                                             databases=databases)
     else:
         raise ValueError('Invalid mode. Expected one of "f", "t", or "ft"')
+    return results
 
-    # set up written output
-    if outfile:
-        cols = expand_io.define_outfile_cols_expand(samp_grps, ontology, mode)
-        expand_io.write_out_general(results, outfile=outfile, cols=cols)
-    # whether writing out or not, return result data frame (mostly for testing)
+
+@profiling.timed('stream')
+def stream_expand(mode, chunks, samp_grps, data_dir=None, func_colname=None, ontology='go', slim_down=False,
+                  tax_colname=None, ft_tar_rank='genus', databases=None):
+    """
+    Expand chunks of peptides one at a time. Each chunk is cleaned as in the in-memory analysis,
+    and the intensities and number of peptides of each term are added to running sums
+    (SampleAnnotationMatrix.add_chunk() for GO, EC, and taxonomy; grouped sums for COG and 'ft' mode),
+    so that memory use depends on the number of distinct terms rather than the number of peptides.
+    The results are the same as for the in-memory analysis, up to the order in which floating point
+    intensities are added. In 'ft' mode, the (peptide, GO term) pairs are also kept, so that duplicates
+    in different chunks are only counted once.
+
+    :param mode: either 't', 'f', or 'ft'
+    :param chunks: iterable of joined dataframes, as from expand_io.read_and_join_files_chunks()
+    :param samp_grps: SampleGroups object
+    :param data_dir: path to parent directory of database files
+    :param func_colname: column name for the functional annotations
+    :param ontology: for function mode only. either 'go', 'ec', or 'cog'
+    :param slim_down: if True, maps full GO terms to slim
+    :param tax_colname: column name with taxonomy annotations
+    :param ft_tar_rank: in ft mode, all taxonomy are mapped to this rank if possible, or a list of ranks
+    :param databases: ReferenceDatabases object with loaded databases to reuse. If None, the databases are loaded
+    :return: dataframe of functional or taxonomic terms with associated intensities
+    (for a list of ranks, a dictionary of the form {rank: dataframe, ...}).
+    """
+    # chunks can be empty, if none of the peptides in the chunk are annotated
+    chunks = (chunk for chunk in chunks if chunk.shape[0] > 0)
+    if mode == 'f':
+        if ontology not in {'go', 'ec', 'cog'}:
+            raise ValueError("the desired ontology is not supported. " +
+                             "Please use either GO (ontology = 'go'), " +
+                             "COG (ontology = 'cog'), or EC numbers (ontology = 'ec')")
+        db = fa.load_function_db(data_dir, ontology, slim_down, databases=databases)
+        if ontology == 'cog':
+            sums = None
+            for chunk in chunks:
+                norm_df = fa.normalize_function_df(db, chunk, func_colname, ontology)
+                chunk_sums = fa.sum_cog_df(norm_df, func_colname, samp_grps)
+                sums = chunk_sums if sums is None else pd.concat([sums, chunk_sums]).groupby(level=0).sum()
+            results = summarize_intensities(sums, samp_grps)
+        else:
+            samp_annot = SampleAnnotationMatrix(db)
+            for chunk in chunks:
+                # share the ancestor cache between redundancy reduction and the hierarchy, and across chunks.
+                # the terms refer to the rows of the chunk, so its intensities are not copied for each term
+                term_df = fa.split_function_df(samp_annot.closure_cache, chunk, func_colname, ontology)
+                term_clean = fa.filter_function_df(db, term_df, func_colname, ontology, slim_down)
+                samp_annot.add_term_mapping(chunk, term_clean, func_colname, samp_grps)
+            samp_annot.finalize()
+            results = summarize_intensities(samp_annot.to_dataframe(), samp_grps)
+        results = fa.describe_function_results(db, results, ontology)
+    elif mode == 't':
+        ncbi = ta.load_taxonomy_db(data_dir, databases=databases)
+        samp_annot = SampleAnnotationMatrix(ncbi)
+        for chunk in chunks:
+            df_clean = ta.clean_taxonomy_df(ncbi, chunk, tax_colname)
+            samp_annot.add_chunk(df_clean, tax_colname, samp_grps)
+        samp_annot.finalize()
+        results = summarize_intensities(samp_annot.to_dataframe(), samp_grps)
+        results = ta.describe_taxonomy_results(ncbi, results)
+    elif mode == 'ft':
+        godb = fa.load_function_db(data_dir, ontology, slim_down, databases=databases)
+        ncbi = ta.load_taxonomy_db(data_dir, databases=databases)
+        colnames = fti.des_rank_colnames(ft_tar_rank)
+        sums = OrderedDict((rank, None) for rank in colnames)
+        seen_pairs = set()
+        for chunk in chunks:
+            dedup_df = fti.clean_function_taxonomy_df(godb, ncbi, chunk, func_colname, ontology, slim_down,
+                                                      tax_colname, ft_tar_rank, seen_pairs=seen_pairs)
+            for rank, colname in colnames.items():
+                chunk_sums = fti.sum_function_taxonomy_df(dedup_df, func_colname, samp_grps,
+                                                          des_rank_colname=colname)
+                sums[rank] = fti.add_function_taxonomy_sums(sums[rank], chunk_sums)
+        results = OrderedDict((rank, fti.describe_function_taxonomy_results(godb, ncbi, rank_sums, func_colname,
+                                                                            samp_grps))
+                              for rank, rank_sums in sums.items())
+        if isinstance(ft_tar_rank, str):
+            results = results[ft_tar_rank]
+    else:
+        raise ValueError('Invalid mode. Expected one of "f", "t", or "ft"')
     return results
 
 
-def common_hierarchical_analysis(db, df, annot_colname, samp_grps, hierarchical=True):
+def common_hierarchical_analysis(db, df, annot_colname, samp_grps, hierarchical=True, engine='hierarchy', workers=1):
     """
     Create hierarchies from original dataframe
 
@@ -78,16 +224,35 @@ def common_hierarchical_analysis(db, df, annot_colname, samp_grps, hierarchical=
     :param samp_grps: SampleGroups object
     :param hierarchical: False should be used in the case of COG, in which case it just adds up the intensities
     for each term
+    :param engine: either 'hierarchy', which builds an AnnotationHierarchy for each sample,
+    or 'matrix', which expands all samples at once using sparse matrix products
+    :param workers: with the 'hierarchy' engine, the number of processes used to build the sample hierarchies
     :return: DataFrame with summarised intensities and other quantitative measures
     """
     if hierarchical:
-        samp_annot = SampleAnnotations(db)
+        if engine == 'hierarchy':
+            samp_annot = SampleAnnotations(db, workers=workers)
+        elif engine == 'matrix':
+            samp_annot = SampleAnnotationMatrix(db)
+        else:
+            raise ValueError('Invalid engine. Expected one of "hierarchy" or "matrix"')
         # make a hierarchy for each sample
         samp_annot.add_samples_from_df(df, annot_colname, samp_grps)
         intensity_all_ranks = samp_annot.to_dataframe()
     else:
         intensity_all_ranks = df
+    return summarize_intensities(intensity_all_ranks, samp_grps)
 
+
+@profiling.timed('summarize')
+def summarize_intensities(intensity_all_ranks, samp_grps):
+    """
+    Calculate group means and log transform the aggregated intensities
+
+    :param intensity_all_ranks: DataFrame with the aggregated intensities of each term, which is the index
+    :param samp_grps: SampleGroups object
+    :return: DataFrame with log transformed intensities, group means, and an 'id' column
+    """
     # calculate means
     int_w_means = calc_means(intensity_all_ranks, samp_grps)
     # todo: calculate sds
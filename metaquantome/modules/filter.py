@@ -1,8 +1,19 @@
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+
 import metaquantome.util.expand_io as expand_io
 import metaquantome.util.stat_io as stat_io
 from metaquantome.classes.SampleGroups import SampleGroups
+from metaquantome.util import profiling
+
+# names of the filtering conditions, which are the keys of each configuration in a sweep
+FILTER_SETTINGS = ['qthreshold', 'min_child_non_leaf', 'min_child_nsamp', 'min_peptides', 'min_pep_nsamp']
 
 
+@profiling.timed('filter')
 def run_filter(expanded_file, sinfo, ontology, mode,
                qthreshold, min_child_non_leaf, min_child_nsamp, min_peptides,
                min_pep_nsamp, outfile=None):
@@ -27,22 +38,36 @@ def run_filter(expanded_file, sinfo, ontology, mode,
 
     # read in df
     df = stat_io.read_expanded_table(expanded_file, samp_grps)
+    return filter_expanded_table(df, samp_grps, ontology, mode, qthreshold=qthreshold,
+                                 min_child_non_leaf=min_child_non_leaf, min_child_nsamp=min_child_nsamp,
+                                 min_peptides=min_peptides, min_pep_nsamp=min_pep_nsamp, outfile=outfile)
+
+
+@profiling.timed('filter_table')
+def filter_expanded_table(df, samp_grps, ontology, mode, qthreshold, min_child_non_leaf, min_child_nsamp,
+                          min_peptides, min_pep_nsamp, outfile=None):
+    """
+    Filter an expanded dataframe that has already been read in (or passed on from expand, see
+    stat_io.expanded_to_table). See run_filter() for the filtering conditions.
 
-    # filter to a minimum number of observed intensities per group
-    samp_loc = samp_grps.grp_names.copy()
-
-    # get the columns for the first sample group
-    grp0 = samp_loc.pop(0)
-    keep = get_rows_to_keep(mode, df, grp0, samp_grps, qthreshold=qthreshold, min_child_non_leaf=min_child_non_leaf,
-                            min_child_nsamp=min_child_nsamp, min_peptides=min_peptides, min_pep_nsamp=min_pep_nsamp)
-
-    # now, iterate over the rest
-    while len(samp_loc) > 0:
-        grp_i = samp_loc.pop(0)
-        ith_keep = get_rows_to_keep(mode, df, grp_i, samp_grps, qthreshold=qthreshold,
-                                    min_child_non_leaf=min_child_non_leaf, min_child_nsamp=min_child_nsamp,
-                                    min_peptides=min_peptides, min_pep_nsamp=min_pep_nsamp)
-        keep &= ith_keep
+    :param df: expanded dataframe, as from stat_io.read_expanded_table(). missing values are represented as 0.
+    :param samp_grps: SampleGroups object
+    :param ontology: relevant for f and ft modes. Either 'go', 'ec', or 'cog'
+    :param mode: either 'f', 't', or 'ft'
+    :param qthreshold: minimum number of quantitations per grp
+    :param min_child_non_leaf: minimum number of children for terms that are not leaves
+    :param min_child_nsamp: minimum number of samples with sample children greater than min_child_non_leaf
+    :param min_peptides: minimum number of peptides for each term
+    :param min_pep_nsamp: minimum number of samples where the number of peptides has to be larger than
+    min_peptides
+    :param outfile: File to write to
+    :return: results dataframe
+    """
+    # the conditions have to be met in every sample group
+    arrays = build_filter_arrays(mode, df, samp_grps)
+    keep = get_rows_to_keep_all_groups(arrays, qthreshold=qthreshold, min_child_non_leaf=min_child_non_leaf,
+                                       min_child_nsamp=min_child_nsamp, min_peptides=min_peptides,
+                                       min_pep_nsamp=min_pep_nsamp)
     filtered_df = df.loc[keep].copy()
 
     # write out
@@ -52,6 +77,164 @@ def run_filter(expanded_file, sinfo, ontology, mode,
     return filtered_df
 
 
+@profiling.timed('filter_sweep')
+def run_filter_sweep(expanded_file, sinfo, ontology, mode, settings, outfile=None):
+    """
+    Filter the expanded dataframe with several configurations of the filtering conditions.
+    The file is read, and the intensity and count arrays are built, only once.
+
+    :param expanded_file: path to expanded file
+    :param sinfo: Path to experimental design file
+    :param ontology: relevant for f and ft modes. Either 'go', 'ec', or 'cog'
+    :param mode: either 'f', 't', or 'ft'
+    :param settings: list of dictionaries, each with the arguments of run_filter() named in FILTER_SETTINGS.
+    Can also be a JSON-formatted string or a path to a JSON file - see read_filter_settings
+    :param outfile: if provided, the result of the i-th configuration (starting at 1)
+    is written to the file name with '_i' added before the extension
+    :return: list of results dataframes, in the same order as settings
+    """
+    settings = read_filter_settings(settings)
+    samp_grps = SampleGroups(sinfo)
+    df = stat_io.read_expanded_table(expanded_file, samp_grps)
+    arrays = build_filter_arrays(mode, df, samp_grps)
+
+    cols = expand_io.define_outfile_cols_expand(samp_grps, ontology, mode)
+    outfile_stem, outfile_ext = os.path.splitext(outfile) if outfile else (None, None)
+    results = list()
+    for i, setting in enumerate(settings, start=1):
+        keep = get_rows_to_keep_all_groups(arrays, **setting)
+        filtered_df = df.loc[keep].copy()
+        logging.info('Filter configuration ' + str(i) + ' ' + json.dumps(setting) + ': ' +
+                     str(filtered_df.shape[0]) + ' of ' + str(df.shape[0]) + ' terms retained')
+        if outfile:
+            expand_io.write_out_general(filtered_df, outfile_stem + '_' + str(i) + outfile_ext, cols)
+        results.append(filtered_df)
+    return results
+
+
+def read_filter_settings(settings):
+    """
+    read and check the filtering configurations of a sweep
+
+    :param settings: a list of dictionaries, a JSON-formatted string, or a path to a JSON file. Each configuration
+    must have all of the keys in FILTER_SETTINGS
+    :return: list of dictionaries
+    """
+    if isinstance(settings, str):
+        if os.path.exists(settings):
+            with open(settings, 'r') as f:
+                settings = json.load(f)
+        else:
+            settings = json.loads(settings)
+    if isinstance(settings, dict):
+        settings = [settings]
+    for setting in settings:
+        missing = [name for name in FILTER_SETTINGS if name not in setting]
+        unknown = [name for name in setting if name not in FILTER_SETTINGS]
+        if missing or unknown:
+            raise ValueError('Each filter configuration must have exactly the keys ' + ', '.join(FILTER_SETTINGS) +
+                             '. Missing: ' + str(missing) + '. Unknown: ' + str(unknown))
+    return settings
+
+
+def build_filter_arrays(mode, df, samp_grps):
+    """
+    Convert the quantitative columns of the expanded dataframe to NumPy arrays, for
+    checking the filtering conditions of all sample groups at once.
+    Group membership is a (sample x group) indicator matrix, so that the number of samples
+    that satisfy a condition in each group is a matrix product.
+
+    :param mode: either 'f', 't', or 'ft'
+    :param df: data frame of functional and taxonomic terms. missing values are represented as 0.
+    :param samp_grps: SampleGroups() object
+    :return: dictionary with the arrays of intensities, number of peptides, and (except for 'ft')
+    number of sample children (terms x samples), the membership matrix (samples x groups),
+    and the number of samples in each group
+    """
+    samples = samp_grps.all_intcols
+    samp_index = {samp: i for i, samp in enumerate(samples)}
+    membership = np.zeros((len(samples), samp_grps.ngrps))
+    for j, grp in enumerate(samp_grps.grp_names):
+        membership[[samp_index[samp] for samp in samp_grps.sample_names[grp]], j] = 1
+    arrays = {'index': df.index,
+              'membership': membership,
+              'grp_sizes': membership.sum(axis=0),
+              'intensity': np.asarray(df[samples].values, dtype=np.float64),
+              'n_peptide': np.asarray(df[samp_grps.n_peptide_names_flat].values, dtype=np.float64),
+              'n_samp_children': None}
+    if mode != 'ft':
+        arrays['n_samp_children'] = np.asarray(df[samp_grps.samp_children_names_flat].values, dtype=np.float64)
+    return arrays
+
+
+def get_rows_to_keep_all_groups(arrays, qthreshold, min_child_non_leaf, min_child_nsamp, min_peptides,
+                                min_pep_nsamp):
+    """
+    Find the rows (taxonomic or functional terms) that satisfy all of the filtering conditions in every group
+
+    :param arrays: output of build_filter_arrays()
+    :param qthreshold: minimum number of quantitations per grp
+    :param min_child_non_leaf: minimum number of children for terms that are not leaves
+    :param min_child_nsamp: minimum number of samples with sample children greater than min_child_non_leaf
+    :param min_peptides: minimum number of peptides for each term
+    :param min_pep_nsamp: minimum number of samples where the number of peptides has to be larger than
+    min_peptides
+    :return: boolean Series with rows to keep as True
+    """
+    keep = get_group_masks(arrays, qthreshold=qthreshold, min_child_non_leaf=min_child_non_leaf,
+                           min_child_nsamp=min_child_nsamp, min_peptides=min_peptides,
+                           min_pep_nsamp=min_pep_nsamp).all(axis=1)
+    return pd.Series(keep, index=arrays['index'])
+
+
+def get_group_masks(arrays, qthreshold, min_child_non_leaf, min_child_nsamp, min_peptides, min_pep_nsamp):
+    """
+    Check the filtering conditions for all groups at once
+
+    :param arrays: output of build_filter_arrays()
+    :param qthreshold: see get_rows_to_keep_all_groups()
+    :param min_child_non_leaf: see get_rows_to_keep_all_groups()
+    :param min_child_nsamp: see get_rows_to_keep_all_groups()
+    :param min_peptides: see get_rows_to_keep_all_groups()
+    :param min_pep_nsamp: see get_rows_to_keep_all_groups()
+    :return: boolean array (terms x groups), True if the term satisfies all conditions in the group
+    """
+    membership = arrays['membership']
+    # intensity
+    keep = _count_per_group(arrays['intensity'] > 0, membership) >= qthreshold
+
+    # peptides
+    peptide_keep = arrays['n_peptide'] > min_peptides
+    keep &= _count_per_group(peptide_keep, membership) >= _nsamp_threshold(min_pep_nsamp, arrays['grp_sizes'])
+
+    # child non leaf
+    if arrays['n_samp_children'] is not None:
+        children = arrays['n_samp_children']
+        child_keep = (children >= min_child_non_leaf) | (children == 0)
+        keep &= _count_per_group(child_keep, membership) >= _nsamp_threshold(min_child_nsamp, arrays['grp_sizes'])
+    return keep
+
+
+def _count_per_group(mask, membership):
+    """
+    :param mask: boolean array (terms x samples)
+    :param membership: indicator matrix (samples x groups)
+    :return: number of samples in each group where mask is True (terms x groups)
+    """
+    return mask.astype(np.float64) @ membership
+
+
+def _nsamp_threshold(nsamp, grp_sizes):
+    """
+    :param nsamp: nonnegative integer or 'all'
+    :param grp_sizes: number of samples in each group
+    :return: minimum number of samples per group
+    """
+    if nsamp == "all":
+        return grp_sizes
+    return int(nsamp)
+
+
 def get_rows_to_keep(mode, df, grp, samp_grps, qthreshold, min_child_non_leaf, min_child_nsamp, min_peptides,
                      min_pep_nsamp):
     """
@@ -69,27 +252,7 @@ def get_rows_to_keep(mode, df, grp, samp_grps, qthreshold, min_child_non_leaf, m
     min_peptides
     :return: boolean Series with rows to keep as True
     """
-    # intensity
-    intcols = samp_grps.sample_names[grp]
-    keep_int = (df[intcols] > 0).apply(sum, axis=1) >= qthreshold
-
-    # peptides
-    peptide_cols = samp_grps.n_peptide_names_dict[grp]
-    peptide_keep_series = (df[peptide_cols] > min_peptides)
-    if min_pep_nsamp == "all":
-        keep_peptide = peptide_keep_series.all(axis=1)
-    else:
-        keep_peptide = peptide_keep_series.apply(sum, axis=1) >= int(min_pep_nsamp)
-
-    if mode != 'ft':
-        # child non leaf
-        child_cols = samp_grps.samp_children_names_dict[grp]
-        child_keep_series = (df[child_cols] >= min_child_non_leaf) | (df[child_cols] == 0)
-        if min_child_nsamp == "all":
-            keep_child = child_keep_series.all(axis=1)
-        else:
-            keep_child = child_keep_series.apply(sum, axis=1) >= int(min_child_nsamp)
-        all_keep = keep_int & keep_child & keep_peptide
-    else:
-        all_keep = keep_int & keep_peptide
-    return all_keep
+    arrays = build_filter_arrays(mode, df, samp_grps)
+    keep = get_group_masks(arrays, qthreshold=qthreshold, min_child_non_leaf=min_child_non_leaf,
+                           min_child_nsamp=min_child_nsamp, min_peptides=min_peptides, min_pep_nsamp=min_pep_nsamp)
+    return pd.Series(keep[:, samp_grps.grp_names.index(grp)], index=df.index)
@@ -1,13 +1,20 @@
+from collections import OrderedDict
 import numpy as np
+import pandas as pd
 
 import metaquantome.modules.expand
 from metaquantome.util import utils
 from metaquantome.modules import functional_analysis as fa
-from metaquantome.databases.NCBITaxonomyDb import NCBITaxonomyDb
+from metaquantome.modules import taxonomy_analysis as ta
+from metaquantome.util import profiling
+from metaquantome.databases.NCBITaxonomyDb import NUMERIC_RANK
+
+# column with the taxon at the target rank
+DES_RANK_COLNAME = 'des_rank'
 
 
 def function_taxonomy_analysis(df, func_colname, pep_colname, ontology, slim_down, tax_colname, samp_grps, ft_tar_rank,
-                               data_dir):
+                               data_dir, databases=None):
     # todo: add normalization module for ft modules
     # choose bp, cc, or mf
     # don't return bp, cc, or mf themselves
@@ -28,59 +35,166 @@ def function_taxonomy_analysis(df, func_colname, pep_colname, ontology, slim_dow
     :param slim_down: whether to map full GO terms to metagenomics slim GO terms
     :param tax_colname: name of LCA column in dataframe.
     :param samp_grps: a SampleGroups object for this modules
-    :param ft_tar_rank: rank at which to group taxonomy. Default is 'genus'
+    :param ft_tar_rank: rank at which to group taxonomy. Default is 'genus'. May also be a list of ranks,
+    in which case steps 1-5 and the lineages of the taxa are shared by all ranks
     :param data_dir: data directory
-    :return: dataframe with taxon-function pairs and their associated total intensity
+    :param databases: ReferenceDatabases object with loaded databases to reuse. If None, the databases are loaded
+    :return: dataframe with taxon-function pairs and their associated total intensity. If ft_tar_rank is a list,
+    a dictionary of the form {rank: dataframe, ...}
     """
     # ---- arg checks ---- #
     # ontology must be go
     if ontology != 'go':
         ValueError('ontology must be "go" for function-taxonomy modules')
 
+    # ---- load databases ---- #
+    godb = fa.load_function_db(data_dir, ontology, slim_down, databases=databases)
+    # load ncbi database
+    ncbi = ta.load_taxonomy_db(data_dir, databases=databases)
+
+    dedup_df = clean_function_taxonomy_df(godb, ncbi, df, func_colname, ontology, slim_down, tax_colname,
+                                          ft_tar_rank)
+    if isinstance(ft_tar_rank, str):
+        ints_and_counts = sum_function_taxonomy_df(dedup_df, func_colname, samp_grps)
+        return describe_function_taxonomy_results(godb, ncbi, ints_and_counts, func_colname, samp_grps)
+    results = OrderedDict()
+    for rank, colname in des_rank_colnames(ft_tar_rank).items():
+        ints_and_counts = sum_function_taxonomy_df(dedup_df, func_colname, samp_grps, des_rank_colname=colname)
+        results[rank] = describe_function_taxonomy_results(godb, ncbi, ints_and_counts, func_colname, samp_grps)
+    return results
+
+
+def des_rank_colnames(ft_tar_rank):
+    """
+    name the columns with the taxa at the target ranks
+
+    :param ft_tar_rank: a rank, or a list of ranks
+    :return: OrderedDict of the form {rank: column name, ...}, in the order of the ranks.
+    For a single rank, the column is 'des_rank';
+    for a list of ranks, 'des_rank_<rank>'
+    """
+    if isinstance(ft_tar_rank, str):
+        ranks = [ft_tar_rank]
+    else:
+        ranks = list(OrderedDict.fromkeys(ft_tar_rank))
+    for rank in ranks:
+        if rank not in NUMERIC_RANK.keys():
+            raise ValueError('Unknown rank ' + str(rank) + '. Expected one of ' + ', '.join(NUMERIC_RANK.keys()))
+    if isinstance(ft_tar_rank, str):
+        return OrderedDict([(ft_tar_rank, DES_RANK_COLNAME)])
+    return OrderedDict((rank, DES_RANK_COLNAME + '_' + rank) for rank in ranks)
+
+
+@profiling.timed('clean')
+def clean_function_taxonomy_df(godb, ncbi, df, func_colname, ontology, slim_down, tax_colname, ft_tar_rank,
+                               seen_pairs=None):
+    """
+    Steps 1-6 of function_taxonomy_analysis(): normalize the functional terms and
+    map each taxon to the target rank
+
+    :param godb: GeneOntologyDb object
+    :param ncbi: NCBITaxonomyDb object
+    :param df: joined taxonomy, intensity, and function tables
+    :param func_colname: name of function column in dataframe
+    :param ontology: name of functional ontology. must be 'go'
+    :param slim_down: whether to map full GO terms to metagenomics slim GO terms
+    :param tax_colname: name of LCA column in dataframe.
+    :param ft_tar_rank: rank at which to group taxonomy, or a list of ranks
+    :param seen_pairs: when the peptides are read in chunks, the set of (peptide, GO term) pairs in earlier chunks.
+    These pairs are dropped as duplicates, and the pairs in df are added to the set.
+    :return: dataframe with one GO term per row, and the taxon at the target rank in the 'des_rank' column.
+    For a list of ranks, the taxa are in a column for each rank (see des_rank_colnames()), which is 0 for
+    peptides that are less specific than that rank, and only peptides that are less specific than all
+    the ranks are dropped
+    """
     # ---- reduce, normalize, (optionally) slim ---- #
-    godb, norm_df = fa.clean_function_df(data_dir, df, func_colname, ontology, slim_down)
+    norm_df = fa.normalize_function_df(godb, df, func_colname, ontology)
     if slim_down:
         norm_df = fa.slim_down_df(godb, norm_df, func_colname)
     # remove peptide/go-term duplicates (in the case that different GO term annotations
     # for the same peptide are mapped to the same slim GO term)
-    # index is named peptide
-    dedup_df = norm_df.\
-        reset_index().\
-        drop_duplicates(subset=['peptide', func_colname], keep='first').\
-        set_index('peptide')
+    is_dup = pd.MultiIndex.from_arrays([norm_df.index, norm_df[func_colname]]).duplicated(keep='first')
+    dedup_df = norm_df.loc[~is_dup]
+    if seen_pairs is not None:
+        pairs = list(zip(dedup_df.index, dedup_df[func_colname]))
+        is_new = [pair not in seen_pairs for pair in pairs]
+        seen_pairs.update(pairs)
+        dedup_df = dedup_df.loc[is_new]
     # ---- get rank of lca ----- #
-    # resolve data dir
-    if not data_dir:
-        data_dir = utils.DATA_DIR
-    # load ncbi database
-    ncbi = NCBITaxonomyDb(data_dir)
     # see if names. if so, convert to taxid
     if utils.sniff_tax_names(df, tax_colname):
-        dedup_df[tax_colname] = ncbi.convert_name_to_taxid(dedup_df[tax_colname].tolist())
+        taxids = pd.Series(ncbi.convert_name_to_taxid(dedup_df[tax_colname].tolist()), index=dedup_df.index)
     else:
-        dedup_df[tax_colname] = [int(x) for x in dedup_df[tax_colname]]
-    # filter df to those that tax ids that non-NaN and are present in NCBI database
-    is_not_nan = dedup_df[tax_colname].notnull()
-    is_in_db = dedup_df[tax_colname].apply(ncbi.is_in_db)
-    dedup_df = dedup_df.loc[is_not_nan & is_in_db]
+        taxids = dedup_df[tax_colname].astype(np.int64)
+    dedup_df = dedup_df.assign(**{tax_colname: taxids.values})
 
-    dedup_df['des_rank'] = dedup_df[tax_colname].apply(lambda x: des_rank_mapper(ft_tar_rank, x, ncbi))
+    # map each distinct taxon to the target ranks at once, with a lookup table from taxid to target taxid.
+    # as in des_rank_mapper(), taxa that are less specific than the target rank are mapped to 0,
+    # and so are missing taxa and taxa that are not in the NCBI database (which are left out of des_rank_map)
+    colnames = des_rank_colnames(ft_tar_rank)
+    des_rank_map = ncbi.map_ids_to_desired_ranks(list(colnames.keys()), taxids.unique())
+    des_ranks = dict()
+    for rank, colname in colnames.items():
+        des_rank_lookup = pd.Series({tid: ranks.get(rank, 0) for tid, ranks in des_rank_map.items()},
+                                    dtype=np.int64)
+        des_ranks[colname] = taxids.map(des_rank_lookup).fillna(0).astype(np.int64).values
     # filter out peptides that are less specific than query rank (which have a taxid of 0)
-    dedup_df = dedup_df[dedup_df['des_rank'] > 0]
-
-    # ---- group by go and new des_rank column, then sum intensity ---- #
-    # select columns for adding purposes
-    df_int = dedup_df[samp_grps.all_intcols + [func_colname, 'des_rank']]
-    # do counts
-    df_counts = df_int.copy()
-    df_counts.loc[:, samp_grps.all_intcols] = df_counts.loc[:, samp_grps.all_intcols] > 0
-    # group by both cog and lca and add
-    grouped = df_int.groupby(by=[func_colname, 'des_rank']).sum()
-    # get groupwise counts (i.e., unique peptides)
-    # multiply by 1 to convert any single booleans (True) to 1
-    counts = df_counts.groupby(by=[func_colname, 'des_rank']).sum() * 1
-    ints_and_counts = grouped.join(counts, rsuffix='_n_peptide')
+    is_mapped = np.logical_or.reduce([des_rank > 0 for des_rank in des_ranks.values()])
+    dedup_df = dedup_df.loc[is_mapped].assign(**{colname: des_rank[is_mapped]
+                                                 for colname, des_rank in des_ranks.items()})
+    return dedup_df
+
+
+@profiling.timed('sum')
+def sum_function_taxonomy_df(dedup_df, func_colname, samp_grps, des_rank_colname=DES_RANK_COLNAME):
+    """
+    Step 7 of function_taxonomy_analysis(): group by GO term and taxon, and add up
+    the intensities and the number of peptides.
+    The sums of separate chunks of peptides can be added up again with add_function_taxonomy_sums()
+
+    :param dedup_df: dataframe from clean_function_taxonomy_df()
+    :param func_colname: name of function column in dataframe
+    :param samp_grps: a SampleGroups object for this modules
+    :param des_rank_colname: column with the taxa at the target rank (see des_rank_colnames()).
+    Peptides with a taxon of 0 in this column are left out
+    :return: dataframe of summed intensities and number of peptides, indexed by GO term and taxon ('des_rank')
+    """
+    # ---- group by go and new des_rank column, then sum intensities and counts together ---- #
+    is_mapped = (dedup_df[des_rank_colname] > 0).values
+    ints = dedup_df.loc[is_mapped, samp_grps.all_intcols]
+    # groupwise counts of peptides with positive intensity (i.e., unique peptides)
+    counts = (ints > 0).astype(np.int64).add_suffix('_n_peptide')
+    keys = [dedup_df[func_colname].values[is_mapped], dedup_df[des_rank_colname].values[is_mapped]]
+    ints_and_counts = pd.concat([ints, counts], axis=1).groupby(by=keys).sum()
+    ints_and_counts.index.names = [func_colname, DES_RANK_COLNAME]
+    return ints_and_counts
+
+
+def add_function_taxonomy_sums(sums, chunk_sums):
+    """
+    Add the sums of a chunk of peptides (from sum_function_taxonomy_df()) to the running sums
+
+    :param sums: running sums, or None for the first chunk
+    :param chunk_sums: sums for a chunk of peptides
+    :return: dataframe of summed intensities and number of peptides, indexed by GO term and taxon
+    """
+    if sums is None:
+        return chunk_sums
+    return pd.concat([sums, chunk_sums]).groupby(level=[0, 1]).sum()
+
+
+@profiling.timed('describe')
+def describe_function_taxonomy_results(godb, ncbi, ints_and_counts, func_colname, samp_grps):
+    """
+    Calculate group means, log transform, and add the GO term and taxon descriptions
 
+    :param godb: GeneOntologyDb object
+    :param ncbi: NCBITaxonomyDb object
+    :param ints_and_counts: dataframe from sum_function_taxonomy_df()
+    :param func_colname: name of function column in dataframe
+    :param samp_grps: a SampleGroups object for this modules
+    :return: dataframe with taxon-function pairs and their associated total intensity
+    """
     # ---- output prep ---- #
     # calculate group means
     results = metaquantome.modules.expand.calc_means(ints_and_counts, samp_grps)
@@ -98,7 +212,8 @@ def function_taxonomy_analysis(df, func_colname, pep_colname, ontology, slim_dow
     taxids = results['des_rank']
     # get ranks
     results['tax_id'] = taxids
-    results['rank'] = [ncbi.get_rank(int(elem)) for elem in taxids]
+    ranks = ncbi.get_ranks(taxids.unique())
+    results['rank'] = [ranks[int(elem)] for elem in taxids]
     results['taxon_name'] = ncbi.convert_taxid_to_name(taxids)
     # drop des_rank column
     results.drop('des_rank', axis=1, inplace=True)
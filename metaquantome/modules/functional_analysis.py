@@ -1,12 +1,16 @@
+import pandas as pd
+
 import metaquantome.modules.expand
 import metaquantome.util.utils
 from metaquantome.databases.GeneOntologyDb import GeneOntologyDb
 from metaquantome.databases.cog import cogCat
 import metaquantome.databases.EnzymeDb as ec
 from metaquantome.util import utils
+from metaquantome.util import profiling
 
 
-def functional_analysis(df, func_colname, samp_grps, ontology, slim_down, data_dir):
+def functional_analysis(df, func_colname, samp_grps, ontology, slim_down, data_dir, engine='hierarchy', workers=1,
+                        databases=None):
     """
     Expand functional terms and aggregate intensities.
 
@@ -17,42 +21,85 @@ def functional_analysis(df, func_colname, samp_grps, ontology, slim_down, data_d
     :param ontology: Functional ontology. Either 'go', 'ec', or 'cog'
     :param slim_down: Boolean. Whether to map terms to slim or not.
     :param data_dir: Directory to contain functional database files (ex. go-basic.obo)
+    :param engine: Expansion engine, either 'hierarchy' or 'matrix'. See common_hierarchical_analysis()
+    :param workers: Number of processes for the 'hierarchy' engine. See common_hierarchical_analysis()
+    :param databases: ReferenceDatabases object with loaded databases to reuse. If None, the database is loaded
     :return: A dataframe with a functional term and its associated sample-specific intensity in each
     row
     """
-    db, norm_df = clean_function_df(data_dir, df, func_colname, ontology, slim_down)
+    db, norm_df = clean_function_df(data_dir, df, func_colname, ontology, slim_down, databases=databases)
 
-    if ontology == "go":
-        # filter to only those in full GO and non-missing
-        df_clean = utils.filter_df(db, func_colname, norm_df)
-        if slim_down:
-            # map full GO terms to slims
-            df_clean = slim_down_df(db, df_clean, func_colname)
+    if ontology in {"go", "ec"}:
+        # filter to only those in the database and non-missing, and (optionally) map to slims
+        df_clean = filter_function_df(db, norm_df, func_colname, ontology, slim_down)
         # expand
         results = metaquantome.modules.expand.\
-            common_hierarchical_analysis(db, df_clean, func_colname, samp_grps)
-        gos = [db.gofull[x] for x in results['id']]
-        results['name'] = [x.name for x in gos]
-        results['namespace'] = [x.namespace for x in gos]
-    elif ontology == "ec":
-        # filter to only those in Enzyme database and non-missing
-        df_clean = utils.filter_df(db, func_colname, norm_df)
-        results = metaquantome.modules.expand.\
-            common_hierarchical_analysis(db, df_clean, func_colname, samp_grps)
-        # use ec database to get term descriptions
-        results['description'] = [db.ecdb[term]['descript'] for term in results.index]
+            common_hierarchical_analysis(db, df_clean, func_colname, samp_grps, engine=engine,
+                                         workers=workers)
     elif ontology == "cog":
-        cog_sum_df = norm_df[[func_colname] + samp_grps.all_intcols].\
-            groupby(func_colname).\
-            sum()
+        cog_sum_df = sum_cog_df(norm_df, func_colname, samp_grps)
         results = metaquantome.modules.expand.\
             common_hierarchical_analysis('cog', cog_sum_df, func_colname, samp_grps,
                                          hierarchical=False)
-        results['description'] = [cogCat[x] for x in results.index]
     else:
         raise ValueError("the desired ontology is not supported. " +
                          "Please use either GO (ontology = 'go'), " +
                          "COG (ontology = 'cog'), or EC numbers (ontology = 'ec')")
+    return describe_function_results(db, results, ontology)
+
+
+@profiling.timed('clean')
+def filter_function_df(db, norm_df, func_colname, ontology, slim_down):
+    """
+    Filter a normalized dataframe (one term per row) to terms in the database,
+    and map full GO terms to slims if desired
+    :param db: The GO or EC database
+    :param norm_df: DataFrame with one functional term per row
+    :param func_colname: Name of column with functional terms
+    :param ontology: Either 'go' or 'ec'
+    :param slim_down: Map full GO terms to the metagenomics slim. Applies for GO only.
+    :return: DataFrame ready for expansion
+    """
+    # filter to only those in the database and non-missing
+    df_clean = utils.filter_df(db, func_colname, norm_df)
+    if ontology == "go" and slim_down:
+        # map full GO terms to slims
+        df_clean = slim_down_df(db, df_clean, func_colname)
+    return df_clean
+
+
+@profiling.timed('sum')
+def sum_cog_df(norm_df, func_colname, samp_grps):
+    """
+    COG categories are not hierarchical, so the intensities are just added up for each category
+    :param norm_df: DataFrame with one COG category per row
+    :param func_colname: Name of column with COG categories
+    :param samp_grps: A SampleGroups() object.
+    :return: DataFrame with the summed intensities, indexed by COG category
+    """
+    return norm_df[[func_colname] + samp_grps.all_intcols].\
+        groupby(func_colname).\
+        sum()
+
+
+@profiling.timed('describe')
+def describe_function_results(db, results, ontology):
+    """
+    Add the names and namespaces of GO terms, or descriptions of EC numbers and COG categories
+    :param db: The GO or EC database (None for COG)
+    :param results: expanded DataFrame with an 'id' column
+    :param ontology: Either 'go', 'ec', or 'cog'
+    :return: results, with the description columns
+    """
+    if ontology == "go":
+        gos = [db.gofull[x] for x in results['id']]
+        results['name'] = [x.name for x in gos]
+        results['namespace'] = [x.namespace for x in gos]
+    elif ontology == "ec":
+        # use ec database to get term descriptions
+        results['description'] = [db.ecdb[term]['descript'] for term in results.index]
+    elif ontology == "cog":
+        results['description'] = [cogCat[x] for x in results.index]
     return results
 
 
@@ -78,7 +125,7 @@ def slim_down_df(godb, df_clean, go_colname):
     return df_loc
 
 
-def clean_function_df(data_dir, df, func_colname, ontology, slim_down):
+def clean_function_df(data_dir, df, func_colname, ontology, slim_down, databases=None):
     """
     make functional terms nonredundant and normalize dataframe so there's only one functional
     term per row
@@ -88,18 +135,50 @@ def clean_function_df(data_dir, df, func_colname, ontology, slim_down):
     :param func_colname: Name of column with functional terms
     :param ontology: Desired ontology.
     :param slim_down: Map full GO terms to the metagenomics slim. Applies for GO only.
+    :param databases: ReferenceDatabases object with loaded databases to reuse. If None, the database is loaded
     :return: A tuple of the database and the dataframe with one functional term in each row.
     """
+    db = load_function_db(data_dir, ontology, slim_down, databases=databases)
+    norm_df = normalize_function_df(db, df, func_colname, ontology)
+    return db, norm_df
+
+
+@profiling.timed('load_db')
+def load_function_db(data_dir, ontology, slim_down, databases=None):
+    """
+    load the database for the specified ontology
+    :param data_dir: directory to contain the database files for specified ontology
+    :param ontology: Desired ontology.
+    :param slim_down: Map full GO terms to the metagenomics slim. Applies for GO only.
+    :param databases: ReferenceDatabases object. If provided, its (already loaded) database is returned
+    :return: GeneOntologyDb or EnzymeDb object, or None for COG
+    """
+    if databases is not None:
+        return databases.function_db(data_dir, ontology, slim_down)
     # db data dir
     if not data_dir:
         data_dir = utils.DATA_DIR
     # assign db
     db = None
+    if ontology == "go":
+        db = GeneOntologyDb(data_dir, slim_down)
+    elif ontology == "ec":
+        db = ec.EnzymeDb(data_dir)
+    return db
+
+
+def normalize_function_df(db, df, func_colname, ontology):
+    """
+    make functional terms nonredundant and normalize dataframe so there's only one functional
+    term per row
+    :param db: The GO or EC database (None for COG), which may be wrapped in a ClosureCache
+    :param df: DataFrame. May have multiple functional terms per row. Missing values
+    should be 0
+    :param func_colname: Name of column with functional terms
+    :param ontology: Desired ontology.
+    :return: dataframe with one functional term in each row.
+    """
     if ontology in {"go", "ec"}:
-        if ontology == "go":
-            db = GeneOntologyDb(data_dir, slim_down)
-        elif ontology == "ec":
-            db = ec.EnzymeDb(data_dir)
         # reduce df to non-redundant functional terms
         # todo: add sep to args (if desired at some point)
         red_df = metaquantome.util.utils.reduce_func_df(db=db, df=df, func_colname=func_colname, sep=',')
@@ -107,4 +186,24 @@ def clean_function_df(data_dir, df, func_colname, ontology, slim_down):
         red_df = df
     # normalize df, so each row has one functional term
     norm_df = utils.tidy_split(red_df, column=func_colname, sep=',')
-    return db, norm_df
+    return norm_df
+
+
+def split_function_df(db, df, func_colname, ontology):
+    """
+    make functional terms nonredundant, and split them into a dataframe with one functional term per row.
+    Unlike normalize_function_df(), the intensities are not repeated for each term; instead, each term
+    has the row position of its peptide within df (see utils.split_terms())
+    :param db: The GO or EC database (None for COG), which may be wrapped in a ClosureCache
+    :param df: DataFrame. May have multiple functional terms per row. Missing values
+    should be 0
+    :param func_colname: Name of column with functional terms
+    :param ontology: Desired ontology.
+    :return: dataframe with the functional term column and the utils.PEPTIDE_ROW_COLNAME column
+    """
+    if ontology in {"go", "ec"}:
+        red_df = metaquantome.util.utils.reduce_func_df(db=db, df=df, func_colname=func_colname, sep=',')
+    else:
+        red_df = df
+    positions, terms = utils.split_terms(red_df[func_colname], sep=',')
+    return pd.DataFrame({func_colname: terms, utils.PEPTIDE_ROW_COLNAME: positions})
@@ -0,0 +1,28 @@
+import importlib
+
+# environment variable with the path to the socket of a running server.
+# If it is set, the command line submits expand, filter, stat, and run jobs to the server
+SOCKET_ENV = 'METAQUANTOME_SOCKET'
+
+# jobs that the command line and the server run:
+# {name: (module, function name, whether the function uses the reference databases)}.
+# The modules are only imported when a job is run, so that other commands do not load them
+JOBS = {'expand': ('metaquantome.modules.expand', 'expand', True),
+        'filter': ('metaquantome.modules.filter', 'run_filter', False),
+        'filter_sweep': ('metaquantome.modules.filter', 'run_filter_sweep', False),
+        'stat': ('metaquantome.modules.stat', 'stat', False),
+        'run': ('metaquantome.modules.pipeline', 'run_pipeline', True)}
+
+
+def load_job(command):
+    """
+    import the function that runs a job
+
+    :param command: name of the job, one of JOBS
+    :return: tuple of the function, and whether it uses the reference databases
+    """
+    if command not in JOBS:
+        raise ValueError('Unknown job ' + str(command) + '. Expected one of ' + ', '.join(JOBS))
+    module_name, func_name, uses_databases = JOBS[command]
+    func = getattr(importlib.import_module(module_name), func_name)
+    return func, uses_databases
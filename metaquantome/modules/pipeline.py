@@ -0,0 +1,116 @@
+import json
+import os
+
+from metaquantome.classes.SampleGroups import SampleGroups
+from metaquantome.modules.expand import expand
+from metaquantome.modules.filter import filter_expanded_table
+from metaquantome.modules.stat import stat_table
+from metaquantome.util import profiling
+from metaquantome.util.stat_io import expanded_to_table
+
+# stages of the pipeline, in the order they are run
+PIPELINE_STAGES = ['expand', 'filter', 'stat']
+
+
+def run_pipeline(config, databases=None):
+    """
+    Run expand, and optionally filter and stat, in a single process.
+    The results of each stage are passed on to the next as dataframes, rather than
+    written to and read from files, and each reference database is loaded once (by expand).
+    Only the outputs with an 'outfile' in the configuration are written.
+    Each stage is profiled as the command of the same name (see metaquantome.util.profiling), and
+    the profile is logged at the end, whether or not profiling was enabled.
+
+    The configuration has the keys 'samps', 'mode', 'ontology' (for 'f' and 'ft' modes), and
+    optionally 'data_dir', which are shared by all stages, and a dictionary of arguments for each stage:
+    'expand' (required), 'filter', and 'stat'. The stage arguments are the keyword arguments of
+    expand(), filter_expanded_table(), and stat_table(), without the shared arguments. For example:
+
+    {"samps": {"s1": ["int1", "int2"], "s2": ["int3", "int4"]}, "mode": "f", "ontology": "go",
+     "expand": {"int_file": "int.tab", "pep_colname_int": "peptide", "func_file": "go.tab",
+                "pep_colname_func": "peptide", "pep_colname_tax": "peptide", "func_colname": "go"},
+     "filter": {"qthreshold": 2, "min_child_non_leaf": 0, "min_child_nsamp": 0, "min_peptides": 0,
+                "min_pep_nsamp": 0, "outfile": "filtered.tab"},
+     "stat": {"control_group": "s2", "paired": false, "parametric": true, "outfile": "stat.tab"}}
+
+    :param config: dictionary, JSON-formatted string, or path to a JSON file with the configuration
+    :param databases: ReferenceDatabases object with loaded databases to reuse. If None, expand loads the databases
+    :return: tuple of a dictionary with the results dataframe of each stage that was run, and
+    a list of dictionaries with the wall time and peak memory of each stage that was run
+    """
+    config = read_pipeline_config(config)
+    sinfo = config['samps']
+    if isinstance(sinfo, dict):
+        sinfo = json.dumps(sinfo)
+    mode = config['mode']
+    ontology = config.get('ontology')
+    data_dir = config.get('data_dir')
+    samp_grps = SampleGroups(sinfo)
+
+    # the stages are always profiled, so that their wall time and peak memory are reported,
+    # and are part of the current profile if the pipeline is run with profiling enabled
+    with profiling.profile_run(enabled=not profiling.PROFILER.enabled):
+        parent = '/'.join(profiling.PROFILER.stack)
+        results = dict()
+
+        # expand
+        with profiling.stage('expand'):
+            expand_args = dict(config['expand'])
+            expanded = expand(mode, sinfo, data_dir=data_dir, ontology=ontology, databases=databases,
+                              **expand_args)
+            table = expanded_to_table(expanded, samp_grps, ontology, mode)
+            results['expand'] = expanded
+
+        # filter
+        if 'filter' in config:
+            with profiling.stage('filter'):
+                filter_args = dict(config['filter'])
+                filtered = filter_expanded_table(table, samp_grps, ontology, mode, **filter_args)
+                # as if the filtered table was read from a file
+                table = filtered.reset_index(drop=True)
+                results['filter'] = filtered
+
+        # stat
+        if 'stat' in config:
+            with profiling.stage('stat'):
+                stat_args = dict(config['stat'])
+                stat_args.setdefault('outfile', None)
+                results['stat'] = stat_table(table, samp_grps, ontology=ontology, mode=mode, **stat_args)
+
+    reports = list()
+    for stage in PIPELINE_STAGES:
+        if stage in results:
+            record = profiling.PROFILER.stages[parent + '/' + stage]
+            reports.append({'stage': stage, 'seconds': record['seconds'], 'peak_memory_mb': record['peak_memory_mb']})
+    return results, reports
+
+
+def read_pipeline_config(config):
+    """
+    read and check the pipeline configuration
+
+    :param config: dictionary, JSON-formatted string, or path to a JSON file
+    :return: dictionary
+    """
+    if isinstance(config, str):
+        if os.path.exists(config):
+            with open(config, 'r') as f:
+                config = json.load(f)
+        else:
+            config = json.loads(config)
+    for key in ['samps', 'mode', 'expand']:
+        if key not in config:
+            raise ValueError('The pipeline configuration must have the key "' + key + '"')
+    shared = {'samps', 'mode', 'ontology', 'data_dir'}
+    unknown = [key for key in config if key not in shared and key not in PIPELINE_STAGES]
+    if unknown:
+        raise ValueError('Unknown keys in the pipeline configuration: ' + str(unknown))
+    for stage in PIPELINE_STAGES:
+        repeated = shared.intersection(config.get(stage, dict()))
+        if repeated:
+            raise ValueError('The ' + stage + ' arguments ' + str(sorted(repeated)) + ' are shared by all stages ' +
+                             'and must be given at the top level of the pipeline configuration')
+    if not isinstance(config['expand'].get('ft_tar_rank', 'genus'), str):
+        raise ValueError('The pipeline takes a single ft_tar_rank. Use metaquantome expand for several ranks')
+    return config
+
@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import stat as file_stat
+import time
+import traceback
+
+from metaquantome.databases.ReferenceDatabases import ReferenceDatabases, PRELOAD_NAMES
+from metaquantome.modules.jobs import load_job
+
+
+class JobServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """
+    Long-running server that keeps the reference databases loaded and runs jobs sent to a Unix socket.
+    Each job runs in a process forked from the server, so jobs run concurrently and share the
+    loaded databases (and any memory mapped closure indexes) with the server, without copying them.
+    """
+    def __init__(self, socket_path, databases):
+        """
+        Create JobServer object and bind the socket
+
+        :param socket_path: path of the Unix socket
+        :param databases: ReferenceDatabases object, usually with preloaded databases
+        """
+        self.databases = databases
+        super().__init__(socket_path, JobHandler)
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    Runs a single job, in a forked process. The request is a line of JSON with the job name ('command'),
+    its keyword arguments ('args'), and the working directory of the client ('cwd'). The reply is
+    a line of JSON; see run_job_request().
+    """
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode())
+        reply = run_job_request(self.server.databases, request)
+        self.wfile.write((json.dumps(reply) + '\n').encode())
+
+
+def run_job_request(databases, request):
+    """
+    Run a job in the current (forked) process
+
+    :param databases: ReferenceDatabases object
+    :param request: dictionary with 'command' (one of metaquantome.modules.jobs.JOBS), 'args', and 'cwd'
+    :return: dictionary with 'status', which is 'ok' or 'error', and either the wall time of the job
+    ('seconds') or the traceback of the error ('message')
+    """
+    start = time.perf_counter()
+    try:
+        func, uses_databases = load_job(request['command'])
+        kwargs = dict(request['args'])
+        if uses_databases:
+            kwargs['databases'] = databases
+        # relative paths are relative to the client's working directory
+        os.chdir(request['cwd'])
+        databases.reconnect()
+        func(**kwargs)
+    except Exception:
+        logging.error('Job ' + str(request.get('command')) + ' failed')
+        return {'status': 'error', 'message': traceback.format_exc()}
+    seconds = time.perf_counter() - start
+    logging.info('Job ' + request['command'] + ' finished in ' + '{:.2f}'.format(seconds) + ' s')
+    return {'status': 'ok', 'seconds': seconds}
+
+
+def serve(socket_path, data_dir=None, preload=PRELOAD_NAMES):
+    """
+    Load the reference databases and run jobs sent to socket_path until interrupted
+
+    :param socket_path: path of the Unix socket. A stale socket at this path is replaced
+    :param data_dir: data directory of the preloaded databases. Jobs can still use other data directories,
+    but those databases are loaded by each job
+    :param preload: databases to load before accepting jobs, from ReferenceDatabases.PRELOAD_NAMES
+    :return: None
+    """
+    databases = ReferenceDatabases()
+    databases.preload(data_dir, preload)
+    if os.path.exists(socket_path) and file_stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        os.remove(socket_path)
+    server = JobServer(socket_path, databases)
+    # stop on SIGTERM as on Ctrl-C, so that the socket is removed
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+    logging.info('metaquantome server listening on ' + socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def _exit_on_signal(signum, frame):
+    """
+    signal handler that exits the server
+
+    :param signum: signal number
+    :param frame: current stack frame
+    :return: None
+    """
+    raise SystemExit(0)
+
+
+def submit(socket_path, command, args):
+    """
+    Send a job to a running server and wait for it to finish
+
+    :param socket_path: path of the server's Unix socket
+    :param command: one of metaquantome.modules.jobs.JOBS
+    :param args: keyword arguments of the job. Must be JSON serializable
+    :return: the server's reply (see run_job_request()). Raises RuntimeError if the job failed,
+    or if the server is not running or the job process exited without replying
+    """
+    request = {'command': command, 'args': args, 'cwd': os.getcwd()}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall((json.dumps(request) + '\n').encode())
+            with sock.makefile('r') as f:
+                line = f.readline()
+    except OSError as e:
+        raise RuntimeError('Could not run the ' + command + ' job on the metaquantome server at ' +
+                           socket_path + ': ' + str(e))
+    if not line:
+        # the job process exited without replying, e.g. it was killed
+        raise RuntimeError('The ' + command + ' job on the metaquantome server at ' + socket_path +
+                           ' ended without a reply')
+    reply = json.loads(line)
+    if reply['status'] != 'ok':
+        raise RuntimeError('The ' + command + ' job failed on the metaquantome server at ' + socket_path +
+                           ':\n' + reply['message'])
+    return reply
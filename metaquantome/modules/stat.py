@@ -1,15 +1,24 @@
+import json
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import pandas as pd
+import scipy
 from scipy import stats as sps
+from scipy import special
 from statsmodels.sandbox.stats import multicomp as mc
 
 from metaquantome.classes.SampleGroups import SampleGroups
 from metaquantome.util.utils import P_COLNAME, P_CORR_COLNAME
 from metaquantome.util.stat_io import read_expanded_table, write_stat
+from metaquantome.util import profiling
 
 
-def stat(infile, sinfo, paired, parametric, ontology, mode, outfile, control_group):
+@profiling.timed('stat')
+def stat(infile, sinfo, paired, parametric, ontology, mode, outfile, control_group, workers=1):
     """
-    Module function that tests differential expression between 2 experimental conditions
+    Module function that tests differential expression between each experimental condition and the control
 
     :param infile: path to filtered file
     :param sinfo: path to experimental design file or JSON string
@@ -18,6 +27,8 @@ def stat(infile, sinfo, paired, parametric, ontology, mode, outfile, control_gro
     :param ontology: for function, is either 'go', 'ec', or 'cog'
     :param mode: 't', 'f', or 'taxf'
     :param outfile: path to write to
+    :param control_group: name of the control sample group. Every other group is compared to it
+    :param workers: number of threads used to test the contrasts (case vs. control groups) in parallel
     :return: original dataframe with p value and fold change columns appended
     """
 
@@ -26,49 +37,101 @@ def stat(infile, sinfo, paired, parametric, ontology, mode, outfile, control_gro
 
     # read in
     df = read_expanded_table(infile, samp_grps)
+    return stat_table(df, samp_grps, paired, parametric, ontology, mode, outfile, control_group, workers=workers)
 
-    #if samp_grps.ngrps != 2:
-    #    raise ValueError('testing is only available for 2 experimental conditions.')
-    
+
+@profiling.timed('test')
+def stat_table(df, samp_grps, paired, parametric, ontology, mode, outfile, control_group, workers=1):
+    """
+    Test differential expression in an expanded (and usually filtered) dataframe that has already been read in.
+    See stat() for the parameters.
+
+    :param df: expanded dataframe, as from read_expanded_table(). missing values are represented as 0.
+    :param samp_grps: SampleGroups object
+    :return: original dataframe with p value and fold change columns appended
+    """
     ###################
     # Addition by Praveen to enable pairwise stat while inputting multiple sample groups
     ###################
     ctrl_grp = control_group
     if ctrl_grp not in samp_grps.grp_names:
         raise ValueError('Control sample group incorrect/missing.')
-    #    print(samp_grps.grp_names)
-    
-    df_test = df.copy()
-    
-    case_grps = samp_grps.grp_names
-    ctrl_grp = ctrl_grp
-    case_grps.remove(ctrl_grp)
-    fc_new_cols = []
-    for each_case in case_grps:
-        tmp_samp_json = '{"'+str(each_case.strip())+'":'+str(samp_grps.sample_names[each_case]).replace("'","\"")+', "'+ str(ctrl_grp.strip()) +'":'+str(samp_grps.sample_names[str(ctrl_grp.strip())]).replace("'","\"")+'}'
-        tmp_samp_grps = SampleGroups(tmp_samp_json)
-        
-        # run test for each pair of groups
-        df_tmp = test_norm_intensity(df, tmp_samp_grps, paired, parametric)
-        
-        df_test[tmp_samp_grps.fc_name] = df_tmp[tmp_samp_grps.fc_name].tolist()
-        df_test[P_COLNAME+"_"+tmp_samp_grps.fc_name.replace("log2fc_","")] = df_tmp[P_COLNAME+"_"+tmp_samp_grps.fc_name.replace("log2fc_","")].tolist()
-        df_test[P_CORR_COLNAME+"_"+tmp_samp_grps.fc_name.replace("log2fc_","")] = df_tmp[P_CORR_COLNAME+"_"+tmp_samp_grps.fc_name.replace("log2fc_","")].tolist()
-        
-        fc_new_cols = fc_new_cols + [tmp_samp_grps.fc_name, P_COLNAME+"_"+tmp_samp_grps.fc_name.replace("log2fc_",""), P_CORR_COLNAME+"_"+tmp_samp_grps.fc_name.replace("log2fc_","")]
-    ###################
-    
-    # run test
-    #df_test = test_norm_intensity(df, samp_grps, paired, parametric)
-    
+
+    case_grps = [grp for grp in samp_grps.grp_names if grp != ctrl_grp]
+    contrasts = [define_contrast(samp_grps, each_case, ctrl_grp) for each_case in case_grps]
+
+    # all contrasts are tested on the same matrix of intensities, with missing values (0) as NaN
+    intensities = df[samp_grps.all_intcols].values.astype(np.float64)
+    intensities[intensities == 0] = np.nan
+    col_index = {samp: i for i, samp in enumerate(samp_grps.all_intcols)}
+    means = df[samp_grps.mean_names].replace(0, np.nan)
+
+    def run_contrast(contrast_grps):
+        return test_contrast(intensities, col_index, means, contrast_grps, paired, parametric)
+
+    if workers > 1 and len(contrasts) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            contrast_results = list(executor.map(run_contrast, contrasts))
+    else:
+        contrast_results = [run_contrast(contrast_grps) for contrast_grps in contrasts]
+
+    # fold change, p value, and corrected p value columns of all contrasts, added at once
+    new_cols = OrderedDict()
+    for result in contrast_results:
+        new_cols.update(result)
+    fc_new_cols = list(new_cols.keys())
+    new_df = pd.DataFrame(new_cols, index=df.index, columns=fc_new_cols)
+    df_test = pd.concat([df, new_df], axis=1)
+
     # write out
     if outfile:
-        #write_stat(df_test, samp_grps=samp_grps, ontology=ontology, mode=mode, outfile=outfile)
-        write_stat(df_tmp, samp_grps=samp_grps, ontology=ontology, mode=mode, outfile=outfile, fc_new_cols=fc_new_cols)
+        # missing values in the original columns are written as NA
+        df_out = pd.concat([df.replace(0, np.nan), new_df], axis=1)
+        write_stat(df_out, samp_grps=samp_grps, ontology=ontology, mode=mode, outfile=outfile, fc_new_cols=fc_new_cols)
     # return
     return df_test
 
 
+def define_contrast(samp_grps, case_grp, ctrl_grp):
+    """
+    Define the SampleGroups of a single case vs. control comparison
+
+    :param samp_grps: SampleGroups object with all groups
+    :param case_grp: name of the case group
+    :param ctrl_grp: name of the control group
+    :return: SampleGroups object with the case group first and the control group second,
+    so that the fold change is case over control
+    """
+    contrast = OrderedDict([(case_grp.strip(), samp_grps.sample_names[case_grp]),
+                            (ctrl_grp.strip(), samp_grps.sample_names[ctrl_grp.strip()])])
+    return SampleGroups(json.dumps(contrast))
+
+
+def test_contrast(intensities, col_index, means, contrast_grps, paired, parametric):
+    """
+    Fold change and test of a single comparison between two sample groups
+
+    :param intensities: 2d array of intensities of all samples, missing values are NaN
+    :param col_index: dictionary of the form {sample name: column in intensities}
+    :param means: dataframe with the group means (log2), missing values are NaN
+    :param contrast_grps: SampleGroups object with the two groups to compare
+    :param paired: whether or not to use a paired test
+    :param parametric: Whether or not to use a parametric test
+    :return: ordered dictionary with the fold change, p value, and corrected p value columns
+    """
+    grp1, grp2 = contrast_grps.grp_names
+    grp1_values = intensities[:, [col_index[samp] for samp in contrast_grps.sample_names[grp1]]]
+    grp2_values = intensities[:, [col_index[samp] for samp in contrast_grps.sample_names[grp2]]]
+    test_results = two_group_test(grp1_values, grp2_values, paired, parametric)
+    contrast_name = contrast_grps.fc_name.replace("log2fc_", "")
+    # the log has already been taken, so the L2FC is the difference in means
+    fold_change = (means[contrast_grps.mean_names[0]] - means[contrast_grps.mean_names[1]]).values
+    return OrderedDict([(contrast_grps.fc_name, fold_change),
+                        (P_COLNAME + "_" + contrast_name, test_results),
+                        # fdr correction
+                        (P_CORR_COLNAME + "_" + contrast_name, mc.fdrcorrection0(test_results, method='indep')[1])])
+
+
 def test_norm_intensity(df, samp_grps, paired, parametric):
     """
     run t-tests (or nonparametric tests) on dataframe.
@@ -78,49 +141,22 @@ def test_norm_intensity(df, samp_grps, paired, parametric):
     :param parametric: Whether or not to use a parametric test
     :return: dataframe with appended pvalue columns
     """
-
-    grp1_intcols = samp_grps.sample_names[samp_grps.grp_names[0]]
-    grp2_intcols = samp_grps.sample_names[samp_grps.grp_names[1]]
-
     # change any zeros back to NaN
     df.replace(0, np.nan, inplace=True)
 
-    # make copy, so df isn't changed by this function
-    test_df = df.copy()
-
-    # test, using logged df
-    if parametric:
-        # don't need to split into paired/unpaired, because both are available in ttest_ind
-        test_results = test_df.apply(lambda x: sps.stats.ttest_ind(x[grp1_intcols].dropna(),
-                                                                   x[grp2_intcols].dropna(),
-                                                                   equal_var=paired).pvalue,
-                                     axis=1)
-    else:
-        if paired:
-            # wilcoxon is non-parametric equivalent of paired t-test
-            test_results = test_df.apply(lambda x: sps.wilcoxon(x[grp1_intcols].dropna(),
-                                                                x[grp2_intcols].dropna()).pvalue,
-                                         axis=1)
-        else:
-            # rank sum test is nonparametric equivalent of unpaired t-test
-            test_results = test_df.apply(lambda x: sps.ranksums(x[grp1_intcols].dropna(),
-                                                                x[grp2_intcols].dropna()).pvalue,
-                                         axis=1)
-
-    # append fold changes to df
-    df_means = log2_fold_change(df, samp_grps)
+    # test, using logged df. the tests are computed for all rows at once,
+    # using the (term x sample) matrix of each group with NaN for missing values
+    intensities = np.asarray(df[samp_grps.all_intcols].values, dtype=np.float64)
+    col_index = {samp: i for i, samp in enumerate(samp_grps.all_intcols)}
+    results = test_contrast(intensities, col_index, df[samp_grps.mean_names], samp_grps, paired, parametric)
 
-    # p values, uncorrected for multiple comparisons
-    #df_means[P_COLNAME] = test_results
-    df_means[P_COLNAME+"_"+samp_grps.fc_name.replace("log2fc_","")] = test_results
-
-    # fdr correction
-    #df_means[P_CORR_COLNAME] = mc.fdrcorrection0(test_results, method='indep')[1]
-    df_means[P_CORR_COLNAME+"_"+samp_grps.fc_name.replace("log2fc_","")] = mc.fdrcorrection0(test_results, method='indep')[1]
+    # append fold change and p values (uncorrected and corrected for multiple comparisons) to df
+    for colname, values in results.items():
+        df[colname] = values
 
     # reset the index to be 'id' - this is mostly for testing, and doesn't affect the output file
-    df_means.set_index('id', drop=False, inplace=True)
-    return df_means
+    df.set_index('id', drop=False, inplace=True)
+    return df
 
 
 def log2_fold_change(df, samp_grps):
@@ -137,3 +173,207 @@ def log2_fold_change(df, samp_grps):
     mean2 = samp_grps.mean_names[1]
     df[samp_grps.fc_name] = df[mean1] - df[mean2]
     return df
+
+
+def two_group_test(grp1_values, grp2_values, paired, parametric):
+    """
+    Test each row of two groups of samples. Gives the same p-values as calling the scipy test on the non-missing
+    values of each row: ttest_ind (with equal_var=paired) if parametric, otherwise wilcoxon if paired,
+    or ranksums if not paired. Regular rows are tested at once with numpy, and the remaining rows
+    (for example, with too few values for the vectorized formulas) are tested with scipy, one at a time.
+
+    :param grp1_values: 2d array of intensities in the first group, with NaN for missing values
+    :param grp2_values: 2d array of intensities in the second group, with NaN for missing values
+    :param paired: whether or not to use a paired test
+    :param parametric: whether or not to use a parametric test
+    :return: array of p-values, one for each row
+    """
+    if parametric:
+        pvalues, is_done = ttest_rows(grp1_values, grp2_values, equal_var=paired)
+    elif paired:
+        pvalues, is_done = signed_rank_rows(grp1_values, grp2_values)
+    else:
+        pvalues, is_done = rank_sum_rows(grp1_values, grp2_values)
+    for i in np.flatnonzero(~is_done):
+        pvalues[i] = scipy_row_test(grp1_values[i], grp2_values[i], paired, parametric)
+    return pvalues
+
+
+def scipy_row_test(grp1_row, grp2_row, paired, parametric):
+    """
+    Test a single row with scipy, after dropping missing values
+
+    :param grp1_row: 1d array of intensities in the first group
+    :param grp2_row: 1d array of intensities in the second group
+    :param paired: whether or not to use a paired test
+    :param parametric: whether or not to use a parametric test
+    :return: p-value
+    """
+    x = grp1_row[~np.isnan(grp1_row)]
+    y = grp2_row[~np.isnan(grp2_row)]
+    if parametric:
+        # don't need to split into paired/unpaired, because both are available in ttest_ind
+        return sps.ttest_ind(x, y, equal_var=paired).pvalue
+    elif paired:
+        # wilcoxon is non-parametric equivalent of paired t-test
+        return sps.wilcoxon(x, y).pvalue
+    else:
+        # rank sum test is nonparametric equivalent of unpaired t-test
+        return sps.ranksums(x, y).pvalue
+
+
+def ttest_rows(grp1_values, grp2_values, equal_var):
+    """
+    Student's (equal_var=True) or Welch's t-test for each row, as in scipy.stats.ttest_ind
+
+    :param grp1_values: 2d array of intensities in the first group, with NaN for missing values
+    :param grp2_values: 2d array of intensities in the second group, with NaN for missing values
+    :param equal_var: whether to assume equal variances
+    :return: tuple of the array of p-values, and a boolean array of the rows that were tested.
+    Rows with less than two values in either group are not tested.
+    """
+    n1, m1, v1 = masked_mean_var(grp1_values)
+    n2, m2, v2 = masked_mean_var(grp2_values)
+    is_done = (n1 >= 2) & (n2 >= 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if equal_var:
+            df = n1 + n2 - 2.0
+            svar = ((n1 - 1) * v1 + (n2 - 1) * v2) / df
+            denom = np.sqrt(svar * (1.0 / n1 + 1.0 / n2))
+        else:
+            vn1 = v1 / n1
+            vn2 = v2 / n2
+            df = (vn1 + vn2)**2 / (vn1**2 / (n1 - 1) + vn2**2 / (n2 - 1))
+            # if df is undefined, the variances are zero, and df doesn't matter
+            df = np.where(np.isnan(df), 1, df)
+            denom = np.sqrt(vn1 + vn2)
+        t = np.divide(m1 - m2, denom)
+        pvalues = special.stdtr(df, -np.abs(t)) * 2
+    return np.where(is_done, pvalues, np.nan), is_done
+
+
+def masked_mean_var(values):
+    """
+    Number of non-missing values, mean, and sample variance (ddof=1) of each row
+
+    :param values: 2d array with NaN for missing values
+    :return: tuple of arrays (n, mean, variance)
+    """
+    is_obs = ~np.isnan(values)
+    n = is_obs.sum(axis=1).astype(np.float64)
+    filled = np.where(is_obs, values, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = filled.sum(axis=1) / n
+        sq_dev = np.where(is_obs, (values - mean[:, np.newaxis])**2, 0)
+        var = sq_dev.sum(axis=1) / n * (n / (n - 1))
+    return n, mean, var
+
+
+def rank_sum_rows(grp1_values, grp2_values):
+    """
+    Wilcoxon rank-sum test for each row, as in scipy.stats.ranksums
+
+    :param grp1_values: 2d array of intensities in the first group, with NaN for missing values
+    :param grp2_values: 2d array of intensities in the second group, with NaN for missing values
+    :return: tuple of the array of p-values, and a boolean array of the rows that were tested.
+    Rows without any values in either group are not tested.
+    """
+    is_obs1 = ~np.isnan(grp1_values)
+    n1 = is_obs1.sum(axis=1).astype(np.float64)
+    n2 = (~np.isnan(grp2_values)).sum(axis=1).astype(np.float64)
+    is_done = (n1 >= 1) & (n2 >= 1)
+    # missing values are ranked last, so the ranks of the observed values are the same as without them
+    all_values = np.hstack([grp1_values, grp2_values])
+    ranks = average_ranks(np.where(np.isnan(all_values), np.inf, all_values))
+    s = np.where(is_obs1, ranks[:, :grp1_values.shape[1]], 0).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = n1 * (n1 + n2 + 1) / 2.0
+        z = (s - expected) / np.sqrt(n1 * n2 * (n1 + n2 + 1) / 12.0)
+    pvalues = 2 * sps.norm.sf(np.abs(z))
+    return np.where(is_done, pvalues, np.nan), is_done
+
+
+def average_ranks(values):
+    """
+    Rank the values in each row, giving tied values the average of their ranks
+    (as in scipy.stats.rankdata with method='average', but for all rows at once)
+
+    :param values: 2d array
+    :return: 2d array of ranks, starting at 1
+    """
+    n_cols = values.shape[1]
+    order = np.argsort(values, axis=1, kind='mergesort')
+    sorted_values = np.take_along_axis(values, order, axis=1)
+    positions = np.broadcast_to(np.arange(n_cols), values.shape)
+    # first and last position of each run of tied values
+    is_first = np.ones(values.shape, dtype=bool)
+    is_first[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    is_last = np.ones(values.shape, dtype=bool)
+    is_last[:, :-1] = is_first[:, 1:]
+    first = np.maximum.accumulate(np.where(is_first, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(is_last, positions, n_cols)[:, ::-1], axis=1)[:, ::-1]
+    ranks = np.empty(values.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2.0 + 1, axis=1)
+    return ranks
+
+
+def wilcoxon_exact_max(scipy_version):
+    """
+    largest number of pairs for which scipy.stats.wilcoxon uses the exact distribution by default
+
+    :param scipy_version: scipy version string, e.g. '1.8.1'
+    :return: number of pairs. 0 if the normal approximation is always used
+    """
+    major, minor = [int(re.match(r'\d*', part).group() or 0) for part in (scipy_version.split('.') + ['0'])[:2]]
+    if (major, minor) >= (1, 9):
+        return 50
+    if (major, minor) >= (1, 3):
+        return 25
+    return 0
+
+
+# rows of the signed-rank test with more pairs are tested with scipy, which uses the normal approximation
+WILCOXON_EXACT_MAX = wilcoxon_exact_max(scipy.__version__)
+
+
+def signed_rank_rows(grp1_values, grp2_values, exact_max=None):
+    """
+    Wilcoxon signed-rank test for each row, as in scipy.stats.wilcoxon with the exact distribution.
+    Only rows without missing values, zero differences, or tied differences,
+    and with at most exact_max pairs, are tested (other rows use the normal approximation in scipy).
+
+    :param grp1_values: 2d array of intensities in the first group, with NaN for missing values
+    :param grp2_values: 2d array of intensities in the second group, with NaN for missing values
+    :param exact_max: largest number of pairs for the exact test, at most 50. If None, the cutoff of the
+    installed scipy is used (see wilcoxon_exact_max()), so that the p-values are the same as with scipy
+    :return: tuple of the array of p-values, and a boolean array of the rows that were tested
+    """
+    if exact_max is None:
+        exact_max = WILCOXON_EXACT_MAX
+    n_rows = grp1_values.shape[0]
+    pvalues = np.full(n_rows, np.nan)
+    count = grp1_values.shape[1]
+    if count != grp2_values.shape[1] or count == 0 or count > min(exact_max, 50):
+        return pvalues, np.zeros(n_rows, dtype=bool)
+    d = grp1_values - grp2_values
+    abs_d = np.sort(np.abs(d), axis=1)
+    has_ties = (np.diff(abs_d, axis=1) == 0).any(axis=1)
+    is_done = ~np.isnan(d).any(axis=1) & ~(d == 0).any(axis=1) & ~has_ties
+    # without ties, the ranks of |d| are 1..count
+    ranks = np.argsort(np.argsort(np.abs(d), axis=1), axis=1) + 1
+    r_plus = np.where(d > 0, ranks, 0).sum(axis=1)
+
+    # exact null distribution of r_plus, which is exact in floating point for count <= 50
+    counts = np.zeros(count * (count + 1) // 2 + 1)
+    counts[0] = 1
+    for k in range(1, count + 1):
+        counts[k:] = counts[k:] + counts[:-k].copy()
+    pmf = counts / 2.0**count
+    cdf = np.cumsum(pmf)
+    sf = np.cumsum(pmf[::-1])[::-1]
+    r_plus = np.where(is_done, r_plus, 0)
+    p_two_sided = np.clip(2 * np.minimum(cdf[r_plus], sf[r_plus]), 0, 1)
+    # r_plus in the center of the distribution
+    p_two_sided[r_plus == (len(pmf) - 1) // 2] = 1.0
+    pvalues[is_done] = p_two_sided[is_done]
+    return pvalues, is_done
@@ -1,9 +1,10 @@
 import metaquantome.modules.expand
 from metaquantome.databases.NCBITaxonomyDb import NCBITaxonomyDb, BASIC_TAXONOMY_TREE
-from metaquantome.util.utils import filter_df, DATA_DIR, sniff_tax_names
+from metaquantome.util.utils import DATA_DIR, sniff_tax_names
+from metaquantome.util import profiling
 
 
-def taxonomy_analysis(df, samp_grps, data_dir, tax_colname='lca'):
+def taxonomy_analysis(df, samp_grps, data_dir, tax_colname='lca', engine='hierarchy', workers=1, databases=None):
     """
     Expand taxonomy annotations
 
@@ -11,14 +12,47 @@ def taxonomy_analysis(df, samp_grps, data_dir, tax_colname='lca'):
     :param samp_grps: SampleGroups object
     :param data_dir: parent directory for the taxonomy database
     :param tax_colname: column with taxonomic annotations
+    :param engine: Expansion engine, either 'hierarchy' or 'matrix'. See common_hierarchical_analysis()
+    :param workers: Number of processes for the 'hierarchy' engine. See common_hierarchical_analysis()
+    :param databases: ReferenceDatabases object with loaded databases to reuse. If None, the database is loaded
     :return: dataframe with taxa and intensities
     """
+    # load ncbi database from data dir
+    ncbi = load_taxonomy_db(data_dir, databases=databases)
+
+    df_clean = clean_taxonomy_df(ncbi, df, tax_colname)
+    results = metaquantome.modules.expand.common_hierarchical_analysis(ncbi, df_clean, tax_colname, samp_grps,
+                                                                       engine=engine, workers=workers)
+    return describe_taxonomy_results(ncbi, results)
+
+
+@profiling.timed('load_db')
+def load_taxonomy_db(data_dir, databases=None):
+    """
+    load the NCBI taxonomy database
+
+    :param data_dir: parent directory for the taxonomy database. If None, the default data directory is used
+    :param databases: ReferenceDatabases object. If provided, its (already loaded) database is returned
+    :return: NCBITaxonomyDb object
+    """
+    if databases is not None:
+        return databases.taxonomy_db(data_dir)
     # if data_dir is not provided, we define the default
     if not data_dir:
         data_dir = DATA_DIR
-    # load ncbi database from data dir
-    ncbi = NCBITaxonomyDb(data_dir)
+    return NCBITaxonomyDb(data_dir)
+
 
+@profiling.timed('clean')
+def clean_taxonomy_df(ncbi, df, tax_colname):
+    """
+    Convert taxon names to NCBI taxids (if necessary) and drop taxa that are not in the database
+
+    :param ncbi: NCBITaxonomyDb object
+    :param df: joined dataframe
+    :param tax_colname: column with taxonomic annotations
+    :return: dataframe with integer taxids, ready for expansion
+    """
     # check for numeric characters, which indicates taxid
     # if is name, convert to taxid
     # keep as character until querying ncbi database
@@ -27,11 +61,27 @@ def taxonomy_analysis(df, samp_grps, data_dir, tax_colname='lca'):
     else:
         df[tax_colname] = [int(x) for x in df[tax_colname]]
     # filter df to those that tax ids that non-NaN and are present in NCBI database
-    df_clean = filter_df(ncbi, tax_colname, df)
-    results = metaquantome.modules.expand.common_hierarchical_analysis(ncbi, df_clean, tax_colname, samp_grps)
+    # (one query for the whole column, rather than one per row as in filter_df)
+    is_not_nan = ~df[tax_colname].isnull()
+    is_in_db = ncbi.are_in_db(df[tax_colname])
+    df_clean = df.loc[is_not_nan & is_in_db].copy(deep=True)
+    # load ranks and ancestors of all taxa in bulk, before expanding one term at a time
+    ncbi.prefetch(df_clean[tax_colname].unique())
+    return df_clean
 
+
+@profiling.timed('describe')
+def describe_taxonomy_results(ncbi, results):
+    """
+    Add the rank and name of each taxon, and drop ranks that are not in the basic taxonomy tree
+
+    :param ncbi: NCBITaxonomyDb object
+    :param results: expanded dataframe with an 'id' column
+    :return: filtered results, with rank and taxon_name columns
+    """
     # use the database to get the rank for each NCBI id number
-    results['rank'] = results['id'].apply(ncbi.get_rank)
+    ranks = ncbi.get_ranks(results['id'])
+    results['rank'] = [ranks[taxid] for taxid in results['id']]
 
     # filter out any ranks that are not in the basic taxonomy tree
     is_right_rank = results['rank'].isin(BASIC_TAXONOMY_TREE)
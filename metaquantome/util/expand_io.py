@@ -1,9 +1,15 @@
+import os
 import pandas as pd
 
 from metaquantome.util.check_args import function_check, tax_check
 from metaquantome.util.utils import MISSING_VALUES
+from metaquantome.util import profiling
 
+# columnar formats for the expand, filter, and stat outputs, by file extension
+COLUMNAR_FORMATS = {'.parquet': 'parquet', '.feather': 'feather', '.arrow': 'feather'}
 
+
+@profiling.timed('read')
 def read_and_join_files(mode, pep_colname_int, pep_colname_func, pep_colname_tax, samp_grps, int_file, tax_file=None,
                         func_file=None, func_colname=None, tax_colname=None):
     """
@@ -24,9 +30,57 @@ def read_and_join_files(mode, pep_colname_int, pep_colname_func, pep_colname_tax
 
     # intensity
     int = read_intensity_table(int_file, samp_grps, pep_colname_int)
+    annotations = read_annotation_tables(mode, pep_colname_func, pep_colname_tax, tax_file=tax_file,
+                                         func_file=func_file, func_colname=func_colname, tax_colname=tax_colname)
+    # join all
+    dfs_joined = join_on_peptide([int] + annotations)
+    dfs_joined.index.name = 'peptide'
+    return dfs_joined
+
+
+def read_and_join_files_chunks(mode, pep_colname_int, pep_colname_func, pep_colname_tax, samp_grps, int_file,
+                               chunksize, tax_file=None, func_file=None, func_colname=None, tax_colname=None):
+    """
+    Like read_and_join_files, but the intensity file is read in chunks of rows.
+    The function and/or taxonomy files (one annotation per peptide) are read in full,
+    and each chunk of intensities is joined to them on the peptide column.
+
+    :param mode: analysis mode - either 'f', 't', or 'ft'
+    :param pep_colname_int: name of the peptide column in the intensity file
+    :param pep_colname_func: name of the peptide column in the function file
+    :param pep_colname_tax: name of the peptide column in the taxonomy file
+    :param samp_grps: SampleGroups() object
+    :param int_file: path to intensity file
+    :param chunksize: number of rows of the intensity file in each chunk
+    :param tax_file: path to taxonomy file. required for 't' and 'ft' modes
+    :param func_file: path to function file. required for 'f' and 'ft' modes
+    :param func_colname: column name of functional annotation in function file
+    :param tax_colname: column name of taxonomic annotation in taxonomy file
+    :return: generator of joined dataframes; missing intensities as 0.
+    """
+    annotations = read_annotation_tables(mode, pep_colname_func, pep_colname_tax, tax_file=tax_file,
+                                         func_file=func_file, func_colname=func_colname, tax_colname=tax_colname)
+    for int in read_intensity_table_chunks(int_file, samp_grps, pep_colname_int, chunksize):
+        dfs_joined = join_on_peptide([int] + annotations)
+        dfs_joined.index.name = 'peptide'
+        yield dfs_joined
+
+
+def read_annotation_tables(mode, pep_colname_func, pep_colname_tax, tax_file=None, func_file=None,
+                           func_colname=None, tax_colname=None):
+    """
+    Reads in the function and/or taxonomy files required by the analysis mode
 
-    # start df list
-    dfs = [int]
+    :param mode: analysis mode - either 'f', 't', or 'ft'
+    :param pep_colname_func: name of the peptide column in the function file
+    :param pep_colname_tax: name of the peptide column in the taxonomy file
+    :param tax_file: path to taxonomy file. required for 't' and 'ft' modes
+    :param func_file: path to function file. required for 'f' and 'ft' modes
+    :param func_colname: column name of functional annotation in function file
+    :param tax_colname: column name of taxonomic annotation in taxonomy file
+    :return: list of annotation dataframes, indexed by peptide
+    """
+    dfs = list()
     if mode == 't' or mode == 'ft':
         tax_check(tax_file, tax_colname)
         tax = read_taxonomy_table(tax_file, pep_colname_tax, tax_colname)
@@ -35,10 +89,7 @@ def read_and_join_files(mode, pep_colname_int, pep_colname_func, pep_colname_tax
         function_check(func_file, func_colname)
         func = read_function_table(func_file, pep_colname_func, func_colname)
         dfs.append(func)
-    # join all
-    dfs_joined = join_on_peptide(dfs)
-    dfs_joined.index.name = 'peptide'
-    return dfs_joined
+    return dfs
 
 
 def read_intensity_table(file, samp_grps, pep_colname_int):
@@ -55,6 +106,37 @@ def read_intensity_table(file, samp_grps, pep_colname_int):
                        dtype=samp_grps.dict_numeric_cols,
                        na_values=MISSING_VALUES,
                        low_memory=False)
+    return clean_intensity_table(df, samp_grps)
+
+
+def read_intensity_table_chunks(file, samp_grps, pep_colname_int, chunksize):
+    """
+    read the file containing peptide intensities in chunks of rows, so that
+    the whole table never has to be in memory.
+
+    :param file: path to intensity file. must be tab-separated
+    :param samp_grps: SampleGroups object
+    :param pep_colname_int: name of peptide column in intensity table
+    :param chunksize: number of rows in each chunk
+    :return: generator of intensity tables (as in read_intensity_table); missing values as 0
+    """
+    reader = pd.read_table(file, sep="\t", index_col=pep_colname_int,
+                           dtype=samp_grps.dict_numeric_cols,
+                           na_values=MISSING_VALUES,
+                           chunksize=chunksize)
+    for df in reader:
+        yield clean_intensity_table(df, samp_grps)
+
+
+def clean_intensity_table(df, samp_grps):
+    """
+    select the intensity columns, drop peptides without any intensities,
+    and set the remaining missing intensities to 0
+
+    :param df: intensity table, as read from file
+    :param samp_grps: SampleGroups object
+    :return: intensity table; missing values as 0
+    """
     # only intcols (in case table has extra cols)
     int_df = df.loc[:, samp_grps.all_intcols]
 
@@ -120,6 +202,7 @@ def join_on_peptide(dfs):
     return df_all
 
 
+@profiling.timed('read')
 def read_nopep_table(file, mode, samp_grps, func_colname=None, tax_colname=None):
     """
     Read in a pre-joined table (rather than 3 separate tables)
@@ -138,6 +221,43 @@ def read_nopep_table(file, mode, samp_grps, func_colname=None, tax_colname=None)
                        dtype=newdict,
                        na_values=MISSING_VALUES,
                        low_memory=False)
+    return clean_nopep_table(df, mode, samp_grps, func_colname, tax_colname)
+
+
+def read_nopep_table_chunks(file, mode, samp_grps, chunksize, func_colname=None, tax_colname=None):
+    """
+    Read in a pre-joined table (rather than 3 separate tables) in chunks of rows
+
+    :param file: file with intensity and functional or taxonomic terms
+    :param mode: f, tax, or ft
+    :param samp_grps: SampleGroups() object
+    :param chunksize: number of rows in each chunk
+    :param func_colname: name of column with functional terms
+    :param tax_colname: name of column with taxonomic annotations
+    :return: generator of dataframes, missing values as 0
+    """
+    newdict = samp_grps.dict_numeric_cols.copy()
+    newdict[func_colname] = object
+    newdict[tax_colname] = object
+    reader = pd.read_table(file, sep="\t",
+                           dtype=newdict,
+                           na_values=MISSING_VALUES,
+                           chunksize=chunksize)
+    for df in reader:
+        yield clean_nopep_table(df, mode, samp_grps, func_colname, tax_colname)
+
+
+def clean_nopep_table(df, mode, samp_grps, func_colname=None, tax_colname=None):
+    """
+    set missing intensities to 0 and drop rows without annotations
+
+    :param df: pre-joined table, as read from file
+    :param mode: f, tax, or ft
+    :param samp_grps: SampleGroups() object
+    :param func_colname: name of column with functional terms
+    :param tax_colname: name of column with taxonomic annotations
+    :return: dataframe, missing values as 0
+    """
     # change remaining missing intensities to 0, for arithmetic (changed back to NA for export)
     values = {x: 0 for x in samp_grps.all_intcols}
     df.fillna(values, inplace=True)
@@ -155,23 +275,57 @@ def read_nopep_table(file, mode, samp_grps, func_colname=None, tax_colname=None)
     return df
 
 
+def table_format(file):
+    """
+    Choose the format of an expanded (or filtered, or tested) table from the file extension
+
+    :param file: path to file
+    :return: 'parquet' or 'feather' for the columnar formats (see COLUMNAR_FORMATS), otherwise 'tsv'
+    """
+    extension = os.path.splitext(str(file))[1].lower()
+    return COLUMNAR_FORMATS.get(extension, 'tsv')
+
+
+def define_ft_rank_outfile(outfile, rank):
+    """
+    name the output file of one target rank, when ft mode is run with several ranks
+
+    :param outfile: output file given for all ranks
+    :param rank: target rank
+    :return: outfile with '_<rank>' added before the extension, e.g. 'ft_genus.tab' for 'ft.tab'
+    """
+    root, ext = os.path.splitext(outfile)
+    return root + '_' + rank + ext
+
+
+@profiling.timed('write')
 def write_out_general(df, outfile, cols):
     """
     Write a pandas dataframe as a tab-separated file.
     Keeps header, does not write index; missing
-    values are represented as NA
+    values are represented as NA.
+    If the file extension is one of COLUMNAR_FORMATS, the dataframe is instead written
+    in that format (which requires pyarrow), keeping the column types and missing values as NaN.
 
     :param df: dataframe
     :param outfile: path to output file
     :param cols: columns to be written, in desired order
     :return: None
     """
-    df.to_csv(outfile,
-              columns=cols,
-              sep="\t",
-              header=True,
-              index=False,
-              na_rep="NA")
+    fmt = table_format(outfile)
+    if fmt == 'tsv':
+        df.to_csv(outfile,
+                  columns=cols,
+                  sep="\t",
+                  header=True,
+                  index=False,
+                  na_rep="NA")
+    else:
+        out = df[cols].reset_index(drop=True)
+        if fmt == 'parquet':
+            out.to_parquet(outfile, index=False)
+        else:
+            out.to_feather(outfile)
 
 
 def define_outfile_cols_expand(samp_grps, ontology, mode):
@@ -0,0 +1,175 @@
+import cProfile
+import json
+import logging
+import resource
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+
+class Profiler:
+    """
+    Collects the wall time and peak memory of each stage of a run, and counters of database
+    lookups and cache hits, when profiling is enabled (>metaquantome <command> --profile).
+
+    Stages are nested: a stage started within another is recorded as '<outer>/<inner>'. A stage started
+    within a stage of the same name (e.g., the pipeline's expand stage, which calls expand()) is part of the outer one.
+    Each stage may run several times (e.g., once per chunk), in which case its calls and times are added up.
+    Work done in worker processes (expand --workers) is not included.
+    """
+    def __init__(self):
+        self.enabled = False
+        # {stage: {'calls': int, 'seconds': float, 'peak_memory_mb': float}}, in the order the stages started
+        self.stages = OrderedDict()
+        self.counters = dict()
+        self.stack = list()
+
+    def reset(self):
+        """
+        forget all stages and counters
+
+        :return: None
+        """
+        self.stages = OrderedDict()
+        self.counters = dict()
+        self.stack = list()
+
+
+# the profiler used by stage(), timed(), and count()
+PROFILER = Profiler()
+
+
+@contextmanager
+def stage(name):
+    """
+    Context manager that records the wall time and the peak memory at the end of a stage.
+    Does nothing unless profiling is enabled.
+
+    :param name: name of the stage
+    :return: None
+    """
+    if not PROFILER.enabled or PROFILER.stack[-1:] == [name]:
+        yield
+        return
+    PROFILER.stack.append(name)
+    full_name = '/'.join(PROFILER.stack)
+    record = PROFILER.stages.setdefault(full_name, {'calls': 0, 'seconds': 0.0, 'peak_memory_mb': 0.0})
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record['calls'] += 1
+        record['seconds'] += time.perf_counter() - start
+        record['peak_memory_mb'] = peak_memory_mb()
+        PROFILER.stack.pop()
+
+
+def timed(name):
+    """
+    Decorator that runs the function as a stage (see stage())
+
+    :param name: name of the stage
+    :return: decorator
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    """
+    Add to a counter, if profiling is enabled
+
+    :param name: name of the counter
+    :param n: amount to add
+    :return: None
+    """
+    if PROFILER.enabled:
+        PROFILER.counters[name] = PROFILER.counters.get(name, 0) + n
+
+
+def peak_memory_mb():
+    """
+    :return: maximum resident set size of this process so far, in MB
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    if sys.platform == 'darwin':
+        return maxrss / 2 ** 20
+    return maxrss / 2 ** 10
+
+
+def summary():
+    """
+    :return: dictionary with the stages (a list of dictionaries with the stage name, number of calls,
+    wall time in seconds, and peak memory in MB at the end of the stage), the counters, and the peak memory in MB
+    """
+    stages = [dict(stage=name, **record) for name, record in PROFILER.stages.items()]
+    return {'stages': stages,
+            'counters': dict(sorted(PROFILER.counters.items())),
+            'peak_memory_mb': peak_memory_mb()}
+
+
+def format_summary(profile):
+    """
+    format a profiling summary as a table
+
+    :param profile: dictionary from summary()
+    :return: string
+    """
+    lines = ['{:<40}{:>8}{:>12}{:>14}'.format('stage', 'calls', 'seconds', 'peak MB')]
+    for record in profile['stages']:
+        # indent nested stages
+        depth = record['stage'].count('/')
+        name = '  ' * depth + record['stage'].split('/')[-1]
+        lines.append('{:<40}{:>8}{:>12.3f}{:>14.1f}'.format(name, record['calls'], record['seconds'],
+                                                           record['peak_memory_mb']))
+    if profile['counters']:
+        lines.append('')
+        lines.append('{:<40}{:>8}'.format('counter', 'count'))
+        for name, value in profile['counters'].items():
+            lines.append('{:<40}{:>8}'.format(name, value))
+    lines.append('')
+    lines.append('peak memory: ' + '{:.1f}'.format(profile['peak_memory_mb']) + ' MB')
+    return '\n'.join(lines)
+
+
+@contextmanager
+def profile_run(enabled=True, json_file=None, stats_file=None):
+    """
+    Context manager that profiles everything run within it. At the end, the summary is logged as a table,
+    and optionally written as JSON.
+
+    :param enabled: if False, nothing is profiled
+    :param json_file: path to write the summary (see summary()) as JSON
+    :param stats_file: path to write cProfile statistics, which can be read with the pstats module
+    :return: None
+    """
+    if not enabled:
+        yield
+        return
+    PROFILER.reset()
+    PROFILER.enabled = True
+    profiler = None
+    if stats_file:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with stage('total'):
+            yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(stats_file)
+        PROFILER.enabled = False
+        profile = summary()
+        logging.info(format_summary(profile))
+        if json_file:
+            with open(json_file, 'w') as f:
+                json.dump(profile, f, indent=2)
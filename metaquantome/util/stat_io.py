@@ -2,24 +2,56 @@ import pandas as pd
 
 from metaquantome.util.utils import MISSING_VALUES, P_COLNAME, P_CORR_COLNAME
 import metaquantome.util.expand_io as expand_io
+from metaquantome.util import profiling
 
 
+@profiling.timed('read')
 def read_expanded_table(file, samp_grps):
     """
     read the output of metaquantome.expand
 
-    :param file: path to file
+    :param file: path to file. Parquet and Feather files are read according to the
+    extension (see expand_io.COLUMNAR_FORMATS), other files as tab-separated
     :param samp_grps: SampleGroups object
     :return: dataframe, with missing values represented as 0
     """
-    df = pd.read_table(file, sep="\t",
-                       dtype=samp_grps.dict_numeric_cols_expanded,
-                       na_values=MISSING_VALUES,
-                       low_memory=False)
+    fmt = expand_io.table_format(file)
+    if fmt == 'tsv':
+        df = pd.read_table(file, sep="\t",
+                           dtype=samp_grps.dict_numeric_cols_expanded,
+                           na_values=MISSING_VALUES,
+                           low_memory=False)
+    else:
+        if fmt == 'parquet':
+            df = pd.read_parquet(file)
+        else:
+            df = pd.read_feather(file)
+        numeric_cols = {col: dtype for col, dtype in samp_grps.dict_numeric_cols_expanded.items() if col in df}
+        df = df.astype(numeric_cols)
     df.fillna(0, inplace=True)
     return df
 
 
+def expanded_to_table(df, samp_grps, ontology, mode):
+    """
+    Convert the results of metaquantome.expand (or filter) to the dataframe that read_expanded_table()
+    returns for the written file, so that they can be passed on without writing and reading the file.
+
+    :param df: dataframe returned by expand
+    :param samp_grps: SampleGroups object
+    :param ontology: functional ontology (for 'f' or 'ft' modes)
+    :param mode: f, t, or ft
+    :return: dataframe with the output columns, with missing values represented as 0
+    """
+    cols = expand_io.define_outfile_cols_expand(samp_grps, ontology, mode)
+    table = df[cols].reset_index(drop=True)
+    numeric_cols = {col: dtype for col, dtype in samp_grps.dict_numeric_cols_expanded.items() if col in table}
+    table = table.astype(numeric_cols)
+    table.fillna(0, inplace=True)
+    return table
+
+
+@profiling.timed('write')
 def write_stat(df, outfile, samp_grps, ontology, mode, fc_new_cols):
     """
     write the output of stat
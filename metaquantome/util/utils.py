@@ -1,8 +1,13 @@
 import re
 import pkg_resources
 import os
+from itertools import chain
+import numpy as np
 from urllib import request
 
+from metaquantome.databases.ClosureCache import ClosureCache
+from metaquantome.util import profiling
+
 BASE_DIR = pkg_resources.resource_filename('metaquantome', '/')
 DATA_DIR = os.path.join(BASE_DIR, 'data')
 MISSING_VALUES = ["", "0", "NA", "NaN", "0.0"]
@@ -10,6 +15,8 @@ ONTOLOGIES = ['cog', 'go', 'ec']
 P_COLNAME = 'p'
 P_CORR_COLNAME = 'corrected_p'
 TEST_DIR = os.path.join(DATA_DIR, 'test')
+# column with the row position of each term's peptide, see split_terms()
+PEPTIDE_ROW_COLNAME = 'peptide_row'
 
 
 def stream_to_file_from_url(url, tar):
@@ -42,6 +49,7 @@ def safe_cast_to_list(string):
         return string
 
 
+@profiling.timed('tidy_split')
 def tidy_split(df, column, sep='|', keep=False):
     """
     Split the values of a column and expand so the new DataFrame has one split
@@ -64,21 +72,47 @@ def tidy_split(df, column, sep='|', keep=False):
     pandas.DataFrame
         Returns a dataframe with the same columns as `df`.
     """
-    indexes = list()
-    new_values = list()
-    for i, presplit in enumerate(df[column].astype(str)):
-        values = presplit.split(sep)
-        if keep and len(values) > 1:
-            indexes.append(i)
-            new_values.append(presplit)
-        for value in values:
-            indexes.append(i)
-            new_values.append(value)
-    new_df = df.iloc[indexes, :].copy()
+    positions, new_values = split_terms(df[column], sep=sep, keep=keep)
+    new_df = df.iloc[positions, :].copy()
     new_df[column] = new_values
     return new_df
 
 
+def split_terms(values, sep='|', keep=False):
+    """
+    Split each value of a Series into terms, without copying any other columns.
+    The row of each term is given by its position, so that the intensities of the
+    peptide of each term can be looked up, rather than repeated for every term.
+
+    :param values: Series with the values to split
+    :param sep: the string used to split the values
+    :param keep: whether to retain the presplit value as its own term
+    :return: tuple of a numpy array with the row position of each term, and a numpy array of the terms.
+    Terms are in the same order as the rows of tidy_split()
+    """
+    presplit = np.asarray(values.astype(str).values, dtype=object)
+    if len(sep) == 1:
+        # splitting the joined values once is much faster than splitting each value
+        lengths = np.fromiter((value.count(sep) + 1 for value in presplit), dtype=np.int64, count=len(presplit))
+        split = sep.join(presplit).split(sep) if len(presplit) > 0 else []
+    else:
+        split = [value.split(sep) for value in presplit]
+        lengths = np.fromiter((len(terms) for terms in split), dtype=np.int64, count=len(split))
+        split = list(chain.from_iterable(split))
+    positions = np.repeat(np.arange(len(presplit)), lengths)
+    terms = np.empty(len(positions), dtype=object)
+    terms[:] = split
+    if keep:
+        # the presplit value comes before its terms
+        multiple = np.flatnonzero(lengths > 1)
+        positions = np.concatenate([multiple, positions])
+        terms = np.concatenate([presplit[multiple], terms])
+        order = np.argsort(positions, kind='stable')
+        positions = positions[order]
+        terms = terms[order]
+    return positions, terms
+
+
 def sniff_tax_names(df, tax_colname):  # todo: move to NCBI database
     """
     if greater than 90% of entries contain numbers, then we say it is numeric
@@ -130,16 +164,23 @@ def reduce_func(db, funclist, sep):
     return pasted
 
 
+@profiling.timed('reduce')
 def reduce_func_df(db, df, func_colname, sep):
     """
-    Replace the old functional column with a nonredundant functional column
+    Replace the old functional column with a nonredundant functional column.
+    Annotation strings repeat across peptides (e.g., every peptide of a protein has the protein's GO terms),
+    so each distinct string is reduced once, with the ancestors of each term looked up once in a ClosureCache,
+    and the results are mapped back to the rows.
 
+    :param db: reference database. If it is already wrapped in a ClosureCache, that cache is shared
     :param df: Combined df
     :param func_colname: String, name of the functional column
     :param sep: String that separates the list of terms in the functional column
     :return: pandas DataFrame with nonredundant functional column
     """
+    if not isinstance(db, ClosureCache):
+        db = ClosureCache(db, maxsize=None)
     orig_func_col = df[func_colname]
-    new_func_col = orig_func_col.apply(lambda x: reduce_func(db, x, sep))
-    df[func_colname] = new_func_col
+    reduced = {funclist: reduce_func(db, funclist, sep) for funclist in orig_func_col.unique()}
+    df[func_colname] = orig_func_col.map(reduced)
     return df
@@ -29,9 +29,13 @@ setup(
         'ete3',
         'goatools',
         'numpy',
+        'scipy',
         'statsmodels',
         'biopython'
     ],
+    extras_require={
+        'columnar': ['pyarrow']
+    },
     python_requires='>=3.5',
     entry_points={
         'console_scripts': ['metaquantome=metaquantome.cli:cli'],
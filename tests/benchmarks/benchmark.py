@@ -0,0 +1,256 @@
+"""
+Benchmarks for expand, filter, and stat on synthetic datasets of configurable size.
+
+The synthetic intensity, function, and taxonomy tables are drawn from the terms of the
+reference databases in --data_dir (by default, the bundled test databases), so the benchmarks run offline.
+The expand, filter, and stat commands are run with profiling enabled (see metaquantome.util.profiling),
+so each of their stages is timed as in >metaquantome <command> --profile, and the results are written as JSON.
+For example:
+
+python -m tests.benchmarks.benchmark --mode f --ontology go --npeptides 100000 --nsamples 12 \
+    --terms_per_peptide 10 --outfile bench.json
+
+Compare against an earlier run with --baseline, which reports any stage that is slower than the
+baseline by more than --tolerance (and exits with status 1).
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+import metaquantome.util.expand_io as expand_io
+from metaquantome.databases.NCBITaxonomyDb import BASIC_TAXONOMY_TREE
+from metaquantome.modules.expand import expand
+from metaquantome.modules import functional_analysis as fa
+from metaquantome.modules import taxonomy_analysis as ta
+from metaquantome.modules.filter import run_filter
+from metaquantome.modules.stat import stat
+from metaquantome.util import profiling
+from metaquantome.util.utils import TEST_DIR
+
+
+def reference_terms(data_dir, mode, ontology):
+    """
+    get the terms that the synthetic annotations are drawn from
+
+    :param data_dir: data directory with the reference databases
+    :param mode: 'f', 't', or 'ft'
+    :param ontology: 'go', 'ec', or 'cog'
+    :return: dictionary with a sorted list of functional terms ('func') and/or taxids ('tax')
+    """
+    terms = dict()
+    if mode in {'f', 'ft'}:
+        if ontology == 'cog':
+            from metaquantome.databases.cog import cogCat
+            terms['func'] = sorted(cogCat.keys())
+        else:
+            db = fa.load_function_db(data_dir, ontology, slim_down=False)
+            if ontology == 'go':
+                terms['func'] = sorted({term.id for term in db.gofull.values()})
+            else:
+                terms['func'] = sorted(db.ecdb.keys())
+    if mode in {'t', 'ft'}:
+        # peptide LCAs are at the basic ranks
+        ncbi = ta.load_taxonomy_db(data_dir)
+        ranks = ncbi.get_ranks(ncbi.get_all_taxids())
+        terms['tax'] = sorted(taxid for taxid, rank in ranks.items() if rank in BASIC_TAXONOMY_TREE)
+    return terms
+
+
+def make_synthetic_data(out_dir, data_dir, mode, ontology, npeptides, nsamples, terms_per_peptide,
+                        peptides_per_protein=5, zero_fraction=0.1, seed=0):
+    """
+    Write synthetic intensity, function, and taxonomy tables. Peptides come from proteins, and
+    all peptides of a protein have the same annotations, as in real data.
+
+    :param out_dir: directory for the tables
+    :param data_dir: data directory with the reference databases
+    :param mode: 'f', 't', or 'ft'
+    :param ontology: 'go', 'ec', or 'cog'
+    :param npeptides: number of peptides
+    :param nsamples: number of samples, split into two groups
+    :param terms_per_peptide: number of functional terms of each protein
+    :param peptides_per_protein: number of peptides with the same annotations
+    :param zero_fraction: fraction of missing (zero) intensities
+    :param seed: random seed
+    :return: dictionary with the paths to the tables ('int_file', 'func_file', 'tax_file'),
+    and the sample groups as a JSON string ('sinfo')
+    """
+    rng = np.random.RandomState(seed)
+    terms = reference_terms(data_dir, mode, ontology)
+    peptides = ['PEP' + str(i) for i in range(npeptides)]
+    nproteins = max(1, npeptides // peptides_per_protein)
+    protein = rng.randint(nproteins, size=npeptides)
+
+    samples = ['int' + str(i) for i in range(nsamples)]
+    intensity = rng.lognormal(mean=15, sigma=2, size=(npeptides, nsamples)).round(1)
+    intensity[rng.rand(npeptides, nsamples) < zero_fraction] = 0
+    int_df = pd.DataFrame(intensity, index=peptides, columns=samples)
+    paths = {'int_file': os.path.join(out_dir, 'int.tab')}
+    int_df.to_csv(paths['int_file'], sep='\t', index_label='peptide')
+
+    if 'func' in terms:
+        func_terms = np.array(terms['func'], dtype=object)
+        nterms = min(terms_per_peptide, len(func_terms))
+        protein_func = [','.join(rng.choice(func_terms, size=nterms, replace=False)) for i in range(nproteins)]
+        func_df = pd.DataFrame({ontology: [protein_func[p] for p in protein]}, index=peptides)
+        paths['func_file'] = os.path.join(out_dir, 'func.tab')
+        func_df.to_csv(paths['func_file'], sep='\t', index_label='peptide')
+    if 'tax' in terms:
+        protein_tax = rng.choice(np.array(terms['tax']), size=nproteins)
+        tax_df = pd.DataFrame({'lca': protein_tax[protein]}, index=peptides)
+        paths['tax_file'] = os.path.join(out_dir, 'tax.tab')
+        tax_df.to_csv(paths['tax_file'], sep='\t', index_label='peptide')
+
+    half = max(1, nsamples // 2)
+    paths['sinfo'] = json.dumps({'grp1': samples[:half], 'grp2': samples[half:]})
+    return paths
+
+
+def run_benchmark(data_dir, mode, ontology, npeptides, nsamples, terms_per_peptide, engine='hierarchy', seed=0,
+                  chunksize=None, workers=1, ft_tar_rank='genus', work_dir=None):
+    """
+    Generate a synthetic dataset and run expand, filter, and stat on it with profiling enabled
+    (see metaquantome.util.profiling), so that every stage of the real commands is timed
+
+    :param data_dir: data directory with the reference databases. If None, the bundled test databases are used
+    :param mode: 'f', 't', or 'ft'
+    :param ontology: 'go', 'ec', or 'cog' (for 'f' and 'ft' modes)
+    :param npeptides: number of peptides
+    :param nsamples: number of samples
+    :param terms_per_peptide: number of functional terms of each peptide
+    :param engine: expand engine, 'hierarchy' or 'matrix'
+    :param seed: random seed
+    :param chunksize: if given, expand reads the tables in chunks of this many rows (see expand.stream_expand())
+    :param workers: number of expand worker processes. Their work is timed as part of the stage that starts them
+    :param ft_tar_rank: in ft mode, the target rank, or a list of ranks (one expanded table per rank,
+    each of which is filtered and tested)
+    :param work_dir: directory for the synthetic tables and outputs. If None, a temporary directory is used
+    :return: dictionary with the configuration and the profiling summary: a list of stages, each with its number of
+    calls, wall time, and peak memory, and the counters
+    """
+    if not data_dir:
+        data_dir = TEST_DIR
+    if mode == 't':
+        ontology = None
+    config = {'mode': mode, 'ontology': ontology, 'npeptides': npeptides, 'nsamples': nsamples,
+              'terms_per_peptide': terms_per_peptide, 'engine': engine, 'seed': seed, 'chunksize': chunksize,
+              'workers': workers, 'ft_tar_rank': ft_tar_rank, 'data_dir': os.path.abspath(data_dir)}
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        start = time.perf_counter()
+        data = make_synthetic_data(tmp_dir, data_dir, mode, ontology, npeptides, nsamples, terms_per_peptide,
+                                   seed=seed)
+        generate_seconds = time.perf_counter() - start
+        expanded_file = os.path.join(tmp_dir, 'expanded.tab')
+        with profiling.profile_run():
+            results = expand(mode, data['sinfo'], data['int_file'], 'peptide', 'peptide', 'peptide',
+                             data_dir=data_dir, outfile=expanded_file, func_file=data.get('func_file'),
+                             func_colname=ontology if mode in {'f', 'ft'} else None, ontology=ontology,
+                             tax_file=data.get('tax_file'), tax_colname='lca' if mode in {'t', 'ft'} else None,
+                             ft_tar_rank=ft_tar_rank, engine=engine, chunksize=chunksize, workers=workers)
+            if isinstance(results, dict):
+                # one table per rank
+                expanded_files = [expand_io.define_ft_rank_outfile(expanded_file, rank) for rank in results]
+                results = list(results.values())
+            else:
+                expanded_files = [expanded_file]
+                results = [results]
+            for infile in expanded_files:
+                if ontology != 'cog':
+                    # COG results have no peptide counts to filter on
+                    filtered_file = infile + '.filtered'
+                    run_filter(infile, data['sinfo'], ontology, mode, qthreshold=2, min_child_non_leaf=0,
+                               min_child_nsamp=0, min_peptides=0, min_pep_nsamp=0, outfile=filtered_file)
+                    infile = filtered_file
+                stat(infile, data['sinfo'], paired=False, parametric=True, ontology=ontology, mode=mode,
+                     outfile=None, control_group='grp2')
+        profile = profiling.summary()
+    return {'config': config,
+            'environment': {'python': platform.python_version(), 'pandas': pd.__version__,
+                            'numpy': np.__version__},
+            'generate_seconds': generate_seconds,
+            'stages': profile['stages'],
+            'counters': profile['counters'],
+            'total_seconds': profile['stages'][0]['seconds'],
+            'peak_memory_mb': profile['peak_memory_mb'],
+            'n_expanded_terms': int(sum(df.shape[0] for df in results))}
+
+
+def compare_to_baseline(result, baseline, tolerance, min_seconds=0.05):
+    """
+    find the stages that are slower than in a baseline run
+
+    :param result: dictionary from run_benchmark()
+    :param baseline: dictionary from an earlier run_benchmark(), with the same configuration
+    :param tolerance: ratio of the stage's time to the baseline time above which the stage is reported
+    :param min_seconds: stages that take less than this in both runs are not compared, as their times are mostly noise
+    :return: list of dictionaries with the stage name, and the seconds in the baseline and in this run
+    """
+    # the data directory may be at a different path on another machine
+    same_config = [key for key in result['config'] if key != 'data_dir']
+    if any(baseline['config'].get(key) != result['config'][key] for key in same_config):
+        raise ValueError('The baseline was run with a different configuration: ' + json.dumps(baseline['config']))
+    baseline_seconds = {stage['stage']: stage['seconds'] for stage in baseline['stages']}
+    regressions = list()
+    for stage in result['stages']:
+        before = baseline_seconds.get(stage['stage'])
+        if before is None or max(before, stage['seconds']) < min_seconds:
+            continue
+        if stage['seconds'] > tolerance * before:
+            regressions.append({'stage': stage['stage'], 'baseline_seconds': before, 'seconds': stage['seconds']})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time expand, filter, and stat on a synthetic dataset')
+    parser.add_argument('--mode', '-m', choices=['f', 't', 'ft'], default='f')
+    parser.add_argument('--ontology', choices=['go', 'ec', 'cog'], default='go')
+    parser.add_argument('--npeptides', type=int, default=10000)
+    parser.add_argument('--nsamples', type=int, default=6)
+    parser.add_argument('--terms_per_peptide', type=int, default=5)
+    parser.add_argument('--engine', choices=['hierarchy', 'matrix'], default='hierarchy')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunksize', type=int, help='Run expand on chunks of this many rows.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of expand worker processes.')
+    parser.add_argument('--ft_tar_rank', nargs='+', default=['genus'],
+                        help='Target rank(s) for ft mode. With several ranks, one table per rank is expanded.')
+    parser.add_argument('--data_dir',
+                        help='Directory with the reference databases. The default is the bundled test databases.')
+    parser.add_argument('--outfile', help='JSON file for the results. If not given, the results are printed.')
+    parser.add_argument('--baseline', help='JSON results of an earlier run with the same configuration.')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='With --baseline, report stages that take more than this times the baseline time.')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(message)s', stream=sys.stderr)
+
+    result = run_benchmark(args.data_dir, args.mode, args.ontology, args.npeptides, args.nsamples,
+                           args.terms_per_peptide, engine=args.engine, seed=args.seed, chunksize=args.chunksize,
+                           workers=args.workers,
+                           ft_tar_rank=args.ft_tar_rank[0] if len(args.ft_tar_rank) == 1 else args.ft_tar_rank)
+    print(profiling.format_summary(result), file=sys.stderr)
+    if args.outfile:
+        with open(args.outfile, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(result, baseline, args.tolerance)
+        for reg in regressions:
+            print('Slower than baseline: ' + reg['stage'] + ' took ' + '{:.3f}'.format(reg['seconds']) + ' s, ' +
+                  'baseline ' + '{:.3f}'.format(reg['baseline_seconds']) + ' s', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
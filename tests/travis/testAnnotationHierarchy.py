@@ -38,6 +38,7 @@ class TestAnnotationHierarchyNcbi(unittest.TestCase):
         self.assertIsInstance(updated_node, AnnotationNode)
         self.assertEqual(updated_node.intensity, intensity*2)
         self.assertEqual(updated_node.n_sample_children, 1)
+        self.assertSetEqual(ah.get_sample_children(testid), {testid2})
 
     def testAggregateNodes(self):
         ah, sample_set = self._create_sapiens_db()
@@ -73,11 +74,12 @@ class TestAnnotationHierarchyGO(unittest.TestCase):
         testid = 'GO:0051026'
         intensity = 100
         ah._add_node_with_ancestors(testid, intensity)
+        ah._define_sample_children()
         updated_node = ah.nodes[testid]
         self.assertIsInstance(updated_node, AnnotationNode)
         self.assertEqual(updated_node.intensity, intensity)
-        ah._define_sample_children()
         self.assertEqual(updated_node.n_sample_children, 0)
+        self.assertSetEqual(ah.get_sample_children(testid), set())
 
     def testAggregateNodes(self):
         ah, sample_set = self._create_go_db()
@@ -118,12 +120,12 @@ class TestAnnotationHierarchyEc(unittest.TestCase):
         intensity = 100
         for i in testids:
             ah._add_node_with_ancestors(i, intensity)
-        updated_node = ah.nodes[testids[0]]
-        print(ah.nodes['1.1.-.-'].intensity)
         ah._define_sample_children()
+        updated_node = ah.nodes[testids[0]]
         self.assertIsInstance(updated_node, AnnotationNode)
         self.assertEqual(updated_node.intensity, intensity*3)
         self.assertEqual(updated_node.n_sample_children, 2)
+        self.assertSetEqual(ah.get_sample_children(testids[0]), {'1.1.4.1', '1.1.4.2'})
 
     def testAggregateNodes(self):
         ah, sample_set = self._create_ec_db()
@@ -136,6 +138,24 @@ class TestAnnotationHierarchyEc(unittest.TestCase):
             ah._add_node_with_ancestors(testids[i], test_intensities[i])
         self.assertEqual(ah.nodes['1.1.4.-'].intensity, 1000)
 
+    def testSharedTermIndex(self):
+        db = EnzymeDb(TEST_DIR)
+        term_index = dict()
+        term_list = list()
+        ah1 = AnnotationHierarchy(db, {'1.1.4.1'}, 'samp1', term_index=term_index, term_list=term_list)
+        ah2 = AnnotationHierarchy(db, {'6.5.-.-'}, 'samp2', term_index=term_index, term_list=term_list)
+        alone = AnnotationHierarchy(db, {'1.1.4.1'}, 'samp1')
+        for ah, term in [(ah1, '1.1.4.1'), (ah2, '6.5.-.-'), (alone, '1.1.4.1')]:
+            ah._add_node_with_ancestors(term, 10)
+            ah._define_sample_children()
+        # the index has the terms of both samples, but each hierarchy only has its own
+        self.assertEqual(len(term_index), 6)
+        self.assertListEqual([term_index[term] for term in term_list], list(range(6)))
+        with self.assertRaises(ValueError):
+            AnnotationHierarchy(db, {'1.1.4.1'}, 'samp1', term_index=term_index)
+        self.assertSetEqual(set(ah2.nodes), {'6.5.-.-', '6.-.-.-'})
+        self.assertTrue(ah1.to_dataframe().equals(alone.to_dataframe()))
+
     def testToDataframe(self):
         ah, sample_set = self._create_ec_db()
         test_set = ['1.1.4.-',
@@ -0,0 +1,42 @@
+import unittest
+
+from tests.benchmarks.benchmark import run_benchmark, compare_to_baseline
+from metaquantome.util.utils import TEST_DIR
+
+
+class TestBenchmark(unittest.TestCase):
+    def testRunBenchmark(self):
+        result = run_benchmark(TEST_DIR, 'f', 'ec', npeptides=50, nsamples=4, terms_per_peptide=3)
+        stages = [stage['stage'] for stage in result['stages']]
+        # other stages may be added as the commands are instrumented
+        for stage in ['read', 'load_db', 'reduce', 'tidy_split', 'hierarchy', 'to_dataframe', 'write']:
+            self.assertIn('total/expand/' + stage, stages)
+        for stage in ['total/filter', 'total/stat']:
+            self.assertIn(stage, stages)
+        self.assertGreater(result['n_expanded_terms'], 0)
+
+        # a run is not slower than itself
+        self.assertListEqual(compare_to_baseline(result, result, tolerance=1.5), [])
+        slower = dict(result, stages=[dict(stage, seconds=stage['seconds'] * 2 + 1) for stage in result['stages']])
+        self.assertEqual(len(compare_to_baseline(slower, result, tolerance=1.5)), len(stages))
+        with self.assertRaises(ValueError):
+            compare_to_baseline(result, dict(result, config=dict(result['config'], npeptides=100)), tolerance=1.5)
+
+    def testRunBenchmarkChunked(self):
+        result = run_benchmark(TEST_DIR, 'f', 'go', npeptides=50, nsamples=4, terms_per_peptide=3, chunksize=20)
+        calls = {stage['stage']: stage['calls'] for stage in result['stages']}
+        self.assertEqual(calls['total/expand/stream/hierarchy'], 3)
+        self.assertEqual(calls['total/expand/stream/finalize'], 1)
+
+    def testRunBenchmarkFtRanks(self):
+        result = run_benchmark(TEST_DIR, 'ft', 'go', npeptides=50, nsamples=4, terms_per_peptide=3,
+                               ft_tar_rank=['genus', 'phylum'])
+        calls = {stage['stage']: stage['calls'] for stage in result['stages']}
+        # each rank's table is written, filtered, and tested
+        self.assertEqual(calls['total/expand/write'], 2)
+        self.assertEqual(calls['total/filter'], 2)
+        self.assertEqual(calls['total/stat'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
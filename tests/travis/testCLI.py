@@ -1,3 +1,4 @@
+import json
 import subprocess
 import unittest
 import pandas as pd
@@ -44,6 +45,25 @@ class TestCLI(unittest.TestCase):
         self.assertTrue(test_df['corrected_p_s1_over_s2']['C'] > 0.05)
         self.assertTrue(test_df['corrected_p_s1_over_s2'][['N','D']].le(0.05).all())
 
+    def testRun(self):
+        test_out = testfile('cli_run_test_out.tab')
+        config = {"samps": TTEST_SINFO, "mode": "f", "ontology": "cog",
+                  "expand": {"int_file": "metaquantome/data/test/int_ttest.tab", "pep_colname_int": "peptide",
+                             "pep_colname_func": "peptide", "pep_colname_tax": "peptide",
+                             "func_file": "metaquantome/data/test/multiple_func.tab", "func_colname": "cog"},
+                  "stat": {"control_group": "s2", "paired": False, "parametric": True, "outfile": test_out}}
+        proc = subprocess.run(['python3', 'metaquantome/cli.py', 'run', '--config', json.dumps(config)],
+                              stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(proc.returncode, 0)
+        # the wall time and peak memory of each stage are reported without --profile
+        stage_lines = [line.split()[0] for line in proc.stderr.splitlines() if line.startswith('  ') and
+                       not line.startswith('   ')]
+        self.assertListEqual(stage_lines, ['expand', 'stat'])
+
+        test_df = pd.read_csv(test_out, sep="\t", index_col='id')
+        self.assertTrue(test_df['corrected_p_s1_over_s2']['C'] > 0.05)
+        self.assertTrue(test_df['corrected_p_s1_over_s2'][['N','D']].le(0.05).all())
+
     def testViz(self):
         infile = testfile('taxonomy_write_simple.tab')
         imgfile = testfile('cli_bar_viz.png')
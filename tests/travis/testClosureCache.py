@@ -0,0 +1,63 @@
+import unittest
+import pandas as pd
+
+from metaquantome.databases.ClosureCache import ClosureCache, unwrap_db
+from metaquantome.databases.EnzymeDb import EnzymeDb
+from metaquantome.classes.SampleAnnotations import SampleAnnotations
+from metaquantome.classes.SampleGroups import SampleGroups
+from metaquantome.util.utils import TEST_DIR
+
+
+class TestClosureCache(unittest.TestCase):
+    ec = EnzymeDb(TEST_DIR)
+
+    def testSameAsDb(self):
+        cache = ClosureCache(self.ec)
+        for ecid in ['1.1.4.1', '6.5.-.-', '6.-.-.-']:
+            self.assertSetEqual(set(cache.get_ancestors(ecid)), self.ec.get_ancestors(ecid))
+            self.assertSetEqual(set(cache.get_children(ecid)), self.ec.get_children(ecid))
+
+    def testHitsAndMisses(self):
+        cache = ClosureCache(self.ec)
+        cache.get_ancestors('1.1.4.1')
+        cache.get_ancestors('1.1.4.1')
+        cache.get_ancestors('1.1.4.2')
+        info = cache.cache_info()
+        self.assertEqual(info['ancestors']['hits'], 1)
+        self.assertEqual(info['ancestors']['misses'], 2)
+        self.assertEqual(info['ancestors']['size'], 2)
+        self.assertEqual(info['children']['misses'], 0)
+        cache.clear()
+        self.assertEqual(cache.cache_info()['ancestors']['size'], 0)
+
+    def testLeastRecentlyUsedDropped(self):
+        cache = ClosureCache(self.ec, maxsize=2)
+        cache.get_ancestors('1.1.4.1')
+        cache.get_ancestors('1.1.4.2')
+        # use 1.1.4.1 again, so that 1.1.4.2 is the least recently used
+        cache.get_ancestors('1.1.4.1')
+        cache.get_ancestors('6.5.1.-')
+        self.assertIn('1.1.4.1', cache.caches['ancestors'])
+        self.assertNotIn('1.1.4.2', cache.caches['ancestors'])
+
+    def testPassThrough(self):
+        cache = ClosureCache(self.ec)
+        self.assertTrue(cache.is_in_db('1.1.4.1'))
+        self.assertIs(unwrap_db(cache), self.ec)
+        self.assertIs(unwrap_db(self.ec), self.ec)
+
+    def testSharedAcrossSamples(self):
+        samp_grps = SampleGroups('{"grp1": ["samp1", "samp2"]}')
+        df = pd.DataFrame({'ec': ['1.1.4.1', '1.1.4.2', '6.5.-.-'],
+                           'samp1': [10, 20, 30],
+                           'samp2': [5, 0, 1]})
+        sa = SampleAnnotations(self.ec)
+        sa.add_samples_from_df(df, 'ec', samp_grps)
+        info = sa.closure_cache.cache_info()
+        # samp2 only has terms that were already looked up for samp1
+        self.assertEqual(info['ancestors']['misses'], 3)
+        self.assertEqual(info['ancestors']['hits'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
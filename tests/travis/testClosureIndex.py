@@ -0,0 +1,53 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from metaquantome.databases.ClosureIndex import ClosureIndex
+from metaquantome.databases.NCBITaxonomyDb import NCBITaxonomyDb
+from metaquantome.util.utils import TEST_DIR
+
+
+class TestClosureIndex(unittest.TestCase):
+    def setUp(self):
+        # copy the test databases, so that indexes are not written to the test directory
+        self.data_dir = tempfile.mkdtemp()
+        for file in ['enzclass.json', 'ec_id.json', 'taxa.sqlite', 'taxa.sqlite.traverse.pkl']:
+            shutil.copy2(os.path.join(TEST_DIR, file), self.data_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def testWriteAndLoad(self):
+        closures = {'a': set(), 'b': {'a'}, 'c': {'a', 'b'}}
+        metadata = {'a': 'root', 'b': 'inner', 'c': 'leaf'}
+        source = os.path.join(self.data_dir, 'ec_id.json')
+        ClosureIndex.write(self.data_dir, 'test', closures, metadata, [source])
+        index = ClosureIndex.load(self.data_dir, 'test', [source])
+        self.assertSetEqual(index.get_ancestors('c'), {'a', 'b'})
+        self.assertSetEqual(index.get_ancestors('a'), set())
+        self.assertEqual(index.get_metadata('b'), 'inner')
+        self.assertIsNone(index.get_ancestors('d'))
+        self.assertNotIn('d', index)
+
+    def testStaleIndexNotUsed(self):
+        source = os.path.join(self.data_dir, 'ec_id.json')
+        ClosureIndex.write(self.data_dir, 'test', {'a': set()}, {'a': 'root'}, [source])
+        # simulate an updated database file
+        stat = os.stat(source)
+        os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertIsNone(ClosureIndex.load(self.data_dir, 'test', [source]))
+        self.assertIsNone(ClosureIndex.load(self.data_dir, 'missing', [source]))
+
+    def testNcbiDb(self):
+        ncbi = NCBITaxonomyDb(self.data_dir)
+        ncbi.write_closure_index(self.data_dir)
+        ncbi_index = NCBITaxonomyDb(self.data_dir)
+        self.assertIsNotNone(ncbi_index.closure_index)
+        for taxid in [9606, 9604, 9599, 1]:
+            self.assertSetEqual(ncbi_index.get_ancestors(taxid), ncbi.get_ancestors(taxid))
+            self.assertEqual(ncbi_index.get_rank(taxid), ncbi.get_rank(taxid))
+
+
+if __name__ == '__main__':
+    unittest.main()
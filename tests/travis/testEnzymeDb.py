@@ -35,6 +35,19 @@ class TestEC(unittest.TestCase):
                         '1.2.3.4': expected3}
         self.assertDictEqual(newdb, all_expected)
 
+    def testIndexEnzymeDb(self):
+        testdb = {'1.-.-.-': "a description",
+                  '1.2.-.-': "another description",
+                  '1.2.3.4': "most specific enzyme, without a parent at depth 2",
+                  '1.3.-.-': "a sibling"}
+        parent_map, child_map, ancestor_map, prefix_map = self.ec._index_enzyme_db(self.ec._annotate_enzyme_db(testdb))
+        self.assertSetEqual(parent_map['1.2.-.-'], {'1.-.-.-'})
+        self.assertSetEqual(child_map['1.-.-.-'], {'1.2.-.-', '1.3.-.-'})
+        # 1.2.3.- is missing, so 1.2.3.4 has no parents or ancestors
+        self.assertSetEqual(parent_map['1.2.3.4'], set())
+        self.assertSetEqual(ancestor_map['1.2.3.4'], set())
+        self.assertSetEqual(prefix_map[(2, ('1', '2'))], {'1.2.-.-', '1.2.3.4'})
+
     def testAssignDepth(self):
         test_ecid0 = '1.-.-.-'
         test_ecid2 = '4.5.2.-'
@@ -1,9 +1,14 @@
+import os
+import tempfile
 import unittest
 import numpy as np
 import pandas as pd
 
 from metaquantome.databases import GeneOntologyDb as godb
+from metaquantome.databases.GeneOntologyDb import GeneOntologyDb
+from metaquantome.databases.NCBITaxonomyDb import NCBITaxonomyDb
 import metaquantome.modules.expand as expand
+import metaquantome.modules.function_taxonomy_interaction as fti
 from metaquantome.classes.SampleGroups import SampleGroups
 from metaquantome.util.testutils import testfile
 from metaquantome.util.utils import TEST_DIR
@@ -96,6 +101,27 @@ class TestFunctionalAnalysisExpand(unittest.TestCase):
         returned_gos.discard('unknown')
         self.assertTrue(returned_gos.issubset(self.db.goslim.keys()))
 
+    def testMatrixEngine(self):
+        func = testfile('multiple_func.tab')
+        int = testfile('multiple_int.tab')
+        kwargs = dict(sinfo='{"s1": ["int1", "int2", "int3"]}', int_file=int, pep_colname_int='peptide',
+                      pep_colname_func='peptide', pep_colname_tax='peptide', data_dir=TEST_DIR, func_file=func,
+                      func_colname='go', ontology='go')
+        hier_df = expand.expand('f', engine='hierarchy', **kwargs).sort_index(axis=1)
+        mat_df = expand.expand('f', engine='matrix', **kwargs).sort_index(axis=1)
+        self.assertTrue(hier_df.equals(mat_df))
+
+    def testChunked(self):
+        func = testfile('multiple_func.tab')
+        int = testfile('multiple_int.tab')
+        for ontology in ['go', 'ec', 'cog']:
+            kwargs = dict(sinfo='{"s1": ["int1", "int2", "int3"]}', int_file=int, pep_colname_int='peptide',
+                          pep_colname_func='peptide', pep_colname_tax='peptide', data_dir=TEST_DIR, func_file=func,
+                          func_colname=ontology, ontology=ontology)
+            whole_df = expand.expand('f', **kwargs).sort_index(axis=1)
+            chunked_df = expand.expand('f', chunksize=2, **kwargs).sort_index(axis=1)
+            pd.testing.assert_frame_equal(whole_df, chunked_df, check_dtype=False)
+
     def testCog(self):
         func=testfile('multiple_func.tab')
         int=testfile('multiple_int.tab')
@@ -161,6 +187,16 @@ class TestTaxonomyAnalysisExpand(unittest.TestCase):
         self.assertEqual(tax_df.query("rank == 'phylum' and taxon_name == 'Proteobacteria'")['int3'].values[0],
                          np.log2(70))
 
+    def testChunked(self):
+        tax = testfile('multiple_tax.tab')
+        int = testfile('multiple_int.tab')
+        kwargs = dict(sinfo='{"s1": ["int1", "int2", "int3"]}', int_file=int, pep_colname_int='peptide',
+                      pep_colname_func='peptide', pep_colname_tax='peptide', data_dir=TEST_DIR, tax_file=tax,
+                      tax_colname='lca')
+        whole_df = expand.expand('t', **kwargs).sort_index(axis=1)
+        chunked_df = expand.expand('t', chunksize=1, **kwargs).sort_index(axis=1)
+        pd.testing.assert_frame_equal(whole_df, chunked_df, check_dtype=False)
+
     def testParentIntensityHigher(self):
         """
         make sure that parents always have higher intensity than children
@@ -190,6 +226,56 @@ class TestFunctionTaxonomyAnalysis(unittest.TestCase):
                            tax_colname='lca', func_file=func, func_colname="go")
         self.assertIn("A_mean", list(ft))
 
+    def testChunked(self):
+        # the same peptide is repeated in different chunks, and should only be counted once
+        tax = testfile('ft_tax.tab')
+        func = testfile('ft_func.tab')
+        int = testfile('ft_int.tab')
+        kwargs = dict(sinfo='{"A": ["int"]}', int_file=int, pep_colname_int='Sequence', pep_colname_func='peptide',
+                      pep_colname_tax='peptide', data_dir=TEST_DIR, tax_file=tax, tax_colname='lca',
+                      func_file=func, func_colname="go")
+        whole_df = expand.expand('ft', **kwargs)
+        chunked_df = expand.expand('ft', chunksize=10, **kwargs)
+        pd.testing.assert_frame_equal(whole_df, chunked_df, check_dtype=False)
+
+    def testMultipleRanks(self):
+        kwargs = dict(sinfo='{"A": ["int"]}', int_file=testfile('ft_int.tab'), pep_colname_int='Sequence',
+                      pep_colname_func='peptide', pep_colname_tax='peptide', data_dir=TEST_DIR,
+                      tax_file=testfile('ft_tax.tab'), tax_colname='lca', func_file=testfile('ft_func.tab'),
+                      func_colname="go")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outfile = os.path.join(tmpdir, 'ft.tab')
+            cube = expand.expand('ft', ft_tar_rank=['genus', 'phylum'], outfile=outfile, **kwargs)
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'ft_genus.tab')))
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'ft_phylum.tab')))
+        chunked_cube = expand.expand('ft', ft_tar_rank=['genus', 'phylum'], chunksize=10, **kwargs)
+        for rank in ['genus', 'phylum']:
+            single = expand.expand('ft', ft_tar_rank=rank, **kwargs)
+            pd.testing.assert_frame_equal(cube[rank], single)
+            pd.testing.assert_frame_equal(chunked_cube[rank], single, check_dtype=False)
+            self.assertTrue((single['rank'] == rank).all())
+        with self.assertRaises(ValueError):
+            expand.expand('ft', ft_tar_rank=['genus', 'not a rank'], **kwargs)
+
+    def testCleanAndSum(self):
+        # 1302 and 1305 are species of the genus 1301, 1239 is a phylum (less specific than genus),
+        # and 999999999 is not in the database. taxids are strings, as read from the taxonomy file
+        df = pd.DataFrame({'lca': ['1302', '1305', '1239', '999999999'],
+                           'go': ['GO:0008152', 'GO:0008152,GO:0022610', 'GO:0008152', 'GO:0008152'],
+                           's1': [10.0, 20.0, 30.0, 40.0],
+                           's2': [0.0, 5.0, 30.0, 40.0]},
+                          index=pd.Index(['A', 'B', 'C', 'D'], name='peptide'))
+        samp_grps = SampleGroups('{"grp1": ["s1", "s2"]}')
+        dedup_df = fti.clean_function_taxonomy_df(GeneOntologyDb(TEST_DIR), NCBITaxonomyDb(TEST_DIR), df, 'go',
+                                                  'go', False, 'lca', 'genus')
+        self.assertListEqual(sorted(set(dedup_df.index)), ['A', 'B'])
+        self.assertTrue((dedup_df['des_rank'] == 1301).all())
+        sums = fti.sum_function_taxonomy_df(dedup_df, 'go', samp_grps)
+        self.assertListEqual(list(sums), ['s1', 's2', 's1_n_peptide', 's2_n_peptide'])
+        self.assertEqual(sums.loc[('GO:0008152', 1301), 's1'], 30)
+        self.assertEqual(sums.loc[('GO:0008152', 1301), 's2_n_peptide'], 1)
+        self.assertEqual(sums.loc[('GO:0022610', 1301), 's1_n_peptide'], 1)
+
 
 if __name__=='__main__':
     unittest.main()
@@ -1,10 +1,11 @@
+import json
 import unittest
 
 from metaquantome.util.testutils import testfile, TTEST_SINFO
 from metaquantome.util import stat_io
 from metaquantome.util.utils import TEST_DIR
 from metaquantome.classes.SampleGroups import SampleGroups
-from metaquantome.modules.filter import run_filter
+from metaquantome.modules.filter import run_filter, run_filter_sweep
 from metaquantome.modules.expand import expand
 
 
@@ -40,6 +41,28 @@ class TestFilter(unittest.TestCase):
         self.assertNotIn(1496, filt3_ids)
         self.assertNotIn(1870884, filt3_ids)
 
+    def testSweep(self):
+        intfile = testfile('filt_int.tab')
+        taxfile = testfile('multiple_tax.tab')
+        expandfile = testfile('expand_out.tab')
+        expand('t', TTEST_SINFO, int_file=intfile, pep_colname_int='peptide', pep_colname_func='peptide',
+               pep_colname_tax='peptide', data_dir=TEST_DIR, outfile=expandfile, tax_file=taxfile,
+               tax_colname='lca')
+        settings = [{"qthreshold": q, "min_child_non_leaf": 0, "min_child_nsamp": 0, "min_peptides": 0,
+                     "min_pep_nsamp": 0} for q in [0, 3]]
+        swept = run_filter_sweep(expandfile, TTEST_SINFO, ontology=None, mode="t", settings=json.dumps(settings))
+        self.assertEqual(len(swept), 2)
+        # each configuration gives the same result as filtering with it alone
+        for setting, filtered in zip(settings, swept):
+            alone = run_filter(expandfile, TTEST_SINFO, ontology=None, mode="t", **setting)
+            self.assertListEqual(filtered['id'].tolist(), alone['id'].tolist())
+        self.assertIn(1496, set(swept[0]['id']))
+        self.assertNotIn(1496, set(swept[1]['id']))
+
+        # all filtering conditions are required
+        with self.assertRaises(ValueError):
+            run_filter_sweep(expandfile, TTEST_SINFO, ontology=None, mode="t", settings='[{"qthreshold": 3}]')
+
 
 if __name__ == '__main__':
     unittest.main()
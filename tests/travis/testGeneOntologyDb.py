@@ -1,6 +1,10 @@
 import unittest
+import os
+import shutil
+import tempfile
 
 from metaquantome.databases import GeneOntologyDb as godb
+from metaquantome.databases.GoSnapshot import GoSnapshot
 from metaquantome.util.utils import TEST_DIR
 
 
@@ -89,5 +93,74 @@ class TestGeneOntologyDb(unittest.TestCase):
         self.assertSetEqual(self.db.get_ancestors(testid), set())
 
 
+class TestGoSnapshot(unittest.TestCase):
+    db = godb.GeneOntologyDb(TEST_DIR, slim_down=True)
+
+    def setUp(self):
+        # copy the OBO files, so that snapshots are not written to the test directory
+        self.data_dir = tempfile.mkdtemp()
+        for file in ['go-basic.obo', 'goslim_metagenomics.obo']:
+            shutil.copy2(os.path.join(TEST_DIR, file), self.data_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def testSameAsObo(self):
+        godb.GeneOntologyDb.write_snapshots(self.data_dir)
+        snap_db = godb.GeneOntologyDb(self.data_dir, slim_down=True)
+        self.assertIsInstance(snap_db.gofull, GoSnapshot)
+        self.assertSetEqual(set(snap_db.gofull.keys()), set(self.db.gofull.keys()))
+        self.assertSetEqual(snap_db.slim_members, self.db.slim_members)
+        for testid in ["GO:0016043", "GO:0007044", "GO:0044406", "GO:0032284", "notagoterm"]:
+            self.assertSetEqual(snap_db.get_ancestors(testid), self.db.get_ancestors(testid))
+            self.assertSetEqual(snap_db.get_descendants(testid), self.db.get_descendants(testid))
+            self.assertEqual(snap_db.map_id_to_slim(testid), self.db.map_id_to_slim(testid))
+        term = snap_db.gofull["GO:0016043"]
+        self.assertEqual(term.name, self.db.gofull["GO:0016043"].name)
+        self.assertEqual(term.namespace, 'biological_process')
+
+    def testAltIdAndStale(self):
+        obo_path = os.path.join(self.data_dir, 'small.obo')
+        with open(obo_path, 'w') as f:
+            f.write('format-version: 1.2\n\n' +
+                    '[Term]\nid: GO:0000001\nname: root\nnamespace: biological_process\n\n' +
+                    '[Term]\nid: GO:0000002\nname: child \u00e9\nnamespace: biological_process\n' +
+                    'alt_id: GO:0000003\nis_a: GO:0000001 ! root\n')
+        GoSnapshot.write(self.data_dir, 'small', godb.obo_parser.GODag(obo_path), obo_path)
+        snapshot = GoSnapshot.load(self.data_dir, 'small', obo_path)
+        self.assertEqual(len(snapshot), 3)
+        self.assertEqual(snapshot['GO:0000003'].id, 'GO:0000002')
+        self.assertEqual(snapshot['GO:0000003'].name, 'child \u00e9')
+        self.assertSetEqual(snapshot['GO:0000003'].get_all_parents(), {'GO:0000001'})
+        self.assertSetEqual({term.id for term in snapshot['GO:0000001'].children}, {'GO:0000002'})
+        with self.assertRaises(KeyError):
+            snapshot['GO:0000004']
+        # a changed OBO file is parsed again
+        stat = os.stat(obo_path)
+        os.utime(obo_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertIsNone(GoSnapshot.load(self.data_dir, 'small', obo_path))
+
+    def testSlimMap(self):
+        slim_db = godb.GeneOntologyDb(self.data_dir, slim_down=True)
+        map_path = godb.GeneOntologyDb.define_slim_map_path(self.data_dir)
+        self.assertTrue(os.path.exists(map_path))
+        self.assertDictEqual(slim_db.slim_map, self.db.slim_map)
+        for goid, slim_id in slim_db.slim_map.items():
+            if goid in slim_db.slim_members:
+                self.assertEqual(slim_id, goid)
+            else:
+                self.assertIn(slim_id, slim_db.get_slim_ancestors(goid))
+        self.assertSetEqual(set(slim_db.get_slim_ancestors("GO:1902494")),
+                            {anc for anc in slim_db.get_ancestors("GO:1902494") if anc in slim_db.slim_members})
+        # the slim map is rebuilt if either OBO file changes
+        slim_path = os.path.join(self.data_dir, 'goslim_metagenomics.obo')
+        stat = os.stat(slim_path)
+        os.utime(slim_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        mtime = os.stat(map_path).st_mtime_ns
+        rebuilt_db = godb.GeneOntologyDb(self.data_dir, slim_down=True)
+        self.assertGreater(os.stat(map_path).st_mtime_ns, mtime)
+        self.assertDictEqual(rebuilt_db.slim_map, slim_db.slim_map)
+
+
 if __name__=="__main__":
     unittest.main()
\ No newline at end of file
@@ -1,9 +1,13 @@
+import importlib.util
 import unittest
 import os
+import pandas as pd
 
 import metaquantome.classes.SampleGroups
 import metaquantome.util.expand_io
-from metaquantome.util.utils import DATA_DIR
+from metaquantome.modules.expand import expand
+from metaquantome.util.stat_io import read_expanded_table
+from metaquantome.util.utils import DATA_DIR, TEST_DIR
 from metaquantome.util.testutils import testfile
 
 
@@ -47,5 +51,39 @@ class TestIO(unittest.TestCase):
         # the row with an NA cog was filtered out
         self.assertEqual(go_df.shape[0], 2)
 
+    def testReadInChunks(self):
+        sinfo = '{"s1":["int1", "int2", "int3"]}'
+        samp_grps = metaquantome.classes.SampleGroups.SampleGroups(sinfo)
+        kwargs = dict(pep_colname_int='peptide', pep_colname_func='peptide', pep_colname_tax='peptide',
+                      samp_grps=samp_grps, int_file=testfile('multiple_int.tab'),
+                      tax_file=testfile('multiple_tax.tab'), tax_colname='lca')
+        whole = metaquantome.util.expand_io.read_and_join_files('t', **kwargs)
+        chunks = list(metaquantome.util.expand_io.read_and_join_files_chunks('t', chunksize=2, **kwargs))
+        self.assertTrue(all(chunk.shape[0] <= 2 for chunk in chunks))
+        self.assertTrue(pd.concat(chunks).equals(whole))
+
+    def testTableFormat(self):
+        self.assertEqual(metaquantome.util.expand_io.table_format('expanded.tab'), 'tsv')
+        self.assertEqual(metaquantome.util.expand_io.table_format('expanded.PARQUET'), 'parquet')
+        self.assertEqual(metaquantome.util.expand_io.table_format('expanded.arrow'), 'feather')
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def testColumnarRoundTrip(self):
+        sinfo = '{"s1": ["int1", "int2", "int3"], "s2": ["int4", "int5", "int6"]}'
+        samp_grps = metaquantome.classes.SampleGroups.SampleGroups(sinfo)
+        expanded = expand('f', sinfo, int_file=testfile('int_ttest.tab'), pep_colname_int='peptide',
+                          pep_colname_func='peptide', pep_colname_tax='peptide', data_dir=TEST_DIR,
+                          outfile=testfile('go_expanded_ttest.tab'), func_file=testfile('multiple_func.tab'),
+                          func_colname='go', ontology='go')
+        tsv = read_expanded_table(testfile('go_expanded_ttest.tab'), samp_grps)
+        for ext in ['.parquet', '.feather']:
+            outfile = testfile('go_expanded_ttest' + ext)
+            cols = metaquantome.util.expand_io.define_outfile_cols_expand(samp_grps, 'go', 'f')
+            metaquantome.util.expand_io.write_out_general(expanded, outfile, cols)
+            columnar = read_expanded_table(outfile, samp_grps)
+            pd.testing.assert_frame_equal(columnar, tsv)
+            os.remove(outfile)
+
+
 if __name__=='__main__':
     unittest.main()
@@ -1,9 +1,14 @@
 import unittest
 import os
+import shutil
+import sqlite3
+import tempfile
 import pandas as pd
 import numpy as np
 
 import metaquantome.databases.NCBITaxonomyDb as td
+from metaquantome.databases.NCBITaxonomySnapshot import NCBITaxonomySnapshot
+from metaquantome.modules.db_download_handler import db_download_handler
 from metaquantome.util.utils import DATA_DIR, TEST_DIR
 from metaquantome.util.testutils import testfile
 
@@ -54,6 +59,16 @@ class TestTaxonomyDatabase(unittest.TestCase):
         expected = {9592, 9605, 9599, 9596}
         self.assertSetEqual(self.ncbi.get_children(id), expected)
 
+    def testGetSampleChildren(self):
+        # hominidae, homo, pongo, homo sapiens, and the primates order
+        sample_set = {9604, 9605, 9599, 9606, 9443}
+        sample_children = self.ncbi.get_sample_children(sample_set)
+        self.assertSetEqual(sample_children[9604], {9605, 9599})
+        self.assertSetEqual(sample_children[9605], {9606})
+        self.assertSetEqual(sample_children[9443], {9604})
+        for taxid in sample_set:
+            self.assertSetEqual(sample_children[taxid], self.ncbi.get_children(taxid) & sample_set)
+
     def testGetDescendants(self):
         id = 9604  # great apes
         # all descendants include 4 genuses/geni (9592, 9605, 9599, 9596)
@@ -114,6 +129,112 @@ class TestTaxonomyDatabase(unittest.TestCase):
         # assure no unknown names (i.e., unipept names are reasonably well supported)
         self.assertEqual(sum([id == np.nan for id in ids]), 0)
 
+    def testBulkSameAsSingle(self):
+        taxids = [9605, 562, 1807140, 1692040, 2, 9606]
+        self.assertDictEqual(self.ncbi.get_ranks(taxids), {i: self.ncbi.get_rank(i) for i in taxids})
+        self.assertDictEqual(self.ncbi.get_basic_lineages(taxids), {i: self.ncbi.get_ancestors(i) for i in taxids})
+        mapped = self.ncbi.map_ids_to_desired_ranks(td.BASIC_TAXONOMY_TREE, taxids)
+        for i in taxids:
+            self.assertDictEqual(mapped[i], self.ncbi.map_id_to_desired_ranks(td.BASIC_TAXONOMY_TREE, i))
+        self.assertEqual(self.ncbi.get_lineages([562])[562], self.ncbi.ncbi.get_lineage(562))
+
+    def testAreInDb(self):
+        taxids = [562, 999999999, np.nan, '562', 9606.0]
+        self.assertListEqual(list(self.ncbi.are_in_db(taxids)), [True, False, False, False, True])
+
+    def testPrefetch(self):
+        ncbi = td.NCBITaxonomyDb(TEST_DIR)
+        ncbi.prefetch([1692040, 562])
+        self.assertSetEqual(ncbi.ancestor_map[1692040], {1224, 1236})
+        self.assertSetEqual(ncbi.get_ancestors(1692040), {1224, 1236})
+        # ranks of the ancestors are also loaded
+        self.assertEqual(ncbi.rank_map[1224], 'phylum')
+        self.assertSetEqual(ncbi.get_parents(562), {561})
+
+
+class TestNCBITaxonomySnapshot(unittest.TestCase):
+    # the reference is always the sqlite database, even if the test directory has a snapshot
+    db = td.NCBITaxonomyDb(TEST_DIR, backend='sqlite')
+
+    @classmethod
+    def setUpClass(cls):
+        # copy the sqlite database, so that the snapshot is not written to the test directory
+        cls.data_dir = tempfile.mkdtemp()
+        shutil.copy2(os.path.join(TEST_DIR, 'taxa.sqlite'), cls.data_dir)
+        # an obsolete taxid, merged into E. coli
+        db = sqlite3.connect(os.path.join(cls.data_dir, 'taxa.sqlite'))
+        db.execute('INSERT INTO merged VALUES (999999998, 562);')
+        db.commit()
+        db.close()
+        # the database is already there, so only the snapshot is written
+        db_download_handler(['ncbi'], cls.data_dir, False, ncbi_snapshot=True)
+        cls.snap_db = td.NCBITaxonomyDb(cls.data_dir, backend='snapshot')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.data_dir)
+
+    def testSameAsSqlite(self):
+        self.assertIsInstance(self.snap_db.ncbi, NCBITaxonomySnapshot)
+        self.assertNotIsInstance(self.db.ncbi, NCBITaxonomySnapshot)
+        all_taxids = self.db.get_all_taxids()
+        self.assertListEqual(sorted(self.snap_db.get_all_taxids()), sorted(all_taxids))
+        sample = all_taxids[::max(1, len(all_taxids) // 1000)]
+        self.assertDictEqual(self.snap_db.get_ranks(sample), self.db.get_ranks(sample))
+        self.assertDictEqual(self.snap_db.get_lineages(sample), self.db.get_lineages(sample))
+        for testid in [9604, 9605, 9606, 562, 1692040, 1807140, 2]:
+            self.assertSetEqual(self.snap_db.get_children(testid), self.db.get_children(testid))
+            self.assertSetEqual(self.snap_db.get_descendants(testid), self.db.get_descendants(testid))
+            self.assertSetEqual(self.snap_db.get_ancestors(testid), self.db.get_ancestors(testid))
+            self.assertSetEqual(self.snap_db.get_parents(testid), self.db.get_parents(testid))
+            self.assertDictEqual(self.snap_db.map_id_to_desired_ranks(td.BASIC_TAXONOMY_TREE, testid),
+                                 self.db.map_id_to_desired_ranks(td.BASIC_TAXONOMY_TREE, testid))
+        self.assertListEqual(list(self.snap_db.are_in_db([562, 999999999, np.nan, '562', 9606.0])),
+                             [True, False, False, False, True])
+        with self.assertRaises(KeyError):
+            self.snap_db.get_rank(999999999)
+        # the job server calls reconnect() in each forked process
+        self.snap_db.reconnect()
+
+    def testNames(self):
+        self.assertEqual(self.snap_db.convert_taxid_to_name([562, 9606]), ['Escherichia coli', 'Homo sapiens'])
+        names = ['Brassicaceae', 'root', 'HOMO SAPIENS', 'Random nonsense']
+        self.assertDictEqual(self.snap_db.ncbi.get_name_translator(names), self.db.ncbi.get_name_translator(names))
+        ids = self.snap_db.convert_name_to_taxid(names)
+        self.assertEqual(ids[:3], [3700, 1, 9606])
+        self.assertTrue(np.isnan(ids[3]))
+        # obsolete taxids are translated to the taxid they were merged into
+        self.assertDictEqual(self.snap_db.ncbi.get_taxid_translator([999999998]), {999999998: 'Escherichia coli'})
+        with self.assertWarns(UserWarning):
+            self.assertListEqual(self.snap_db.ncbi.get_lineage(999999998), self.snap_db.ncbi.get_lineage(562))
+
+    def testStale(self):
+        data_dir = tempfile.mkdtemp()
+        tax_path = os.path.join(data_dir, 'taxa.sqlite')
+        shutil.copy2(os.path.join(self.data_dir, 'taxa.sqlite'), tax_path)
+        shutil.copytree(NCBITaxonomySnapshot.define_snapshot_dir(self.data_dir),
+                        NCBITaxonomySnapshot.define_snapshot_dir(data_dir))
+        self.assertIsNotNone(NCBITaxonomySnapshot.load(data_dir, tax_path))
+        # a changed sqlite database is used directly
+        stat = os.stat(tax_path)
+        os.utime(tax_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertIsNone(NCBITaxonomySnapshot.load(data_dir, tax_path))
+        self.assertNotIsInstance(td.NCBITaxonomyDb(data_dir).ncbi, NCBITaxonomySnapshot)
+        with self.assertRaises(ValueError):
+            td.NCBITaxonomyDb(data_dir, backend='snapshot')
+        shutil.rmtree(data_dir)
+
+    def testOptIn(self):
+        data_dir = tempfile.mkdtemp()
+        shutil.copy2(os.path.join(self.data_dir, 'taxa.sqlite'), data_dir)
+        db_download_handler(['ncbi'], data_dir, False)
+        self.assertFalse(os.path.exists(NCBITaxonomySnapshot.define_snapshot_dir(data_dir)))
+        self.assertNotIsInstance(td.NCBITaxonomyDb(data_dir).ncbi, NCBITaxonomySnapshot)
+        # the sqlite database can be used even if there is a snapshot
+        self.assertNotIsInstance(td.NCBITaxonomyDb(self.data_dir, backend='sqlite').ncbi, NCBITaxonomySnapshot)
+        with self.assertRaises(ValueError):
+            td.NCBITaxonomyDb(data_dir, backend='not a backend')
+        shutil.rmtree(data_dir)
 
 if __name__=='__main__':
     unittest.main()
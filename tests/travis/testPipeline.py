@@ -0,0 +1,57 @@
+import json
+import unittest
+import pandas as pd
+
+from metaquantome.modules.expand import expand
+from metaquantome.modules.filter import run_filter
+from metaquantome.modules.stat import stat
+from metaquantome.modules.pipeline import run_pipeline
+from metaquantome.util import profiling
+from metaquantome.util.testutils import testfile, TTEST_SINFO
+from metaquantome.util.utils import TEST_DIR
+
+
+class TestPipeline(unittest.TestCase):
+    expand_args = dict(int_file=testfile('int_ttest.tab'), pep_colname_int='peptide', pep_colname_func='peptide',
+                       pep_colname_tax='peptide', tax_file=testfile('multiple_tax.tab'), tax_colname='lca')
+    filter_args = dict(qthreshold=2, min_child_non_leaf=0, min_child_nsamp=0, min_peptides=0, min_pep_nsamp=0)
+    stat_args = dict(control_group='s2', paired=False, parametric=True)
+
+    def testSameAsSeparateSteps(self):
+        config = {'samps': json.loads(TTEST_SINFO), 'mode': 't', 'data_dir': TEST_DIR,
+                  'expand': self.expand_args,
+                  'filter': dict(self.filter_args, outfile=testfile('pipeline_filtered.tab')),
+                  'stat': self.stat_args}
+        results, reports = run_pipeline(json.dumps(config))
+        self.assertListEqual([report['stage'] for report in reports], ['expand', 'filter', 'stat'])
+        # within a profiled run, the stages are part of its profile
+        with profiling.profile_run():
+            results, reports = run_pipeline(json.dumps(config))
+        stages = [stage['stage'] for stage in profiling.summary()['stages']]
+        self.assertListEqual([report['stage'] for report in reports], ['expand', 'filter', 'stat'])
+        self.assertListEqual([stage for stage in stages if stage.count('/') == 1],
+                             ['total/expand', 'total/filter', 'total/stat'])
+        # the expand stage is not repeated for the expand() call within it
+        self.assertIn('total/expand/hierarchy', stages)
+
+        # the same steps, through files
+        expand('t', TTEST_SINFO, data_dir=TEST_DIR, outfile=testfile('expand_taxttest.tab'), **self.expand_args)
+        filtered = run_filter(testfile('expand_taxttest.tab'), TTEST_SINFO, ontology=None, mode='t',
+                              outfile=testfile('pipeline_filtered_steps.tab'), **self.filter_args)
+        tested = stat(testfile('pipeline_filtered_steps.tab'), TTEST_SINFO, ontology=None, mode='t', outfile=None,
+                      **self.stat_args)
+        self.assertListEqual(results['filter']['id'].tolist(), filtered['id'].tolist())
+        # up to the precision of the floats in the written file
+        pd.testing.assert_frame_equal(results['stat'], tested, rtol=1e-12)
+        pd.testing.assert_frame_equal(pd.read_table(testfile('pipeline_filtered.tab')),
+                                      pd.read_table(testfile('pipeline_filtered_steps.tab')), rtol=1e-12)
+
+    def testConfigErrors(self):
+        with self.assertRaises(ValueError):
+            run_pipeline({'samps': TTEST_SINFO, 'mode': 't'})
+        with self.assertRaises(ValueError):
+            run_pipeline({'samps': TTEST_SINFO, 'mode': 't', 'expand': dict(self.expand_args, mode='f')})
+
+
+if __name__ == '__main__':
+    unittest.main()
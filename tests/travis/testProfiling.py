@@ -0,0 +1,49 @@
+import json
+import os
+import pstats
+import tempfile
+import unittest
+
+from metaquantome.modules import expand
+from metaquantome.util import profiling
+from metaquantome.util.testutils import testfile
+from metaquantome.util.utils import TEST_DIR
+
+
+class TestProfiling(unittest.TestCase):
+    def testStages(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_file = os.path.join(tmpdir, 'profile.json')
+            stats_file = os.path.join(tmpdir, 'profile.prof')
+            with profiling.profile_run(json_file=json_file, stats_file=stats_file):
+                for i in range(3):
+                    with profiling.stage('outer'):
+                        with profiling.stage('inner'):
+                            profiling.count('lookups', 2)
+            with open(json_file) as f:
+                profile = json.load(f)
+            pstats.Stats(stats_file)
+        stages = {record['stage']: record for record in profile['stages']}
+        self.assertListEqual(list(stages), ['total', 'total/outer', 'total/outer/inner'])
+        self.assertEqual(stages['total/outer/inner']['calls'], 3)
+        self.assertDictEqual(profile['counters'], {'lookups': 6})
+        self.assertIn('inner', profiling.format_summary(profile))
+
+        # nothing is recorded when profiling is disabled
+        with profiling.profile_run(enabled=False):
+            with profiling.stage('outer'):
+                profiling.count('lookups')
+        self.assertDictEqual(profiling.summary()['counters'], {'lookups': 6})
+
+    def testExpand(self):
+        with profiling.profile_run():
+            expand.expand('f', sinfo='{"s1": ["int"]}', int_file=testfile('simple_int.tab'),
+                          pep_colname_int='peptide', pep_colname_func='peptide', pep_colname_tax='peptide',
+                          data_dir=TEST_DIR, func_file=testfile('simple_func.tab'), func_colname='go', ontology='go')
+        stages = [record['stage'] for record in profiling.summary()['stages']]
+        for name in ['total/expand', 'total/expand/read', 'total/expand/load_db', 'total/expand/hierarchy']:
+            self.assertIn(name, stages)
+
+
+if __name__ == '__main__':
+    unittest.main()
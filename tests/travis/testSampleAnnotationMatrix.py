@@ -0,0 +1,90 @@
+import unittest
+import pandas as pd
+
+from metaquantome.databases.NCBITaxonomyDb import NCBITaxonomyDb
+from metaquantome.databases.EnzymeDb import EnzymeDb
+from metaquantome.classes.SampleAnnotations import SampleAnnotations
+from metaquantome.classes.SampleAnnotationMatrix import SampleAnnotationMatrix
+from metaquantome.classes.SampleGroups import SampleGroups
+from metaquantome.util import utils
+from metaquantome.util.utils import TEST_DIR
+
+
+class TestSampleAnnotationMatrix(unittest.TestCase):
+    ncbi = NCBITaxonomyDb(TEST_DIR)
+    ec = EnzymeDb(TEST_DIR)
+
+    # same test dataframe as in testSampleAnnotations
+    peptide = ['A', 'B', 'C', 'D', 'E', 'F', 'G']
+    lca = [9604, 9604, 9605, 9605, 9606, 9606, 9599]
+    samp1 = [1, 1, 1, 1, 1, 0, 1]
+    samp2 = [1, 1, 1, 1, 1, 1, 1]
+    samp_grps = SampleGroups('{"grp1": ["samp1", "samp2"]}')
+    test_df = pd.DataFrame({'lca': lca,
+                            'samp1': samp1,
+                            'samp2': samp2},
+                           index=[peptide])
+
+    def _compare_engines(self, db, df, annot_colname, samp_grps):
+        hier = SampleAnnotations(db)
+        hier.add_samples_from_df(df, annot_colname, samp_grps)
+        hier_df = hier.to_dataframe().sort_index(axis=1)
+        mat = SampleAnnotationMatrix(db)
+        mat.add_samples_from_df(df, annot_colname, samp_grps)
+        mat_df = mat.to_dataframe().sort_index(axis=1)
+        # intensities are always float in the matrix engine
+        hier_df[samp_grps.all_intcols] = hier_df[samp_grps.all_intcols].astype(float)
+        self.assertTrue(hier_df.equals(mat_df))
+        return mat_df
+
+    def testAddSample(self):
+        sa = SampleAnnotationMatrix(db=self.ncbi)
+        sa.add_samples_from_df(self.test_df, annot_colname='lca',
+                               samp_grps=self.samp_grps)
+        df = sa.to_dataframe()
+        self.assertEqual(df.loc[9604, 'samp1'], 6)
+        self.assertEqual(df.loc[9599, 'samp1'], 1)
+        self.assertEqual(df.loc[9606, 'samp1_n_peptide'], 1)
+        self.assertEqual(df.loc[9606, 'samp2_n_peptide'], 2)
+        # homo and pongo
+        self.assertEqual(df.loc[9604, 'samp1_n_samp_children'], 2)
+
+    def testSameAsHierarchyNcbi(self):
+        self._compare_engines(self.ncbi, self.test_df, 'lca', self.samp_grps)
+
+    def testSameAsHierarchyEc(self):
+        ec_df = pd.DataFrame({'ec': ['1.1.4.-', '1.1.4.1', '1.1.4.2', '6.5.-.-', '6.-.-.-', '1.1.4.1'],
+                              'samp1': [100, 200, 0, 10, 5, 20],
+                              'samp2': [0, 50, 30, 0, 15, 1]})
+        df = self._compare_engines(self.ec, ec_df, 'ec', self.samp_grps)
+        # 6.5.-.- is not observed in samp2, so it is missing rather than 0
+        self.assertTrue(pd.isnull(df.loc['6.5.-.-', 'samp2']))
+        self.assertEqual(df.loc['1.1.4.-', 'samp1_n_samp_children'], 1)
+        self.assertEqual(df.loc['1.1.4.-', 'samp2_n_samp_children'], 2)
+
+    def testAddChunks(self):
+        whole = SampleAnnotationMatrix(db=self.ncbi)
+        whole.add_samples_from_df(self.test_df, annot_colname='lca', samp_grps=self.samp_grps)
+        chunked = SampleAnnotationMatrix(db=self.ncbi)
+        for start in range(0, self.test_df.shape[0], 3):
+            chunked.add_chunk(self.test_df.iloc[start:start + 3], annot_colname='lca', samp_grps=self.samp_grps)
+        chunked.finalize()
+        self.assertTrue(whole.to_dataframe().equals(chunked.to_dataframe()))
+
+    def testAddTermMapping(self):
+        # peptides with several terms, as split by tidy_split or split_terms
+        ec_df = pd.DataFrame({'ec': ['1.1.4.1,6.5.-.-', '1.1.4.2', '1.1.4.1,1.1.4.2,6.-.-.-'],
+                              'samp1': [100, 0, 20],
+                              'samp2': [50, 30, 1]})
+        tidy = SampleAnnotationMatrix(db=self.ec)
+        tidy.add_samples_from_df(utils.tidy_split(ec_df, 'ec', sep=','), 'ec', self.samp_grps)
+        mapped = SampleAnnotationMatrix(db=self.ec)
+        positions, terms = utils.split_terms(ec_df['ec'], sep=',')
+        term_df = pd.DataFrame({'ec': terms, utils.PEPTIDE_ROW_COLNAME: positions})
+        mapped.add_term_mapping(ec_df, term_df, 'ec', self.samp_grps)
+        mapped.finalize()
+        pd.testing.assert_frame_equal(tidy.to_dataframe(), mapped.to_dataframe())
+
+
+if __name__ == '__main__':
+    unittest.main()
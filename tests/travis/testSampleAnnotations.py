@@ -38,6 +38,30 @@ class TestSampleAnnotations(unittest.TestCase):
         self.assertEqual(df.loc[9604, 'samp1'], 6)
         self.assertEqual(df.loc[9599, 'samp1'], 1)
 
+    def testToDataframeMissingTerms(self):
+        # 9599 is not observed in samp2
+        df = self.test_df.copy()
+        df['samp2'] = [1, 1, 1, 1, 1, 1, 0]
+        sa = SampleAnnotations(db=self.ncbi)
+        sa.add_samples_from_df(df, annot_colname='lca', samp_grps=self.samp_grps)
+        full_df = sa.to_dataframe()
+        self.assertListEqual(list(full_df.index), sorted(full_df.index))
+        self.assertTrue(pd.isnull(full_df.loc[9599, 'samp2']))
+        self.assertEqual(full_df.loc[9599, 'samp1_n_peptide'], 1)
+        # counts stay integers for samples that have every term
+        self.assertEqual(full_df['samp1_n_peptide'].dtype, 'int64')
+        self.assertEqual(full_df['samp2_n_peptide'].dtype, 'float64')
+
+    def testWorkers(self):
+        serial = SampleAnnotations(db=self.ncbi)
+        serial.add_samples_from_df(self.test_df, annot_colname='lca', samp_grps=self.samp_grps)
+        parallel = SampleAnnotations(db=self.ncbi, workers=2)
+        parallel.add_samples_from_df(self.test_df, annot_colname='lca', samp_grps=self.samp_grps)
+        parallel_df = parallel.to_dataframe()
+        self.assertTrue(serial.to_dataframe().equals(parallel_df))
+        # columns are in the order of the samples
+        self.assertListEqual(list(parallel_df)[:3], ['samp1', 'samp1_n_samp_children', 'samp1_n_peptide'])
+
     def testCreateSampleSet(self):
         sampset = SampleAnnotations.create_sample_set(self.test_df, 'lca')
         self.assertSetEqual(sampset, set(self.lca))
@@ -0,0 +1,94 @@
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import pandas as pd
+
+from metaquantome.databases.ReferenceDatabases import ReferenceDatabases
+from metaquantome.modules.expand import expand
+from metaquantome.modules.server import JobServer, submit
+from metaquantome.util.testutils import testfile, TTEST_SINFO
+from metaquantome.util.utils import TEST_DIR
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmpdir.name, 'mq.sock')
+        self.databases = ReferenceDatabases()
+        self.databases.preload(TEST_DIR, ['ncbi'])
+        self.server = JobServer(self.socket_path, self.databases)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.tmpdir.cleanup()
+
+    def testReferenceDatabases(self):
+        # the same object is returned, however data_dir is given
+        ncbi = self.databases.taxonomy_db(TEST_DIR)
+        self.assertIs(ncbi, self.databases.taxonomy_db(os.path.relpath(TEST_DIR)))
+        self.assertIsNone(self.databases.function_db(TEST_DIR, 'cog', False))
+
+    def testExpandJob(self):
+        args = dict(mode='t', sinfo=TTEST_SINFO, int_file=testfile('int_ttest.tab'), pep_colname_int='peptide',
+                    pep_colname_func='peptide', pep_colname_tax='peptide', data_dir=TEST_DIR,
+                    tax_file=testfile('multiple_tax.tab'), tax_colname='lca')
+        server_out = os.path.join(self.tmpdir.name, 'server_expanded.tab')
+        reply = submit(self.socket_path, 'expand', dict(args, outfile=server_out))
+        self.assertEqual(reply['status'], 'ok')
+
+        local_out = os.path.join(self.tmpdir.name, 'local_expanded.tab')
+        expand(outfile=local_out, **args)
+        pd.testing.assert_frame_equal(pd.read_table(server_out), pd.read_table(local_out))
+
+    def testFailedJob(self):
+        with self.assertRaises(RuntimeError):
+            submit(self.socket_path, 'stat', dict(infile='not_a_file.tab', sinfo=TTEST_SINFO, paired=False,
+                                                  parametric=True, ontology=None, mode='t', outfile=None,
+                                                  control_group='s2'))
+        with self.assertRaises(RuntimeError):
+            submit(self.socket_path, 'viz', dict())
+
+    def testNoReply(self):
+        # a job process that dies before replying closes the connection without a reply
+        silent_path = os.path.join(self.tmpdir.name, 'silent.sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+            listener.bind(silent_path)
+            listener.listen(1)
+            thread = threading.Thread(target=self._read_request_and_close, args=(listener,))
+            thread.start()
+            with self.assertRaisesRegex(RuntimeError, 'without a reply'):
+                submit(silent_path, 'stat', dict())
+            thread.join()
+
+    @staticmethod
+    def _read_request_and_close(listener):
+        conn, _ = listener.accept()
+        with conn, conn.makefile('r') as f:
+            f.readline()
+
+    def testServerShutDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        with self.assertRaisesRegex(RuntimeError, re.escape(self.socket_path)):
+            submit(self.socket_path, 'stat', dict())
+
+    def testLazyImports(self):
+        # the command line only imports the server and the job modules when they are needed
+        code = ('import sys; import metaquantome.cli; ' +
+                'print(any(name in sys.modules for name in ["metaquantome.modules.server", ' +
+                '"metaquantome.modules.expand", "metaquantome.modules.pipeline"]))')
+        self.assertEqual(subprocess.check_output([sys.executable, '-c', code]).decode().strip(), 'False')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -23,6 +23,45 @@ class TestStatUtils(unittest.TestCase):
         fc = stat.log2_fold_change(means, samps)
         self.assertTrue(fc['log2fc_s1_over_s2'].equals(pd.Series({0: np.log2(3/6), 1: np.log2(3/13)})))
 
+    def testTwoGroupTestSameAsScipy(self):
+        rng = np.random.RandomState(0)
+        grp1 = rng.normal(10, 2, (50, 4))
+        grp2 = rng.normal(11, 2, (50, 4))
+        # missing values, including a row with a single value in the first group
+        grp1[rng.random_sample(grp1.shape) < 0.2] = np.nan
+        grp1[0, 1:] = np.nan
+        # ties
+        grp2[1] = [5, 5, 6, 6]
+        for paired, parametric in [(False, True), (True, True), (False, False)]:
+            pvalues = stat.two_group_test(grp1, grp2, paired, parametric)
+            expected = [stat.scipy_row_test(x, y, paired, parametric) for x, y in zip(grp1, grp2)]
+            np.testing.assert_allclose(pvalues, expected, rtol=1e-10)
+        # signed-rank test needs pairs, so no missing values. the first row has a zero difference
+        grp1 = rng.normal(10, 2, (50, 6))
+        grp2 = rng.normal(11, 2, (50, 6))
+        grp1[0, 0] = grp2[0, 0]
+        pvalues = stat.two_group_test(grp1, grp2, True, False)
+        expected = [stat.scipy_row_test(x, y, True, False) for x, y in zip(grp1, grp2)]
+        np.testing.assert_allclose(pvalues, expected, rtol=1e-10)
+        # more pairs than the exact test of older scipy versions
+        grp1 = rng.normal(10, 2, (20, 30))
+        grp2 = rng.normal(11, 2, (20, 30))
+        pvalues = stat.two_group_test(grp1, grp2, True, False)
+        expected = [stat.scipy_row_test(x, y, True, False) for x, y in zip(grp1, grp2)]
+        np.testing.assert_allclose(pvalues, expected, rtol=1e-10)
+
+    def testWilcoxonExactMax(self):
+        self.assertEqual(stat.wilcoxon_exact_max('1.12.0'), 50)
+        self.assertEqual(stat.wilcoxon_exact_max('1.9.0rc1'), 50)
+        self.assertEqual(stat.wilcoxon_exact_max('1.8.1'), 25)
+        self.assertEqual(stat.wilcoxon_exact_max('1.3.0'), 25)
+        self.assertEqual(stat.wilcoxon_exact_max('1.1.0'), 0)
+        # rows with more pairs than the cutoff are left to scipy
+        rng = np.random.RandomState(0)
+        grp1 = rng.normal(10, 2, (5, 30))
+        pvalues, is_done = stat.signed_rank_rows(grp1, grp1 + 1, exact_max=25)
+        self.assertFalse(is_done.any())
+
 
 class TestFunctionTaxInteraction(unittest.TestCase):
     def testReadAndDE(self):
@@ -98,6 +137,28 @@ class TestFunctionalAnalysisTest(unittest.TestCase):
         self.assertTrue(ec_tst['p_s1_over_s2']['3.4.11.-'] > 0.05)
         self.assertTrue(ec_tst['p_s1_over_s2'][['3.4.21.70', '1.2.-.-']].le(0.05).all())
 
+    def testMultipleContrasts(self):
+        func = testfile('multiple_func.tab')
+        int = testfile('int_ttest.tab')
+        expandfile = testfile('ec_ttest_contrasts.tab')
+        sinfo = '{"s1": ["int1", "int2"], "s2": ["int3", "int4"], "s3": ["int5", "int6"]}'
+        expand.expand('f', sinfo=sinfo, int_file=int, pep_colname_int='peptide', pep_colname_func='peptide',
+                      pep_colname_tax='peptide', data_dir=TEST_DIR, outfile=expandfile, func_file=func, func_colname='ec',
+                      ontology='ec')
+        serial = stat.stat(expandfile, sinfo=sinfo, paired=False, parametric=True, ontology='ec', mode='f',
+                           control_group='s2', outfile=None)
+        threaded = stat.stat(expandfile, sinfo=sinfo, paired=False, parametric=True, ontology='ec', mode='f',
+                             control_group='s2', outfile=None, workers=2)
+        pd.testing.assert_frame_equal(serial, threaded)
+        # each case group is compared to the control, as if tested alone
+        for case in ['s1', 's3']:
+            samp_grps = SampleGroups(sinfo)
+            contrast = stat.define_contrast(samp_grps, case, 's2')
+            df = pd.read_csv(expandfile, sep='\t')
+            alone = stat.test_norm_intensity(df, contrast, paired=False, parametric=True)
+            for colname in ['log2fc_' + case + '_over_s2', 'p_' + case + '_over_s2', 'corrected_p_' + case + '_over_s2']:
+                np.testing.assert_allclose(serial[colname].values, alone[colname].values)
+
 
 class TestTaxonomyAnalysisTest(unittest.TestCase):
     def testTaxTTests(self):
@@ -7,6 +7,7 @@ from metaquantome.databases import GeneOntologyDb as godb
 from metaquantome.util import utils as utils
 from metaquantome.databases import EnzymeDb as ecdb
 from metaquantome.databases import NCBITaxonomyDb as ncbi
+from metaquantome.databases.ClosureCache import ClosureCache
 from metaquantome.util.utils import TEST_DIR
 
 
@@ -23,6 +24,19 @@ class TestUtils(unittest.TestCase):
         nam_df = pd.DataFrame({'tax': ['imataxon', 'imanothertaxon', 'third']})
         self.assertTrue(utils.sniff_tax_names(nam_df, 'tax'))
 
+    def testTidySplit(self):
+        df = pd.DataFrame({'go': ['a,b', 'c', 'd,e,f'], 'int': [1, 2, 3]}, index=['x', 'y', 'z'])
+        split_df = utils.tidy_split(df, 'go', sep=',')
+        self.assertListEqual(split_df['go'].tolist(), ['a', 'b', 'c', 'd', 'e', 'f'])
+        self.assertListEqual(split_df['int'].tolist(), [1, 1, 2, 3, 3, 3])
+        self.assertListEqual(split_df.index.tolist(), ['x', 'x', 'y', 'z', 'z', 'z'])
+        kept_df = utils.tidy_split(df, 'go', sep=',', keep=True)
+        self.assertListEqual(kept_df['go'].tolist(), ['a,b', 'a', 'b', 'c', 'd,e,f', 'd', 'e', 'f'])
+
+        positions, terms = utils.split_terms(df['go'], sep=',')
+        self.assertListEqual(positions.tolist(), [0, 0, 1, 2, 2, 2])
+        self.assertListEqual(terms.tolist(), split_df['go'].tolist())
+
     def testFilter(self):
         ncbi_db = ncbi.NCBITaxonomyDb(TEST_DIR)
         tax_df = pd.DataFrame({'tax': [np.nan, 210, '9999999']},
@@ -74,5 +88,16 @@ class TestReduceFuncDf(unittest.TestCase):
                                  'intensity': [100, 200]}).sort_index(axis='columns')
         self.assertTrue(expected.equals(obs_result))
 
+    def testMakeDfNonRedundantRepeated(self):
+        # each distinct annotation string is reduced once, and each term's ancestors are looked up once
+        cache = ClosureCache(self.ec_db)
+        ecdf = pd.DataFrame({'ec': ['1.1.4.-,1.1.4.2', '1.1.4.-,1.1.4.1', '1.1.4.-,1.1.4.2'],
+                             'peptide': ['A', 'B', 'C']})
+        obs_result = metaquantome.util.utils.reduce_func_df(cache, ecdf, 'ec', ',')
+        self.assertListEqual(obs_result['ec'].tolist(), ['1.1.4.2', '1.1.4.1', '1.1.4.2'])
+        self.assertEqual(cache.cache_info()['ancestors']['misses'], 3)
+        self.assertEqual(cache.cache_info()['ancestors']['hits'], 1)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file